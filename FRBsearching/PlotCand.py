@@ -139,184 +139,284 @@ def pairwise(iterable):
     next(b, None)
     return zip(a, b)
 
-def plotParaCalc(snr,filter,dm,fl,fh,tint,nchan):
-        #Extract block factor plot in seconds
-	extimefact = 1.0
-
-        # Total extract time Calc
-        # Extract according to the DM delay    
-	cmd = 'dmsmear -f %f -b %f -n 2048 -d ' % (fl+(fh-fl)/2,fh-fl) + str(dm) + " -q 2>&1 "
-	p = os.popen(cmd)
-	cand_band_smear = p.readline().strip()
-	p.close()
-        #extime = extimefact/2 + extimefact*float(cand_band_smear)
-
-        # Tbin calc
-        # For Filter widths startting from 2^0 to 2^12=4096
-        #widths = [2048,2048,2048,1024,1024,512,512,256,256,128,128,64,32]
-        #tbin = widths[filter]
-	bin_width = tint * (2 ** filter)
-
-	extime = 2*float(cand_band_smear) 
-	if extime < 1.0: extime = 1.0
-
-	#So that we have at least 4 bins on pulse
-	if filter <= 4 and snr > 20:
-		tbin = 4.0*int(extime / bin_width)
-	else:
-		tbin = 2.0*int(extime / bin_width)
-
-	if tbin < 16:
-		tbin = 16
-
-	if tint > (extime/tbin):
-		tbin = int(extime/tint)
-
-        #Fbin Calc
-	fbin = int(round(math.pow(float(snr)/4.0,2)))
-	if (fbin > nchan): fbin=nchan
-
-	#print "fbin " + str(fbin)
-
-	#if nchan is not power of 2, get fbin modulo of nchan
-	i=0
-	while nchan%(fbin+i): i+=1
-	fbin+=i
-
-	#print "fbin " + str(fbin)
-
-	if fbin > 512:
-            #fbin = 512
-		i=0
-		while nchan%(512-i): i+=1
-		fbin=512-i
-
-	#print "fbin " + str(fbin)
-
-	if fbin<16:
-		i=0
-		while nchan%(16+i): i+=1
-		fbin=i+16
-
-	#print "fbin " + str(fbin)
-
-        #fbin_base2 = int(round(math.log(fbin,2)))
-        #fbin = pow(2,fbin_base2)
+# Dispersion constant (MHz^2 pc^-1 cm^3 s)
+KDM = 4148.808
 
+def plotParaCalcArray(snr,filter,dm,fl,fh,tint,nchan):
 	'''
-	if(nchan%float(fbin)):
-		# If the fbin is not modulo of number of channel, we select closed modulo nchan		
-		fbin = nchan/2**np.argmin([abs(float(fbin)-nchan/2**i) for i in range(0,10)]) 
+	Plot parameters of all candidates at once (snr, filter and dm are arrays).
+	The band smearing is the cold-plasma dispersion delay across the band
+	(in seconds). Returns arrays of tbin, fbin, extime and smear and the
+	list of frac arrays.
 	'''
-
+	snr = np.atleast_1d(np.asarray(snr,dtype=float))
+	filter = np.atleast_1d(np.asarray(filter,dtype=int))
+	dm = np.atleast_1d(np.asarray(dm,dtype=float))
+
+	# Total extract time according to the DM delay
+	flo = min(fl,fh)
+	fhi = max(fl,fh)
+	cand_band_smear = KDM*dm*(flo**-2 - fhi**-2)
+	extime = np.maximum(2*cand_band_smear,1.0)
+
+	# Tbin calc, so that we have at least 4 bins on pulse
+	bin_width = tint*(2.0**filter)
+	tbin = np.where((filter<=4) & (snr>20),4.0,2.0)*np.floor(extime/bin_width)
+	tbin = np.maximum(tbin,16)
+	tbin = np.where(tint > extime/tbin,np.floor(extime/tint),tbin)
+
+	# Fbin calc: closest number of subbands that divides nchan
+	divisors = np.array([i for i in range(1,nchan+1) if nchan%i == 0])
+	fbin = np.minimum(np.round((snr/4.0)**2),nchan)
+	fbin = divisors[np.minimum(np.searchsorted(divisors,fbin),divisors.size-1)]
+	fbin = np.where(fbin>512,divisors[np.searchsorted(divisors,512,side='right')-1],fbin)
+	fbin = np.where(fbin<16,divisors[min(np.searchsorted(divisors,16),divisors.size-1)],fbin)
+
+	# Fraction of extraction to plot each time calc (we expect pulse to be in first half)
 	bins_per_plot=1024.0
+	frac = [np.linspace(0,0.5,num=int(np.ceil(t/bins_per_plot))) if t>bins_per_plot \
+			else np.array([0,0.5]) for t in tbin]
 
-        # Fraction of extraction to plot each time calc (we expect pulse to be in first half)
-	if tbin>bins_per_plot:
-		frac = np.linspace(0,0.5,num=int(np.ceil(tbin/bins_per_plot))) 
-	else:
-		frac = np.array([0,0.5]) 
-
-	return tbin,fbin,extime,frac,cand_band_smear 
-
-def extractPlotCand(fil_file,frb_cands,noplot,fl,fh,tint,Ttot,kill_time_range,kill_chans,source_name,nchan,mask_file,smooth,zerodm,csv_file,manualzap):
-	parallel=1
-	if(frb_cands.size >= 1 and noplot is not True):
-			if(frb_cands.size>1):
-                                frb_cands = np.sort(frb_cands)
-                                frb_cands[:] = frb_cands[::-1]
-			if(frb_cands.size==1): frb_cands = [frb_cands]
-			cmd = "rm *.png *.ps *.pdf"
-			print(cmd)
-			os.system(cmd)
-			cmd_array=[]
-			for indx,frb in enumerate(frb_cands):
-                                #time = frb['time'] #This time is rounded so not using it.
-                                time = float(frb['samp_idx'])*(1.0/tint) #Getting arrival time from the sample number
-                                dm = frb['dm']
-                                filter = frb['filter']
-                                width = tint * (2 ** filter)*(10**3) # Width in msec
-                                snr = frb['snr']
-				#if frb.size > 6: prob = frb['FRBprob']	#This is not working
-                                if np.size(frb.tolist())>6: prob = frb['FRBprob']
-                                else: prob = ""
-
-                                print(frb,np.size(frb.tolist()),prob)
-                                tbin,fbin,extime,frac,cand_band_smear=plotParaCalc(snr,filter,dm,fl,fh,tint,nchan)
-                                bin_width = (2 ** filter)
-				#So that we have at least 4 bins on puls
-                                if filter <= 4 and filter > 0 and snr > 20:
-                                        downfact = int(bin_width/4.0)
-                                elif filter > 2:
-                                        downfact = int(bin_width/2.0)
-                                else:
-                                        downfact = 1
-                                if downfact == 0: downfact = 1
+	return tbin,fbin,extime,frac,cand_band_smear
 
-                                print(fbin,filter,bin_width,downfact)
-				#stime = time-(extimeplot*0.1) # Go back data
-                                #stime = time - float(cand_band_smear) 
-				#TotDisplay = (downfact*bin_width)*tint*128 # To display 256 times the pulse width in the plot
-				#print TotDisplay
-
-                                TotDisplay = (width/10**3)*128 #Roughly 128 times the pulse width window for display
-
-                                stime = time-(TotDisplay/2.0)
+def plotParaCalc(snr,filter,dm,fl,fh,tint,nchan):
+	tbin,fbin,extime,frac,cand_band_smear = plotParaCalcArray(snr,filter,dm,fl,fh,tint,nchan)
+	return tbin[0],int(fbin[0]),extime[0],frac[0],cand_band_smear[0]
 
-                                if smooth: smooth_bins  = int(smooth*(bin_width)) # As downsampling is done after the smoothing, we do not need to multiplie downsample here
-                                else: smooth_bins = 0
+def candPlotList(frb_cands,fl,fh,tint,Ttot,kill_time_range,nchan,smooth):
+    '''
+    Work out the waterfaller_vg.py parameters of every candidate.
+    Candidates are ordered by decreasing SNR and the index in the name of
+    the plot follows that order. Candidates inside a bad-time range are dropped.
+    '''
+    if(frb_cands.size>1):
+        frb_cands = np.sort(frb_cands)
+        frb_cands[:] = frb_cands[::-1]
+    frb_cands = np.atleast_1d(frb_cands)
+    tbins,fbins,extimes,fracs,smears = plotParaCalcArray(frb_cands['snr'],frb_cands['filter'], \
+                                        frb_cands['dm'],fl,fh,tint,nchan)
+    cands=[]
+    for indx,frb in enumerate(frb_cands):
+        time = float(frb['samp_idx'])*tint #Getting arrival time from the sample number
+        # Values go through str() as they did on the waterfaller_vg.py command line
+        dm = float(str(frb['dm']))
+        filter = frb['filter']
+        width = tint * (2 ** filter)*(10**3) # Width in msec
+        snr = frb['snr']
+        #if frb.size > 6: prob = frb['FRBprob']	#This is not working
+        if np.size(frb.tolist())>6: prob = frb['FRBprob']
+        else: prob = ""
+
+        print(frb,np.size(frb.tolist()),prob)
+        tbin,fbin,extime,frac,cand_band_smear = tbins[indx],fbins[indx],extimes[indx],fracs[indx],smears[indx]
+        bin_width = (2 ** filter)
+        #So that we have at least 4 bins on puls
+        if filter <= 4 and filter > 0 and snr > 20:
+            downfact = int(bin_width/4.0)
+        elif filter > 2:
+            downfact = int(bin_width/2.0)
+        else:
+            downfact = 1
+        if downfact == 0: downfact = 1
+
+        print(fbin,filter,bin_width,downfact)
+        #stime = time-(extimeplot*0.1) # Go back data
+        #stime = time - float(cand_band_smear) 
+        #TotDisplay = (downfact*bin_width)*tint*128 # To display 256 times the pulse width in the plot
+        #print TotDisplay
+
+        TotDisplay = (width/10**3)*128 #Roughly 128 times the pulse width window for display
+
+        stime = time-(TotDisplay/2.0)
+
+        if smooth: smooth_bins  = int(smooth*(bin_width)) # As downsampling is done after the smoothing, we do not need to multiplie downsample here
+        else: smooth_bins = 0
+
+        if(stime<0): stime = 0
+        if(stime+extime>=Ttot): extime=Ttot-stime
+        if(any(l<=time<=u for (l,u) in kill_time_range) or extime < 0.0):
+            print("Candidate inside bad-time range")
+        else:
+            candname = '%04d' % (indx) + "_" + '%.3f' % (time) + "sec_DM" + '%.2f.png' % (dm)
+            cands.append({'candname':candname,'time':time,'stime':stime,'TotDisplay':TotDisplay,
+                          'dm':dm,'fbin':int(fbin),'downfact':downfact,'smooth_bins':smooth_bins,
+                          'snr':str(snr),'width':str(width),
+                          'prob':float(str(prob)) if prob else None})
+    return cands
+
+def candPlotCmd(fil_file,cand,mask_file,zerodm,csv_file,manualzap):
+    '''
+    waterfaller_vg.py command line which plots one candidate of candPlotList
+    '''
+    #SOF EDIT
+    #spandak_path = '/home/ssheikh/FRB/STARTING_OVER/PulsarSearch/'
+    spandak_path = '/home/vishalg/SPANDAK_ATA/FRBsearching/'
+    cmd = spandak_path + "waterfaller_vg.py --show-ts " + \
+           " -t " + str(cand['TotDisplay']) + \
+           " --colour-map=hot " + \
+           " -T "  + str(cand['stime']) +  \
+           " -d "  + str(cand['dm']) + \
+           " --sweep-dm " + str(cand['dm']) + \
+           " -s "  + str(cand['fbin']) +  \
+           " -o "  + str(cand['candname']) + \
+           " --scaleindep " + \
+           " --downsamp " + str(cand['downfact']) + \
+           " --width-bins " + str(cand['smooth_bins']) + \
+           " --snr " + cand['snr'] + \
+           " --width " + cand['width'] + " " + \
+           fil_file 
+    if mask_file: cmd = cmd + " --mask --maskfile  " + str(mask_file) 
+    if zerodm: cmd = cmd + " --zerodm "
+    if csv_file: cmd = cmd + " --logs " + str(csv_file)
+    if cand['prob']: cmd = cmd + " --prob " + str(cand['prob'])
+    if manualzap: cmd = cmd + " -Z " + str(manualzap)	
+    return cmd
+
+# State of a renderer worker: the waterfaller module and the opened filterbank file
+_render_state = {}
+
+def _render_init(fil_file,mask_file):
+    '''
+    Pool initializer: import the plotting code, open the filterbank file
+    and read the rfifind mask once for the life of the worker.
+    '''
+    import waterfaller_vg
+    _render_state['wf'] = waterfaller_vg
+    _render_state['rawdatafile'] = waterfaller_vg.FilterbankMmap(fil_file)
+    if mask_file: waterfaller_vg.load_rfimask(mask_file)
 
-                                if(stime<0): stime = 0
-                                if(stime+extime>=Ttot): extime=Ttot-stime
-                                if(any(l<=time<=u for (l,u) in kill_time_range) or extime < 0.0):
-                                        print("Candidate inside bad-time range")
-                                else:
-                                        candname = '%04d' % (indx) + "_" + '%.3f' % (time) + "sec_DM" + '%.2f.png' % (dm)
-                                        #SOF EDIT
-                                        #spandak_path = '/home/ssheikh/FRB/STARTING_OVER/PulsarSearch/'
-                                        spandak_path = '/home/vishalg/SPANDAK_ATA/FRBsearching/'
-                                        cmd = spandak_path + "waterfaller_vg.py --show-ts " + \
-					       " -t " + str(TotDisplay) + \
-				 	       " --colour-map=hot " + \
-					       " -T "  + str(stime) +  \
-					       " -d "  + str(dm) + \
-					       " --sweep-dm " + str(dm) + \
-					       " -s "  + str(fbin) +  \
-					       " -o "  + str(candname) + \
-					       " --scaleindep " + \
-					       " --downsamp " + str(downfact) + \
-					       " --width-bins " + str(smooth_bins) + \
-					       " --snr " + str(snr) + \
-					       " --width " + str(width) + " " + \
- 					       fil_file 
-                                        if mask_file: cmd = cmd + " --mask --maskfile  " + str(mask_file) 
-                                        if zerodm: cmd = cmd + " --zerodm "
-                                        if csv_file: cmd = cmd + " --logs " + str(csv_file)
-                                        if prob: cmd = cmd + " --prob " + str(prob)
-                                        if manualzap: cmd = cmd + " -Z " + str(manualzap)	
-					#os.system(cmd) 						
-                                        if parallel: 
-                                                cmd_array.append(cmd)
-                                        else:
-                                                print(cmd)
-                                                os.system(cmd)					
-					#df=pd.DataFrame({'PNGFILE':[candname],'filename':[fil_file]})
-					#if csv_file: csvdata = csvdata.append(df)
-			if parallel:
-				exeparallel(cmd_array)
-				#open('cand_plot_commands','wb').write('\n'.join(i for i in cmd_array))
-				open('cand_plot_commands','w').write('\n'.join(i for i in cmd_array))
-			#if csv_file: csvdata.to_csv(csv_file)		
-			tt.sleep(2)	
-			print("Plotting Done")
-
-			#cmd = "gs -sDEVICE=pdfwrite -dNOPAUSE -dBATCH -dSAFER -sOutputFile=%s_frb_cand.pdf *.png" % (source_name)
-			#cmd = "convert [A-Z]*.png 0*.png %s_frb_cand.pdf" % (source_name)
-		        #print cmd
-             		#os.system(cmd)
-	else:
-                print("No candidate found")
-                return
+def _render_one(task):
+    '''
+    Plot one candidate in a renderer worker, same as one waterfaller_vg.py call.
+    Returns the name of the plot and the CSV row of the candidate (None if
+    it was not plotted).
+    '''
+    cand,fil_file,mask_file,zerodm,csv_file,manualzap = task
+    wf = _render_state['wf']
+    rawdatafile = _render_state['rawdatafile']
+    try:
+        data, bins, nbins, start, source_name = wf.waterfall(rawdatafile, cand['stime'], \
+                                cand['TotDisplay'], dm=cand['dm'], nsub=cand['fbin'], \
+                                subdm=cand['dm'], zerodm=bool(zerodm), downsamp=cand['downfact'], \
+                                scaleindep=True, width_bins=cand['smooth_bins'], \
+                                mask=bool(mask_file), maskfn=mask_file or None, \
+                                csv_file=csv_file, zap_original=manualzap or None)
+        ofile,ttest,ttestprob = wf.plot_waterfall(data, start, source_name, cand['TotDisplay'], \
+                                dm=cand['dm'], ofile=cand['candname'], integrate_ts=True, \
+                                cmap_str="hot", sweep_dms=[cand['dm']], sweep_posns=None, \
+                                downsamp=cand['downfact'], width=cand['width'], snr=cand['snr'], \
+                                csv_file=csv_file, prob=cand['prob'])
+    except Exception as e:
+        print("[render_candidates] ERROR plotting %s: %s" % (cand['candname'],e))
+        return None,None
+    row = wf.cand_csv_row(rawdatafile, fil_file, ofile, ttest, ttestprob, cand['snr'], \
+                          cand['width'], cand['dm'], cand['prob'])
+    return ofile,row
+
+def _render_block(task):
+    '''
+    Read one block of the extraction plan with a single sequential read
+    and plot its candidates from views of the block.
+    Returns (index,ofile,row) for every candidate of the block.
+    '''
+    bstart,bnspec,indexed,fil_file,mask_file,zerodm,csv_file,manualzap = task
+    rawdatafile = _render_state['rawdatafile']
+    rawdatafile.load_block(bstart,bnspec)
+    out = []
+    for indx,cand in indexed:
+        ofile,row = _render_one((cand,fil_file,mask_file,zerodm,csv_file,manualzap))
+        out.append((indx,ofile,row))
+    return out
+
+def planCandBlocks(fil_file,cands,nproc,max_block_bytes=256*1024**2):
+    '''
+    Extraction plan of the candidates: the data windows read by waterfall()
+    are sorted by start sample and overlapping windows are merged into
+    blocks (of at most max_block_bytes), so the file is read once, in order.
+    A task is a whole block, or the candidates of a large block are split
+    over several tasks so all workers stay busy: each task then reads only
+    the sub-window of the block covered by its own candidates, and only the
+    spectra shared by the windows at the edge of two tasks are read twice.
+    Returns a list of (start,nspec,[(index,cand),...]) in file order.
+    '''
+    import waterfaller_vg
+    from filterbank_mmap import plan_blocks
+    rawdatafile = waterfaller_vg.FilterbankMmap(fil_file)
+    windows = []
+    for cand in cands:
+        start_bin,nbinsextra,nbins = waterfaller_vg.cutout_window(rawdatafile,cand['stime'], \
+                                        cand['TotDisplay'],dm=cand['dm'])
+        windows.append((start_bin,nbinsextra))
+    max_nspec = max(1,max_block_bytes//rawdatafile.bytes_per_spectrum)
+    per_task = max(1,int(math.ceil(len(cands)/float(nproc))))
+    plan = []
+    for bstart,bnspec,indices in plan_blocks(windows,max_nspec):
+        for ii in range(0,len(indices),per_task):
+            part = indices[ii:ii+per_task]
+            # Union of the windows of the task (the whole block for one task)
+            tstart = min(windows[indx][0] for indx in part)
+            tstop = max(windows[indx][0]+max(windows[indx][1],0) for indx in part)
+            plan.append((tstart,tstop-tstart,[(indx,cands[indx]) for indx in part]))
+    return plan
+
+def render_candidates(fil_file,cands,mask_file="",zerodm=False,csv_file="",manualzap=None,nproc=20,store=None):
+    '''
+    Plot the candidates of candPlotList with a pool of long-lived workers.
+    Each worker opens the filterbank file and the mask once and calls
+    waterfall()/plot_waterfall() directly instead of starting a new
+    waterfaller_vg.py process per candidate. The work is handed out as
+    blocks of the extraction plan (planCandBlocks), in file order.
+    The CSV rows are written here, by one process, in candidate order, and
+    put in the queue of the candidate store (cand_store.StoreWriter) if given.
+    Returns the number of plotted candidates.
+    '''
+    if not cands: return 0
+    from multiprocessing import Pool
+    import waterfaller_vg
+    nproc = max(1,min(nproc,len(cands),os.cpu_count() or 1))
+    plan = planCandBlocks(fil_file,cands,nproc)
+    print("Extracting %d candidates with %d block reads" % (len(cands),len(plan)))
+    tasks = [(bstart,bnspec,indexed,fil_file,mask_file,zerodm,csv_file,manualzap) \
+                for bstart,bnspec,indexed in plan]
+    rows = {}
+    nplot = 0
+    pool = Pool(nproc,initializer=_render_init,initargs=(fil_file,mask_file))
+    try:
+        for out in pool.imap(_render_block,tasks):
+            for indx,ofile,row in out:
+                if row is not None: rows[indx] = row
+                if ofile: nplot+=1
+    finally:
+        pool.close()
+        pool.join()
+    if nplot < len(cands):
+        print("[render_candidates] %d of %d candidates not plotted" % (len(cands)-nplot,len(cands)))
+    for indx in sorted(rows):
+        if csv_file: waterfaller_vg.append_csv(csv_file,rows[indx])
+    if store is not None:
+        from cand_store import plot_row
+        store.put([plot_row(fil_file,rows[indx].iloc[0].to_dict(),cands[indx]['time']) for indx in sorted(rows)])
+    return nplot
+
+def extractPlotCand(fil_file,frb_cands,noplot,fl,fh,tint,Ttot,kill_time_range,kill_chans,source_name,nchan,mask_file,smooth,zerodm,csv_file,manualzap,nproc=20,store=None):
+    if(frb_cands.size >= 1 and noplot is not True):
+        cmd = "rm *.png *.ps *.pdf"
+        print(cmd)
+        os.system(cmd)
+        cands = candPlotList(frb_cands,fl,fh,tint,Ttot,kill_time_range,nchan,smooth)
+        cmd_array = [candPlotCmd(fil_file,cand,mask_file,zerodm,csv_file,manualzap) for cand in cands]
+        # Commands are kept to re-plot a single candidate by hand
+        open('cand_plot_commands','w').write('\n'.join(i for i in cmd_array))
+        render_candidates(fil_file,cands,mask_file,zerodm,csv_file,manualzap,nproc,store)
+        print("Plotting Done")
+
+        #cmd = "gs -sDEVICE=pdfwrite -dNOPAUSE -dBATCH -dSAFER -sOutputFile=%s_frb_cand.pdf *.png" % (source_name)
+        #cmd = "convert [A-Z]*.png 0*.png %s_frb_cand.pdf" % (source_name)
+        #print cmd
+        #os.system(cmd)
+    else:
+        print("No candidate found")
+        return
 
 #python waterfaller_vg.py -T 16.22 -d 600 --show-ts  -t 0.06  --sweep-posn 0.2 /mnt_blpd9/datax/incoming/spliced_guppi_57991_49905_DIAG_FRB121102_0011.gpuspec.0001.8.4chan.fil --colour-map=hot --width-bins 1 -s 64
 
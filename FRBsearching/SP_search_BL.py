@@ -11,11 +11,27 @@ from email.mime.application import MIMEApplication  # Needed for email only
 import smtplib  # Needed for email only
 import re
 from PlotCand import extractPlotCand
+from heimdall_chunks import heimdall_chunked, run_chunk
+from cpu_search import cpu_search
+from coincidencer import coincidencer
+from frb_detector_bl import classify, load_all_cands, TextOutput
+from filterbank_mmap import FLIPS, FilterbankMmap
+from subBand import subband_search
+from stream_search import follow
+from obsinfo import obs_info, dead_channels
+from obsinfo import base_name as obs_base_name
+from reduce_fil import reduce_fil, reduced_info, start_reduce
+from stage_cache import StageCache
+from stage_timer import StageTimer, count_lines
+from ml_share import remote_predict
+from cand_store import StoreWriter, frbcand_rows
+import atexit
 import subprocess as sb
 from os.path import basename
 from argparse import ArgumentParser
 import os
 import sys
+import hashlib
 # import math
 # import rfi_quality_check
 # import bird_wrapper
@@ -29,12 +45,6 @@ import glob
 # sys.path.insert(0, '/home/ssheikh/FRB/STARTING_OVER/PulsarSearch/robert_sp/')
 sys.path.insert(0, '/home/vishalg/SPANDAK_ATA/FRBsearching/robert_sp/')
 # import sp_cand_find as sp -> IMPORTED LATER ON IF NEEDED
-# Added by WF
-try:
-    from sigpyproc.Readers import FilReader
-except ModuleNotFoundError as e:
-    from sigpyproc.readers import FilReader
-
 # from PlotCand import extractPlotCand_old
 # import pandas as pd
 
@@ -76,6 +86,22 @@ def emailsend(send_to, subject, msgtxt, files, candtxt):
     print("email sent")
 
 
+# Wall time, CPU time and memory of the stages of the run
+timer = StageTimer()
+
+
+def run_stage(cache, stage, func, **kwargs):
+    '''
+    Run func as a stage of the manifest of the run: skipped when its
+    inputs, parameters, code and upstream stages did not change.
+    Always run without a cache.
+    '''
+    if cache is None:
+        with timer.stage(stage):
+            return func()
+    return cache.run(stage, func, **kwargs)
+
+
 def candplots(
         fil_file,
         source_name,
@@ -99,7 +125,18 @@ def candplots(
         csv_file,
         ml_model,
         manualzap,
-        onlyA):
+        onlyA,
+        coincide=True,
+        cache=None,
+        ml_server="",
+        cand_db=""):
+    # Candidates of the detection, ML and plot stages go to the candidate store
+    store = None
+    if cand_db:
+        store = StoreWriter(cand_db)
+        atexit.register(store.close)
+        header = FilterbankMmap(fil_file).header
+
     if (nogpu is not True):
         # os.chdir(basedir)
         # os.system("cd %s" % (basedir))
@@ -108,37 +145,65 @@ def candplots(
         #spandak_dir = "/home/ssheikh/FRB/STARTING_OVER/PulsarSearch/"
         spandak_dir = "/home/vishalg/SPANDAK_ATA/FRBsearching/"
         print("Inside : %s" % (basedir))
-        os.system("rm *_all.cand")
         os.system("rm *.ar *.norm")
-        os.system("coincidencer *.cand")
-        # SOF EDIT
-        # os.system(spandak_dir + "trans_gen_overview_uGMRT.py -cands_file *_all.cand")
-        # os.system("mv overview_1024x768.tmp.png %s.overview.png" % (source_name))
-        os.system(
-            spandak_dir +
-            "frb_detector_bl.py  -gdm 6 -cands_file *_all.cand -filter_cut %d -snr_cut %f -max_cands_per_sec %f -min_members_cut %f -verbose" %
-            (filter_cut,
-             snr_cut,
-             maxCandSec,
-             minMem))
-        os.system(
-            spandak_dir +
-            "frb_detector_bl.py  -gdm 6 -cands_file *_all.cand -filter_cut %d -snr_cut %f -max_cands_per_sec %f -min_members_cut %f  > FRBcand" %
-            (filter_cut,
-             snr_cut,
-             maxCandSec,
-             minMem))
-        if ml_model and (os.stat("FRBcand").st_size != 0):
-            print("ML model given")
-            FRBcand = os.path.abspath("FRBcand")
-            if(manualzap):
-                cmd="python /home/vishalg/SPANDAK_ATA/ML/simulateFRBclassification/predict.py %s %s -f %s -Z %s" % (FRBcand,ml_model,fil_file,manualzap)
-            else:
-                cmd="python /home/vishalg/SPANDAK_ATA/ML/simulateFRBclassification/predict.py %s %s -f %s" % (FRBcand,ml_model,fil_file)
-            os.system(cmd)
 
-            # cmd="python /home/vishalg/hey-aliens/simulateFRBclassification/predict.py %s %s -f %s" % (FRBcand,ml_model,fil_file)
-            # os.system(cmd)
+        def coincidence():
+            os.system("rm *_all.cand")
+            coincidencer(glob.glob("*.cand"))
+
+        def detect():
+            # SOF EDIT
+            # os.system(spandak_dir + "trans_gen_overview_uGMRT.py -cands_file *_all.cand")
+            # os.system("mv overview_1024x768.tmp.png %s.overview.png" % (source_name))
+            # Classified once, printed to the console and to FRBcand
+            categories, counts, rates = classify(load_all_cands(glob.glob("*_all.cand")), gdm=6,
+                                                 snr_cut=snr_cut, filter_cut=filter_cut,
+                                                 members_cut=minMem, max_cands_per_sec=maxCandSec)
+            text_output = TextOutput()
+            text_output.print_summary(counts, rates, maxCandSec)
+            text_output.print_text(categories)
+            with open("FRBcand", "w") as f:
+                text_output.print_text(categories, f)
+
+        def predict():
+            if ml_model and (os.stat("FRBcand").st_size != 0):
+                print("ML model given")
+                FRBcand = os.path.abspath("FRBcand")
+                if ml_server:
+                    # Model loaded once by the batch (see spandak_batch.py)
+                    remote_predict(ml_server, FRBcand, fil_file, manualzap)
+                    return
+                if(manualzap):
+                    cmd="python /home/vishalg/SPANDAK_ATA/ML/simulateFRBclassification/predict.py %s %s -f %s -Z %s" % (FRBcand,ml_model,fil_file,manualzap)
+                else:
+                    cmd="python /home/vishalg/SPANDAK_ATA/ML/simulateFRBclassification/predict.py %s %s -f %s" % (FRBcand,ml_model,fil_file)
+                os.system(cmd)
+
+                # cmd="python /home/vishalg/hey-aliens/simulateFRBclassification/predict.py %s %s -f %s" % (FRBcand,ml_model,fil_file)
+                # os.system(cmd)
+
+        # The CPU search writes the *_all.cand file itself
+        if coincide:
+            run_stage(cache, 'coincidencer', coincidence,
+                      inputs=[c for c in glob.glob("*.cand") if not c.endswith("_all.cand")],
+                      code=['coincidencer.py'], upstream=['search'], outputs=['*_all.cand'])
+            timer.count('coincidencer', 'candidates', count_lines(glob.glob("*_all.cand")))
+        run_stage(cache, 'frb_detector', detect,
+                  params={'filter_cut': filter_cut, 'snr_cut': snr_cut,
+                          'maxCandSec': maxCandSec, 'minMem': minMem},
+                  code=['frb_detector_bl.py'],
+                  upstream=['coincidencer' if coincide else 'search'], outputs=['FRBcand'])
+        timer.count('frb_detector', 'candidates', count_lines(["FRBcand"]))
+        if store:
+            store.put(frbcand_rows("FRBcand", fil_file, header, source_name))
+        run_stage(cache, 'ml', predict,
+                  inputs=[ml_model] if ml_model else [],
+                  params={'ml_model': ml_model, 'manualzap': manualzap},
+                  upstream=['frb_detector'], outputs=['FRBcand_prob.txt'])
+        if ml_model:
+            timer.count('ml', 'candidates', count_lines(["FRBcand_prob.txt"]))
+            if store:
+                store.put(frbcand_rows("FRBcand_prob.txt", fil_file, header, source_name))
 
         if (os.stat("FRBcand").st_size != 0):
             if ml_model and os.stat("FRBcand_prob.txt").st_size != 0:
@@ -205,14 +270,14 @@ def candplots(
                         'i4',
                         'i4')})
             frb_cands = np.zeros(len(gcands), dt)
-            for i, dd in enumerate(gcands):
-                frb_cands[i] = np.array(
-                    [(dd.sigma, dd.time, dd.sample, dd.dm, dd.dfact, 0)][0], dt)
+            for name, col in [('snr', 'sigma'), ('time', 'time'), ('samp_idx', 'sample'),
+                              ('dm', 'dm'), ('filter', 'dfact')]:
+                frb_cands[name] = gcands[col]
         else:
             print("No candidate found")
             return
 
-    extractPlotCand(
+    run_stage(cache, 'plot', lambda: extractPlotCand(
         fil_file,
         frb_cands,
         noplot,
@@ -228,7 +293,19 @@ def candplots(
         smooth,
         zerodm,
         csv_file,
-        manualzap)
+        manualzap,
+        store=store),
+        inputs=[fil_file],
+        # The candidates themselves: the --nogpu list has no upstream stage
+        params={'noplot': noplot, 'kill_time_range': kill_time_range, 'mask_file': mask_file,
+                'smooth': smooth, 'zerodm': zerodm, 'csv_file': csv_file,
+                'manualzap': manualzap, 'onlyA': onlyA,
+                'cands': hashlib.sha1(np.ascontiguousarray(frb_cands).tobytes()).hexdigest()},
+        code=['PlotCand.py', 'waterfaller_vg.py', 'filterbank_mmap.py'],
+        upstream=['frb_detector', 'ml'] if nogpu is not True else [],
+        outputs=['*.png'])
+    timer.count('plot', 'candidates', frb_cands.size)
+    timer.count('plot', 'plots', len(glob.glob("*.png")))
     # extractPlotCand_old(fil_file,frb_cands,noplot,fl,fh,tint,Ttot,kill_time_range,kill_chans,source_name,nchan,mask_file)
 
 
@@ -240,66 +317,60 @@ def heimdall_run(
         snr_cut,
         dorfi,
         kill_chan_range,
-        heimdall):
+        heimdall,
+        chunk_time=0,
+        nworkers=1,
+        fifo=None,
+        reducer=None):
 
     print("Running Heimdal with %f to %f DM range" % (lodm, hidm))
     # Test
     # os.system("heimdall -zap_chans 1775 1942 -f %s -dm_tol 1.01 -dm %f %f -boxcar_max %f -output_dir %s/  -v" % (fil_file,dmlo,dmhi,boxcar_max,base_name));
-    # Orig
-    if dorfi is True or manualzap:
-        zapchan = ""
-        # print kill_chan_range
-        for r in kill_chan_range:
-            zapchan = zapchan + " -zap_chans " + r
-        # After talking to AJ and SO and after much testing I found that
-        # 'rfi_no_narrow' works better.
-        cmd = "heimdall -f %s -rfi_tol 100 -dm_tol 1.001 -no_scrunching -dm_pulse_width 100 -rfi_no_narrow -rfi_no_broad -dm_nbits 32 -dm %f %f -boxcar_max %f -output_dir %s -v %s %s" % (
-            fil_file, dmlo, dmhi, boxcar_max, outdir, zapchan, heimdall)
+    # kill_chan_range has the rfifind and manual ranges and the channels
+    # without data, zapped in every run
+    zapchan = ""
+    for r in kill_chan_range:
+        zapchan = zapchan + " -zap_chans " + r
+    # After talking to AJ and SO and after much testing I found that
+    # 'rfi_no_narrow' works better.
+    heimdall_args = "-dm_tol 1.001 -no_scrunching -rfi_tol 100 -dm_pulse_width 100 -rfi_no_narrow -rfi_no_broad -dm_nbits 32 -dm %f %f -boxcar_max %f -v %s %s" % (
+        dmlo, dmhi, boxcar_max, zapchan, heimdall)
+
+    if chunk_time > 0:
+        # Long observations: overlapping time chunks, resumed after a crash
+        cand_file = heimdall_chunked(fil_file, heimdall_args, outdir, dmhi, boxcar_max,
+                                     chunk_time, nworkers)
+        if cand_file is None:
+            # Not recorded as done: the next run searches the failed chunks only
+            print("Heimdall failed on some chunks of %s, stopping" % (fil_file))
+            sys.exit(1)
+        return
+
+    if fifo:
+        # Read the data from the pipe while reduce_fil writes it, once:
+        # a failed run is done again on the reduced file.
+        cmd = "heimdall -f %s -output_dir %s %s" % (fifo, outdir, heimdall_args)
         print(cmd)
-        # os.system(cmd)
-        p = sb.Popen(cmd, stdout=sb.PIPE, shell=True)
-        out, err = p.communicate()
-        # Sometime the heimdall command fails with some Thrust memory error
-        # so running it again
-        if p.returncode != 0:
-            print("First try after failure")
-            p = sb.Popen(cmd, stdout=sb.PIPE, shell=True)
-            out, err = p.communicate()
-            if p.returncode != 0:
-                print("Second try after failure")
-                p = sb.Popen(cmd, stdout=sb.PIPE, shell=True)
-                out, err = p.communicate()
-                if p.returncode != 0:
-                    print("HEIMDALL_ERROR=" + str(p.returncode))
-                else:
-                    print("HEIMDALL_ERROR=0")
-            else:
-                print("HEIMDALL_ERROR=0")
-        else:
+        returncode = run_chunk(cmd, 1)
+        if returncode != 0:
+            # Heimdall may have exited before opening the pipe
+            reducer.close_fifo()
+        reducer.finish()
+        if reducer.error is not None:
+            # The reduced file is truncated, no rerun on it
+            print("HEIMDALL_ERROR=" + str(returncode or 1))
+            return
+        if returncode == 0:
             print("HEIMDALL_ERROR=0")
+            return
+        print("Heimdall failed on %s, running on %s" % (fifo, fil_file))
 
-    else:
-        # After talking to AJ and SO
-        cmd = "heimdall -f %s -dm_tol 1.001 -no_scrunching -rfi_tol 100 -dm_pulse_width 100   -rfi_no_narrow -rfi_no_broad -dm_nbits 32 -dm %f %f -boxcar_max %f -output_dir %s -v %s" % (
-            fil_file, dmlo, dmhi, boxcar_max, outdir, heimdall)
-        print(cmd)
-        # os.system(cmd);
-        p = sb.Popen(cmd, stdout=sb.PIPE, shell=True)
-        out, err = p.communicate()
-        if p.returncode != 0:
-            print("First try after failure")
-            p = sb.Popen(cmd, stdout=sb.PIPE, shell=True)
-            out, err = p.communicate()
-            if p.returncode != 0:
-                print("Second try after failure")
-                p = sb.Popen(cmd, stdout=sb.PIPE, shell=True)
-                out, err = p.communicate()
-                if p.returncode != 0:
-                    print("HEIMDALL_ERROR=" + str(p.returncode))
-                else:
-                    print("HEIMDALL_ERROR=0")
-        else:
-            print("HEIMDALL_ERROR=0")
+    cmd = "heimdall -f %s -output_dir %s %s" % (fil_file, outdir, heimdall_args)
+    print(cmd)
+    # Sometime the heimdall command fails with some Thrust memory error
+    # so running it again
+    returncode = run_chunk(cmd, 3)
+    print("HEIMDALL_ERROR=" + str(returncode))
     return
 
 
@@ -383,31 +454,21 @@ def PRESTOsp(
 
     if (len(cands)):
         if zerodm:
-            zdm = []
-            dupdms = np.array([dd.dupes_dms for dd in cands])
-            for i, d in enumerate(dupdms):
-                if (0.0 not in d):
-                    zdm.append(i)
-            cands = [cands[ii] for ii in zdm]
+            # Drop groups with a duplicate at DM 0
+            cands = cands[~cands.dupes_any('dm', 0.0)]
 
         sp.write_cands(fullfile, cands)
-        ndupes = np.array([dd.nhits for dd in cands])
+        ndupes = cands['nhits']
         # print 	dupes
-        yy = np.where((ndupes > 0) & (ndupes <= nhits_max))[0]
-        # print len(yy)
-        all_cands = [cands[ii] for ii in yy]
+        yy = (ndupes > 0) & (ndupes <= nhits_max)
+        all_cands = cands[yy]
         if len(all_cands):
             sp.write_cands(allfile, all_cands)
 
-        dms = np.array([dd.dm for dd in cands])
-        snrs = np.array([dd.sigma for dd in cands])
-        xx = np.where(
-            (ndupes > 0) & (
-                ndupes <= nhits_max) & (
-                dms >= dm_min) & (
-                dms <= dm_max) & (
-                    snrs >= snr_cut))[0]
-        gcands = [cands[ii] for ii in xx]
+        dms = cands['dm']
+        snrs = cands['sigma']
+        xx = yy & (dms >= dm_min) & (dms <= dm_max) & (snrs >= snr_cut)
+        gcands = cands[xx]
 
         print("%d good candidates" % len(gcands))
         if (len(gcands)):
@@ -423,29 +484,33 @@ def PRESTOsp(
 # def candplots_nogpu(fil_file,source_name,noplot,kill_chans,kill_time_range):
 
 
-def downsample(fil_file, inbits, inchans):
-
+def downsample(fil_file, inbits, inchans, fifo=None):
+    '''
+    8-bit (and for more than 8192 channels, 2-channel collapsed) copy of the
+    file with reduce_fil. With a fifo, the reduction runs in a thread that
+    also writes to the named pipe; the thread is returned with the name of
+    the reduced file (None without a fifo).
+    '''
     # basename = ".".join(fil_file.split(".")[:-1])
     basename = "downsampled"
-    # sum_fil="/home/obs/sw/bl_sigproc/src/sum_fil"
-    sum_fil = "/home/vgajjar/bl_sigproc/src/sum_fil"
     if (inbits > 8 and inchans < 8193):
         outf = basename + "_8bit.fil"
-        cmd = sum_fil + " %s -o %s -obits 8 -qlen 10000" % (fil_file, outf)
     if (inbits > 8 and inchans > 8192):
         outf = basename + "_8bit_2chan.fil"
-        cmd = sum_fil + \
-            "  %s -o %s -obits 8 -fcollapse 2 -qlen 10000" % (fil_file, outf)
     if (inbits < 9 and inchans > 8192):
         outf = basename + "_2chan.fil"
-        cmd = sum_fil + \
-            "  %s -o %s -obits 8  -fcollapse 2 -qlen 10000" % (fil_file, outf)
     if (inbits < 9 and inchans < 8193):
-        outf = fil_file
+        return fil_file, None
+    fcollapse = 2 if inchans > 8192 else 1
+    outf = os.path.abspath(outf)
 
-    print(cmd)
-    os.system(cmd)
-    return outf
+    print("Reducing %s to %s (8 bits, %d channels summed)" % (fil_file, outf, fcollapse))
+    if fifo:
+        if not os.path.exists(fifo):
+            os.mkfifo(fifo)
+        return outf, start_reduce(fil_file, outf, fcollapse, fifo=fifo)
+    reduce_fil(fil_file, outf, fcollapse)
+    return outf, None
 
 
 if __name__ == "__main__":
@@ -529,12 +594,14 @@ if __name__ == "__main__":
         "--negDM",
         action='store_true',
         dest='negdm',
-        help='Do all four types of negative search (Only works with SPANDAK; Default: Do not Run)')
+        help='Do all four types of negative search, on flipped views of the file with the CPU search; candidates in <base>_negdm.txt (Default: Do not Run)')
     parser.add_option(
         "--subBand",
-        action='store_true',
-        dest='negdm',
-        help='Do sub-band search search (Only works with SPANDAK; Default: Do not Run)')
+        action='store',
+        dest='subband',
+        default=0,
+        type=int,
+        help='Also search this many sub-bands with the CPU search; candidates in <base>_subbands.txt (Default: 0, do not Run)')
 
     parser.add_option(
         "--lodm",
@@ -594,6 +661,45 @@ if __name__ == "__main__":
         default=3.0,
         type=float,
         help="Post Heimdall: Number of required minimum memebers in a cluster for a real candidate (Default: 10.0)")
+    parser.add_option("--cpu", action='store_true', dest='cpu',
+                      help='Run the built-in CPU single pulse search instead of heimdall')
+    parser.add_option(
+        "--cpu_workers",
+        action='store',
+        dest='cpu_workers',
+        default=None,
+        type=int,
+        help="Number of processes of the CPU search (Default: all CPUs)")
+    parser.add_option("--follow", action='store_true', dest='follow',
+                      help='Search the file while it is being recorded, with the CPU search (Default: search the finished file)')
+    parser.add_option(
+        "--block_time",
+        action='store',
+        dest='block_time',
+        default=10.0,
+        type=float,
+        help="With --follow: length of a searched block in seconds (Default: 10)")
+    parser.add_option(
+        "--fifo",
+        action='store',
+        dest='fifo',
+        default="",
+        type=str,
+        help="Named pipe through which heimdall reads the 8-bit data while it is being reduced (Default: reduce first)")
+    parser.add_option(
+        "--chunk_time",
+        action='store',
+        dest='chunk_time',
+        default=0.0,
+        type=float,
+        help="Run Heimdall on chunks of this many seconds; finished chunks are not searched again (Default: 0, whole file)")
+    parser.add_option(
+        "--chunk_workers",
+        action='store',
+        dest='chunk_workers',
+        default=1,
+        type=int,
+        help="Number of Heimdall chunks searched at the same time (Default: 1)")
     parser.add_option("--noplot", action='store_true', dest='noplot',
                       help='Do not run plot candidates (Default: Run)')
     parser.add_option("--nogpu", action='store_true', dest='nogpu',
@@ -648,6 +754,27 @@ if __name__ == "__main__":
         action='store_true',
         dest='onlyA',
         help='When ML model is used, this option allows only plotting A category candidates as oppose to everything (default: plot everything). If ML model is not used, this option will have no effect as there will not be any A category candidates.')
+    parser.add_option(
+        "--ml_server",
+        action='store',
+        dest='ml_server',
+        type=str,
+        default="",
+        help="Socket of a server holding the loaded ML model (started by spandak_batch.py; Default: run predict.py)")
+    parser.add_option(
+        "--cand_db",
+        action='store',
+        dest='cand_db',
+        type=str,
+        default="",
+        help="SQLite candidate store the candidates are added to (see cand_store.py; Default: none)")
+    parser.add_option(
+        "--timing_log",
+        action='store',
+        dest='timing_log',
+        type=str,
+        default="",
+        help="Also append the timing report of the run (timing.json) to this file, shared by many runs (see stage_timer.py)")
 
     options, args = parser.parse_args()
 
@@ -668,20 +795,37 @@ if __name__ == "__main__":
         ml_model = options.model
     else:
         ml_model = ""
+    timing_log = os.path.abspath(options.timing_log) if options.timing_log else None
+    timer.name = fil_file
+
+    origf = obs_info(fil_file)
+    inchans = origf['nchans']
+    inbits = origf['nbits']
 
-    origf = FilReader(fil_file)
-    try:
-        inchans = origf.header['nchans']
-        inbits = origf.header['nbits']
-    except TypeError as e:
-        inchans = origf.header.nchans
-        inbits = origf.header.nbits
+    # Manifest of the stages of the run: a stage is skipped when run again
+    # if its inputs, parameters and code did not change
+    mandir = os.path.abspath(options.outdir or os.getcwd())
+    if not os.path.isdir(mandir):
+        os.makedirs(mandir)
+    cache = StageCache(os.path.join(mandir, os.path.basename(fil_file)[:-4] + ".manifest.json"), timer)
 
     # For 32-bit BL, downsample to 8-bit and create new file
-    if (nodsamp is not True):
+    reducer = None
+    fifo = None
+    orig_fil_file = fil_file
+    dsamp_params = {'inbits': inbits, 'inchans': inchans}
+    if (nodsamp is not True) and (options.follow is not True):
         if (inchans > 8192 or inbits > 8):
-            print("Running sum_fil")
-            fil_file = downsample(fil_file, inbits, inchans)
+            # Heimdall can read the reduced data from a pipe while it is written
+            if options.fifo and not (options.nosearch or options.dorfi or options.cpu or
+                                     options.nogpu or options.chunk_time > 0):
+                fifo = os.path.abspath(options.fifo)
+                with timer.stage('downsample'):
+                    fil_file, reducer = downsample(fil_file, inbits, inchans, fifo)
+            else:
+                fil_file = cache.run('downsample', lambda: downsample(fil_file, inbits, inchans)[0],
+                                     inputs=[fil_file], params=dsamp_params, code=['reduce_fil.py'],
+                                     outputs=lambda outf: [outf])
 
     fname = fil_file.split("/")[-1]
     print(fil_file)
@@ -724,19 +868,18 @@ if __name__ == "__main__":
     print("Output will go to %s" % (outdir))
     os.chdir(outdir)
 
-    f = FilReader(fil_file)
-    try:
-        nchan = f.header['nchans']
-        fch1 = f.header['fch1']
-        foff = f.header['foff']
-        tint = f.header['tsamp']
-        Ttot = f.header['tobs']
-    except TypeError as e:
-        nchan = f.header.nchans
-        fch1 = f.header.fch1
-        foff = f.header.foff
-        tint = f.header.tsamp
-        Ttot = f.header.tobs
+    # Header and channel statistics, saved in a sidecar for the other stages
+    if reducer is not None:
+        # Reduced file still being written
+        f = reduced_info(origf, 2 if inchans > 8192 else 1)
+    else:
+        with timer.stage('obsinfo'):
+            f = obs_info(fil_file, stats=options.follow is not True)
+    nchan = f['nchans']
+    fch1 = f['fch1']
+    foff = f['foff']
+    tint = f['tsamp']
+    Ttot = f['tobs']
 
     print("\n Nchan : " + str(nchan) +
           "\n High Freq (MHz) : " + str(fch1) +
@@ -748,48 +891,61 @@ if __name__ == "__main__":
     fl = fch1 + (foff * nchan)
 
     fname = fname[:-4]
-    hdr_file_name = fname + ".hdr"
-
-    # print fname,hdr_file_name
-# os.system("header {0} -source_name -tstart -tsamp -nchans > {1}.hdr".format(fil_file, fname))
-    os.system(
-        "/home/sonata/src/bl_sigproc/src/header {0} -source_name -tstart -tsamp -nchans > {1}.hdr".format(
-            fil_file,
-            fname))
-    hdr_file = open(hdr_file_name, "r")
-    hdr_data = hdr_file.readlines()
-    source_name = hdr_data[0].strip("\n")
-    if source_name == "":
-        source_name = fname.split(".")[0]
-    source_name = source_name.replace(" ", "_")
-    # source_name = "fake"
-    # print source_name
-
-    MJD = hdr_data[1].strip("\n").replace(".", "_")
-    MJDfloat = hdr_data[1].strip("\n")
-    if (len(MJD) - MJD.index("_") -
-            1) > 4:  # check to see if the MJD has more than 4 decimal places
-        MJD = MJD[:MJD.index("_") + 5]  # reduce the MJD to 4 decimal places
-    base_name = source_name + "_" + MJD
+    source_name, MJD, base_name = obs_base_name(f, fname.split(".")[0])
     outdir = outdir + "/" + base_name
     print("Output will go to %s" % (outdir))
     if (os.path.isdir(base_name) is not True):
         os.system("mkdir %s" % (base_name))
     basedir = os.getcwd() + "/" + base_name
     fil_file = os.path.abspath(fil_file)
-    os.system("mv %s.hdr %s/" % (fname, basedir))
     os.chdir(basedir)
+    # Written at the end of the run, also when it stops early
+    atexit.register(timer.write, os.path.join(basedir, "timing.json"), timing_log)
+
+    if options.follow:
+        # Search, classify and plot block by block while the file grows
+        with timer.stage('follow'):
+            valid = follow(
+                fil_file,
+                lodm,
+                hidm,
+                options.block_time,
+                snr_cut,
+                boxcar_max,
+                filter_cut,
+                minMem,
+                6.0,
+                options.cpu_workers,
+                base_name=base_name,
+                noplot=noplot)
+        timer.count('follow', 'candidates', valid.size)
+        sys.exit(0)
 
     if (dorfi is True):
         # SOF #EDIT
-        kill_chans, kill_chan_range, kill_time_range, mask_file = rfi(
-            fil_file, time, timesig, freqsig, chanfrac, intfrac, max_percent, mask, sp)
+        kill_chans, kill_chan_range, kill_time_range, mask_file = cache.run(
+            'rfifind', rfi,
+            (fil_file, time, timesig, freqsig, chanfrac, intfrac, max_percent, mask, sp),
+            inputs=[fil_file] + ([mask] if mask and os.path.isfile(str(mask)) else []),
+            params={'time': time, 'timesig': timesig, 'freqsig': freqsig, 'chanfrac': chanfrac,
+                    'intfrac': intfrac, 'max_percent': max_percent, 'mask': mask},
+            code=['rfi_filter_vg.py', 'rfi_quality_check_vg.py'],
+            upstream=['downsample'],
+            outputs=lambda r: [r[3]] if r and r[3] else [])
     else:
         kill_chans = []
         kill_chan_range = []
         kill_time_range = []
         mask_file = ""
 
+    # New list: the rfifind ranges are the result saved by the cache
+    extra_ranges = []
+    if 'zero_frac' in f:
+        # Channels without data are left out of the search
+        for chan in dead_channels(f):
+            extra_ranges.append("%d %d" % (chan, chan))
+        print("%d channels without data" % len(dead_channels(f)))
+
     if manualzap:
         sub_grps = [
             x.group() for x in re.finditer(
@@ -798,24 +954,94 @@ if __name__ == "__main__":
         # print sub_grps
         for zap in sub_grps:
             if ":" in zap:
-                kill_chan_range.append(
+                extra_ranges.append(
                     str(zap.split(":")[0] + " " + zap.split(":")[1]))
             else:
-                kill_chan_range.append(str(zap) + " " + str(zap))
+                extra_ranges.append(str(zap) + " " + str(zap))
+    kill_chan_range = list(kill_chan_range) + extra_ranges
 
     if (nogpu is not True):
-        if (nosearch is not True):
+        def search():
             # IF running heimdall then remove old candidates
             os.system("rm %s/*.cand" % (outdir))
-            heimdall_run(
-                fil_file,
-                lodm,
-                hidm,
-                outdir,
-                boxcar_max,
-                dorfi,
-                kill_chan_range,
-                heimdall)
+            zap_chans = []
+            for r in kill_chan_range:
+                zap_chans.extend(range(int(r.split()[0]), int(r.split()[1]) + 1))
+            if options.cpu:
+                cpu_search(
+                    fil_file,
+                    lodm,
+                    hidm,
+                    6.0,  # detection threshold of heimdall, snr_cut is applied later
+                    boxcar_max,
+                    options.cpu_workers,
+                    zap_chans=zap_chans,
+                    cand_file="%s/%s_all.cand" % (outdir, base_name),
+                    flips=FLIPS if negdm else None,
+                    flip_file="%s/%s_negdm.txt" % (outdir, base_name))
+            else:
+                heimdall_run(
+                    fil_file,
+                    lodm,
+                    hidm,
+                    outdir,
+                    boxcar_max,
+                    dorfi,
+                    kill_chan_range,
+                    heimdall,
+                    options.chunk_time,
+                    options.chunk_workers,
+                    fifo,
+                    reducer)
+                if negdm:
+                    # Flipped directions with the CPU search, heimdall reads files only
+                    cpu_search(
+                        fil_file,
+                        lodm,
+                        hidm,
+                        6.0,
+                        boxcar_max,
+                        options.cpu_workers,
+                        zap_chans=zap_chans,
+                        flips=FLIPS[1:],
+                        flip_file="%s/%s_negdm.txt" % (outdir, base_name))
+            if options.subband > 1:
+                subband_search(
+                    fil_file,
+                    lodm,
+                    hidm,
+                    options.subband,
+                    6.0,
+                    boxcar_max,
+                    options.cpu_workers,
+                    zap_chans=zap_chans,
+                    subband_file="%s/%s_subbands.txt" % (outdir, base_name))
+
+        search_stage = {'inputs': [fil_file],
+                        'params': {'lodm': lodm, 'hidm': hidm, 'boxcar_max': boxcar_max,
+                                   'kill_chan_range': kill_chan_range, 'heimdall': heimdall,
+                                   'cpu': options.cpu, 'chunk_time': options.chunk_time,
+                                   'negdm': negdm, 'subband': options.subband},
+                        'code': ['heimdall_chunks.py', 'cpu_search.py', 'dedisperse.py'],
+                        'upstream': ['downsample', 'rfifind'],
+                        'outputs': ["%s/*.cand" % (outdir), "%s/*_negdm.txt" % (outdir),
+                                    "%s/*_subbands.txt" % (outdir)]}
+        if (nosearch is not True) and reducer is not None:
+            # The reduced file was written while heimdall read the pipe
+            with timer.stage('search'):
+                search()
+                reducer.finish()
+            if reducer.error is not None:
+                print("Reduced file %s is incomplete: %s" % (fil_file, reducer.error))
+                sys.exit(1)
+            cache.record('downsample', cache.key('downsample', [orig_fil_file], dsamp_params,
+                                                 ['reduce_fil.py']), [fil_file], fil_file)
+            cache.record('search', cache.key('search', search_stage['inputs'], search_stage['params'],
+                                             search_stage['code'], search_stage['upstream']),
+                         search_stage['outputs'])
+        elif (nosearch is not True):
+            cache.run('search', search, **search_stage)
+        timer.count('search', 'candidates', count_lines(glob.glob("%s/*.cand" % (outdir))))
             # os.system("mv %s.* %s" % (base_name,base_name))
             # if(os.path.isfile("*.cand") is True):
 
@@ -844,20 +1070,26 @@ if __name__ == "__main__":
                 csv_file,
                 ml_model,
                 manualzap,
-                onlyA)
+                onlyA,
+                not options.cpu,
+                cache,
+                options.ml_server,
+                options.cand_db)
         else:
             print("No heimdall candidate found")
     else:
-        gcands = PRESTOsp(
-            fil_file,
-            lodm,
-            hidm,
-            outdir,
-            snr_cut,
-            zerodm,
-            mask_file,
-            base_name,
-            nosearch)
+        with timer.stage('search'):
+            gcands = PRESTOsp(
+                fil_file,
+                lodm,
+                hidm,
+                outdir,
+                snr_cut,
+                zerodm,
+                mask_file,
+                base_name,
+                nosearch)
+        timer.count('search', 'candidates', len(gcands))
         candplots(
             fil_file,
             source_name,
@@ -881,7 +1113,9 @@ if __name__ == "__main__":
             csv_file,
             ml_model,
             manualzap,
-            onlyA)
+            onlyA,
+            ml_server=options.ml_server,
+            cand_db=options.cand_db)
 
     if (email is True):
         pdffile = source_name + "_frb_cand.pdf"
@@ -889,7 +1123,7 @@ if __name__ == "__main__":
         # cmd = "convert *.ps %s" % (pdffile)
         pdffile = [pdffile]
         subject = "Broadband candidates from %s" % (base_name)
-        cmd = "mjd2cal %s" % (MJDfloat)
+        cmd = "mjd2cal %.12f" % (f['tstart'])
         p = sb.Popen([cmd], stdout=sb.PIPE, shell=True)
         mjdstr = [p.stdout.read()]
         msgtxt = "Broadband candidates found on %s" % (mjdstr[0])
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Fast reader of Heimdall candidate files.
+
+load_cands() parses the whitespace separated columns of a .cand (9
+columns) or coincidencer *_all.cand (14 columns) file in one pass of
+numpy's C reader and saves the structured array next to the text file, as
+<file>.npy, with the size and mtime (in ns) of the text file it was parsed
+from in <file>.npy.stat. Later readers map the .npy instead of parsing the
+text again, as long as the text file still has exactly that size and
+mtime.
+
+Example: python cand_io.py file_all.cand      (parse and cache)
+"""
+import os
+from argparse import ArgumentParser
+import numpy as np
+
+# Columns of a Heimdall .cand file
+CAND_NAMES = ('snr', 'samp_idx', 'time', 'filter', 'dm_trial', 'dm', 'members', 'begin', 'end')
+CAND_FORMATS = ('f4', 'i8', 'f8', 'i4', 'i4', 'f4', 'i4', 'i8', 'i8')
+# Columns of a coincidencer *_all.cand file
+ALL_CAND_NAMES = CAND_NAMES + ('nbeams', 'beam_mask', 'prim_beam', 'max_snr', 'beam')
+ALL_CAND_FORMATS = CAND_FORMATS + ('i4', 'i8', 'i4', 'f4', 'i4')
+
+
+def popcount(masks):
+    """Number of bits set of every (non negative) integer of masks"""
+    masks = np.asarray(masks).astype('uint64')
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(masks).astype(int)
+    masks = masks - ((masks >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    masks = (masks & np.uint64(0x3333333333333333)) + ((masks >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    masks = (masks + (masks >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return ((masks * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(int)
+
+
+def parse_cands(cand_file, dtype):
+    """Structured array (dtype) of the first columns of a text candidate file"""
+    dtype = np.dtype(dtype)
+    if os.path.getsize(cand_file) == 0:
+        return np.zeros(0, dtype=dtype)
+    # One float64 block parsed by numpy's C reader (integer columns may be
+    # written as floats), no per-value converters
+    values = np.loadtxt(cand_file, dtype='float64', ndmin=2, usecols=range(len(dtype.names)))
+    cands = np.zeros(values.shape[0], dtype=dtype)
+    for icol, name in enumerate(dtype.names):
+        cands[name] = values[:, icol]
+    return cands
+
+
+def file_stat(path):
+    """Size and mtime (in ns) of a file, as written in a .npy.stat file"""
+    st = os.stat(path)
+    return "%d %d" % (st.st_size, st.st_mtime_ns)
+
+
+def read_stat(stat_file):
+    """Content of a .npy.stat file, None if it can not be read"""
+    try:
+        with open(stat_file) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def load_cands(cand_file, names=ALL_CAND_NAMES, formats=ALL_CAND_FORMATS, cache=True):
+    """Candidates of a text candidate file, from the .npy cache when its
+        .npy.stat matches the size and mtime of the text file.
+
+        Input:
+            cand_file: .cand or *_all.cand file
+            names, formats: columns to read (Default: the 14 *_all.cand columns)
+            cache: read and write the <cand_file>.npy cache (and .npy.stat)
+
+        Output:
+            structured array (a read-only map of the cache when it is used)
+    """
+    dtype = np.dtype({'names': names, 'formats': formats})
+    npy = cand_file + ".npy"
+    stat_file = npy + ".stat"
+    # Stat of the text file before it is parsed: if it changes meanwhile,
+    # the cache is stale at the next read
+    stat = file_stat(cand_file)
+    if cache and os.path.isfile(npy) and read_stat(stat_file) == stat:
+        cands = np.load(npy, mmap_mode='r')
+        if cands.dtype == dtype:
+            return cands
+    cands = parse_cands(cand_file, dtype)
+    if cache:
+        try:
+            # No .stat while the .npy is replaced: never a stat of another .npy
+            if os.path.exists(stat_file):
+                os.remove(stat_file)
+            with open(npy + ".tmp", 'wb') as f:
+                np.save(f, cands)
+            os.rename(npy + ".tmp", npy)
+            with open(stat_file + ".tmp", 'w') as f:
+                f.write(stat + "\n")
+            os.rename(stat_file + ".tmp", stat_file)
+        except (IOError, OSError) as e:
+            print("Can not save %s: %s" % (npy, e))
+    return cands
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Parse candidate files and cache them as .npy")
+    parser.add_argument('cand_files', type=str, nargs='+', help="*_all.cand files")
+    parser.add_argument('--ncols', type=int, default=14, help="9 for Heimdall .cand files (Default: 14)")
+    args = parser.parse_args()
+
+    for cand_file in args.cand_files:
+        if args.ncols == 9:
+            cands = load_cands(cand_file, CAND_NAMES, CAND_FORMATS)
+        else:
+            cands = load_cands(cand_file)
+        print("%s: %d candidates" % (cand_file, cands.size))
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+"""
+SQLite store of the candidates of all observations.
+
+Every candidate is one row, keyed by its filterbank file, its time from the
+start of the file (in ms) and its DM (to 0.01): the stages of the pipeline
+add their columns to the same row (detection: SNR, width, MJD, ...; ML:
+prob; plot: category, t-test and plot file). The rows are written by one
+thread per process (StoreWriter), fed through a queue by the stages, in
+batched transactions; several pipelines may share one database (WAL
+journal, writers wait for the lock).
+
+The candidates are indexed on MJD, DM, SNR, source and category, for
+queries across observations:
+
+Example: python cand_store.py cands.db --dm 557 --dm_tol 5 --days 30
+         python cand_store.py cands.db --repeaters --min_bursts 2
+         python cand_store.py cands.db --ingest_csv cand.csv      (import a --logs CSV file)
+"""
+import os
+import re
+import time
+import sqlite3
+import threading
+from argparse import ArgumentParser
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import numpy as np
+
+# Columns of a candidate, the first three are its key
+COLUMNS = ('fil_file', 'time', 'dm', 'samp_idx', 'source', 'mjd', 'snr', 'width', 'filter', 'beam',
+           'prob', 'category', 'ttest', 'ttest_prob', 'png', 'ra', 'dec', 'fch1', 'nchans',
+           'bandwidth', 'updated')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS candidates (
+    id INTEGER PRIMARY KEY,
+    fil_file TEXT NOT NULL, time REAL NOT NULL, dm REAL NOT NULL,
+    samp_idx INTEGER, source TEXT, mjd REAL, snr REAL, width REAL, filter INTEGER, beam INTEGER,
+    prob REAL, category TEXT, ttest REAL, ttest_prob REAL, png TEXT, ra TEXT, dec TEXT,
+    fch1 REAL, nchans INTEGER, bandwidth REAL, updated REAL,
+    UNIQUE (fil_file, time, dm));
+CREATE INDEX IF NOT EXISTS cand_mjd ON candidates (mjd);
+CREATE INDEX IF NOT EXISTS cand_dm ON candidates (dm, mjd);
+CREATE INDEX IF NOT EXISTS cand_snr ON candidates (snr);
+CREATE INDEX IF NOT EXISTS cand_source ON candidates (source, mjd);
+CREATE INDEX IF NOT EXISTS cand_category ON candidates (category, mjd);
+"""
+
+# A stage only sets the columns it knows (None keeps the stored value)
+UPSERT = "INSERT INTO candidates (%s) VALUES (%s) ON CONFLICT (fil_file, time, dm) DO UPDATE SET %s" % (
+    ", ".join(COLUMNS), ", ".join("?"*len(COLUMNS)),
+    ", ".join("%s = COALESCE(excluded.%s, %s)" % (c, c, c) for c in COLUMNS[3:]))
+
+
+def connect(db_file):
+    """Connection to the store, created if needed"""
+    conn = sqlite3.connect(db_file, timeout=120)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def cand_row(fil_file, tsec, dm, **columns):
+    """Row of a candidate: time (sec from the start of the file) and DM
+        rounded as in the name of its plot, the other columns by name
+    """
+    row = dict.fromkeys(COLUMNS)
+    row.update(columns)
+    row['fil_file'] = os.path.abspath(fil_file)
+    row['time'] = round(float(tsec), 3)
+    row['dm'] = round(float(dm), 2)
+    row['updated'] = time.time()
+    return row
+
+
+def ingest(conn, rows):
+    """Write the rows in one transaction"""
+    with conn:
+        conn.executemany(UPSERT, [tuple(row[c] for c in COLUMNS) for row in rows])
+
+
+class StoreWriter(threading.Thread):
+    """The single writer of a process: rows put in its queue by the stages
+        are written in batches until close().
+    """
+    def __init__(self, db_file, batch_size=1000):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.nrows = 0
+        self.start()
+
+    def put(self, rows):
+        self.queue.put(list(rows))
+
+    def run(self):
+        conn = connect(self.db_file)
+        done = False
+        while not done:
+            batch = []
+            rows = self.queue.get()
+            while True:
+                if rows is None:
+                    done = True
+                    break
+                batch.extend(rows)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    rows = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    ingest(conn, batch)
+                    self.nrows += len(batch)
+                except sqlite3.Error as e:
+                    print("Can not store %d candidates in %s: %s" % (len(batch), self.db_file, e))
+        conn.close()
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+
+def frbcand_rows(frbcand_file, fil_file, header, source=None):
+    """Rows of the candidates of a FRBcand (or FRBcand_prob.txt) file:
+        snr time samp_idx dm filter prim_beam [prob]
+    """
+    rows = []
+    if not os.path.isfile(frbcand_file) or os.path.getsize(frbcand_file) == 0:
+        return rows
+    table = np.loadtxt(frbcand_file, ndmin=2)
+    tsamp = header['tsamp']
+    for cand in table:
+        samp_idx = int(cand[2])
+        rows.append(cand_row(fil_file, samp_idx*tsamp, cand[3], samp_idx=samp_idx,
+                             source=source or header.get('source_name'),
+                             mjd=header['tstart'] + samp_idx*tsamp/86400.0,
+                             snr=float(cand[0]), filter=int(cand[4]),
+                             width=tsamp*(2**int(cand[4]))*1e3, beam=int(cand[5]),
+                             prob=float(cand[6]) if cand.size > 6 else None,
+                             fch1=header.get('fch1'), nchans=header.get('nchans'),
+                             bandwidth=header.get('nchans', 0)*header.get('foff', 0)))
+    return rows
+
+
+def plot_row(fil_file, csv_row, tsec):
+    """Row of a plotted candidate, from its row of the --logs CSV file
+        (columns of waterfaller_vg.cand_csv_row) and its time tsec in sec
+    """
+    def value(name, cast=float):
+        v = csv_row.get(name)
+        if v is None or v == "*" or v == "":
+            return None
+        return cast(v)
+    # Category A, B or C (a plot without category is named after its index)
+    category = value('Category', str)
+    if category is not None and not category.isalpha():
+        category = None
+    return cand_row(fil_file, tsec, csv_row['DM'], source=value('SourceName', str),
+                    mjd=value('MJD') + tsec/86400.0 if value('MJD') is not None else None,
+                    snr=value('SNR'), width=value('WIDTH'), prob=value('Prob'),
+                    category=category, ttest=value('T-test'),
+                    ttest_prob=value('T-test_prob') if 'T-test_prob' in csv_row else value('T-test prob'),
+                    png=value('PNGFILE', str), ra=value('RA', str), dec=value('DEC', str),
+                    fch1=value('Hfreq'), nchans=value('NCHANS', lambda v: int(float(v))),
+                    bandwidth=value('BANDWIDTH'))
+
+
+def ingest_csv(conn, csv_file):
+    """Import the rows of a --logs CSV file, the time of every candidate
+        coming from the name of its plot
+    """
+    import csv
+    rows = []
+    with open(csv_file) as f:
+        for csv_row in csv.DictReader(f):
+            match = re.search(r"_([0-9.]+)sec_DM", csv_row['PNGFILE'])
+            if match is None:
+                continue
+            rows.append(plot_row(csv_row['filename'], csv_row, float(match.group(1))))
+    ingest(conn, rows)
+    return len(rows)
+
+
+def query(conn, dm=None, dm_tol=5.0, mjd_lo=None, mjd_hi=None, snr_min=None, source=None,
+          category=None, limit=None):
+    """Candidates within dm_tol of dm, between mjd_lo and mjd_hi, above
+        snr_min, of a source and a category (None: any), by MJD
+    """
+    where = []
+    args = []
+    if dm is not None:
+        where.append("dm BETWEEN ? AND ?")
+        args += [dm - dm_tol, dm + dm_tol]
+    for column, op, v in [('mjd', '>=', mjd_lo), ('mjd', '<=', mjd_hi), ('snr', '>=', snr_min),
+                          ('source', '=', source), ('category', '=', category)]:
+        if v is not None:
+            where.append("%s %s ?" % (column, op))
+            args.append(v)
+    sql = "SELECT * FROM candidates"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY mjd"
+    if limit:
+        sql += " LIMIT %d" % limit
+    return [dict(row) for row in conn.execute(sql, args)]
+
+
+def repeaters(conn, dm_tol=5.0, min_bursts=2, **cuts):
+    """Groups of candidates of a source within dm_tol of each other
+        (friends of friends in DM) seen in at least min_bursts observations.
+        cuts: as query()
+
+        Output:
+            list of dict: source, dm (of the brightest), nbursts, nobs,
+            first and last MJD, snr (brightest)
+    """
+    cands = query(conn, **cuts)
+    out = []
+    if not cands:
+        return out
+    source = np.array([c['source'] or "" for c in cands])
+    dm = np.array([c['dm'] for c in cands])
+    order = np.lexsort((dm, source))
+    source, dm = source[order], dm[order]
+    new = np.r_[True, (source[1:] != source[:-1]) | (np.diff(dm) > dm_tol)]
+    for group in np.split(order, np.flatnonzero(new)[1:]):
+        members = [cands[i] for i in group]
+        nobs = len(set(c['fil_file'] for c in members))
+        if nobs < min_bursts:
+            continue
+        brightest = max(members, key=lambda c: c['snr'] or 0)
+        mjds = [c['mjd'] for c in members if c['mjd'] is not None]
+        out.append({'source': brightest['source'], 'dm': brightest['dm'], 'nbursts': len(members),
+                    'nobs': nobs, 'first_mjd': min(mjds) if mjds else None,
+                    'last_mjd': max(mjds) if mjds else None, 'snr': brightest['snr']})
+    return out
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Query the candidate store")
+    parser.add_argument('db_file', type=str, help="SQLite candidate store")
+    parser.add_argument('--dm', type=float, default=None, help="DM of the candidates")
+    parser.add_argument('--dm_tol', type=float, default=5.0, help="DM tolerance (Default: 5)")
+    parser.add_argument('--days', type=float, default=None, help="Only the last days (Default: all)")
+    parser.add_argument('--snr_min', type=float, default=None, help="Lowest SNR")
+    parser.add_argument('--source', type=str, default=None, help="Source name")
+    parser.add_argument('--category', type=str, default=None, help="Plot category (A, B, C)")
+    parser.add_argument('--repeaters', action='store_true', help="Candidates seen in several observations")
+    parser.add_argument('--min_bursts', type=int, default=2, help="Observations of a repeater (Default: 2)")
+    parser.add_argument('--ingest_csv', type=str, nargs='+', default=[], help="Import --logs CSV files")
+    args = parser.parse_args()
+
+    conn = connect(args.db_file)
+    for csv_file in args.ingest_csv:
+        print("%s: %d candidates" % (csv_file, ingest_csv(conn, csv_file)))
+    if args.ingest_csv and args.dm is None and not args.repeaters:
+        raise SystemExit(0)
+    # MJD now
+    mjd_lo = time.time()/86400.0 + 40587.0 - args.days if args.days else None
+    cuts = {'mjd_lo': mjd_lo, 'snr_min': args.snr_min, 'source': args.source, 'category': args.category}
+    start = time.time()
+    if args.repeaters:
+        for rep in repeaters(conn, args.dm_tol, args.min_bursts, **cuts):
+            print("%(source)s\tDM %(dm).2f\t%(nbursts)d bursts in %(nobs)d observations\tMJD %(first_mjd)s to %(last_mjd)s\tSNR %(snr).1f" % rep)
+    else:
+        for c in query(conn, args.dm, args.dm_tol, **cuts):
+            print("%s\t%.6f\tDM %.2f\tSNR %s\t%s\t%s" % (c['source'], c['mjd'] or 0, c['dm'], c['snr'],
+                                                      c['category'] or "", c['png'] or c['fil_file']))
+    print("Query: %.1f ms" % ((time.time() - start)*1e3))
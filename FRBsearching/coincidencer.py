@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+Coincidencer of Heimdall candidates, in place of Heimdall's coincidencer
+binary.
+
+All the .cand files (one per gulp and beam, named <utc>_<beam>.cand) are
+loaded at once, and the candidates of all gulps and beams seen at the same
+time, DM trial and boxcar width are grouped friends-of-friends. Two
+candidates are friends when they are at most dm_tol DM trials and
+filter_tol boxcar filters apart, and closer in time than the wider of
+their boxcars plus time_tol samples. The candidates are hashed on a grid of
+(DM trial, filter) rows sorted in time. Binary searches give the range of
+the friends of every candidate in each neighbouring row; the candidate is
+linked to the first of them and the candidates of the range to each other:
+O(N log N).
+
+As Heimdall's coincidencer, every candidate is written to <utc>_all.cand
+(utc of the first file) with the 14 columns of the coincidencer: its own
+9 .cand columns, nbeams and beam_mask the beams its group was seen in,
+prim_beam and max_snr the (1-based) beam and the SNR of the brightest
+candidate of the group, and beam its own (1-based) beam.
+
+Example: python coincidencer.py *.cand
+"""
+import os
+import re
+import glob
+from argparse import ArgumentParser
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from cand_io import CAND_NAMES, CAND_FORMATS, ALL_CAND_NAMES, ALL_CAND_FORMATS, load_cands, popcount
+from cpu_search import write_all_cands
+
+
+def parse_cand_name(cand_file):
+    """utc and (1-based) beam of a Heimdall <utc>_<beam>.cand file name"""
+    name = os.path.basename(cand_file)
+    match = re.match(r"(.*)_(\d+)\.cand$", name)
+    if match is None:
+        return name[:-5], 1
+    return match.group(1), int(match.group(2))
+
+
+def load_cand_files(cand_files):
+    """Candidates of all the .cand files and the beam of every candidate"""
+    parts = []
+    beams = []
+    for cand_file in cand_files:
+        cands = load_cands(cand_file, CAND_NAMES, CAND_FORMATS, cache=False)
+        parts.append(cands)
+        beams.append(np.full(cands.size, parse_cand_name(cand_file)[1], dtype=int))
+    if not parts:
+        return np.zeros(0, dtype={'names': CAND_NAMES, 'formats': CAND_FORMATS}), np.zeros(0, dtype=int)
+    return np.concatenate(parts), np.concatenate(beams)
+
+
+def friends(cands, time_tol=0, dm_tol=3, filter_tol=2):
+    """Links of the candidates (see above), as two arrays of indices: two
+        candidates are friends if and only if they are connected by links
+    """
+    n = cands.size
+    samp = cands['samp_idx'].astype('int64')
+    idm = cands['dm_trial'].astype('int64')
+    filt = cands['filter'].astype('int64')
+    # Rows of the grid: one per DM trial and filter, padded so that the
+    # filter offsets never wrap to the next DM trial
+    nfilt = int(filt.max()) + 2*filter_tol + 1
+    row = idm*nfilt + filt + filter_tol
+    # Samples padded by the widest window: windows never reach another row
+    pad = (1 << (int(filt.max()) + filter_tol)) + time_tol
+    samp = samp - samp.min() + pad
+    span = np.int64(samp.max() + pad + 1)
+    order = np.lexsort((samp, row))
+    keys = row[order]*span + samp[order]
+    srow = row[order]
+    ssamp = samp[order]
+    sfilt = filt[order]
+    rows = []
+    cols = []
+    # chain[j] > 0: sorted candidates j and j+1 are in the window of a candidate
+    chain = np.zeros(n + 1, dtype='int64')
+    for ddm in range(0, dm_tol + 1):
+        for dfilt in range(-filter_tol, filter_tol + 1):
+            if ddm == 0 and dfilt < 0:
+                continue
+            target = (srow + ddm*nfilt + dfilt)*span + ssamp
+            width = np.left_shift(1, np.maximum(sfilt, sfilt + dfilt)) + time_tol
+            lo = np.searchsorted(keys, target - width, side='left')
+            hi = np.searchsorted(keys, target + width, side='right')
+            ok = hi > lo
+            rows.append(order[ok])
+            cols.append(order[lo[ok]])
+            np.add.at(chain, lo[ok], 1)
+            np.add.at(chain, hi[ok] - 1, -1)
+    linked = np.flatnonzero(np.cumsum(chain)[:n - 1] > 0)
+    rows.append(order[linked])
+    cols.append(order[linked + 1])
+    return np.concatenate(rows), np.concatenate(cols)
+
+
+def groups(cands, time_tol=0, dm_tol=3, filter_tol=2):
+    """Number of friends-of-friends groups and group of every candidate"""
+    rows, cols = friends(cands, time_tol, dm_tol, filter_tol)
+    graph = coo_matrix((np.ones(rows.size), (rows, cols)), shape=(cands.size, cands.size))
+    return connected_components(graph, directed=False)
+
+
+def coincide(cands, beams, time_tol=0, dm_tol=3, filter_tol=2):
+    """Coincidence of the candidates of all beams.
+
+        Input:
+            cands: candidates (CAND_NAMES, or more columns)
+            beams: (1-based) beam of every candidate
+            time_tol, dm_tol, filter_tol: friends tolerances (see above)
+
+        Output:
+            every candidate (ALL_CAND_NAMES) with the beams of its group,
+            sorted by sample
+    """
+    out = np.zeros(cands.size, dtype={'names': ALL_CAND_NAMES, 'formats': ALL_CAND_FORMATS})
+    if cands.size == 0:
+        return out
+    ngroup, group = groups(cands, time_tol, dm_tol, filter_tol)
+
+    # Brightest candidate of every group
+    order = np.lexsort((-cands['snr'], group))
+    best = order[np.r_[True, np.diff(group[order]) != 0]]
+    mask = np.zeros(ngroup, dtype='int64')
+    np.bitwise_or.at(mask, group, np.left_shift(1, beams - 1))
+    for name in CAND_NAMES:
+        out[name] = cands[name]
+    out['beam_mask'] = mask[group]
+    out['nbeams'] = popcount(mask)[group]
+    out['prim_beam'] = beams[best][group]
+    out['max_snr'] = cands['snr'][best][group]
+    out['beam'] = beams
+    return out[np.argsort(out['samp_idx'], kind='stable')]
+
+
+def coincidencer(cand_files, outdir=None, time_tol=0, dm_tol=3, filter_tol=2):
+    """Coincidencer of the .cand files: write <utc>_all.cand in outdir
+        (Default: the directory of the first file).
+
+        Output:
+            name of the *_all.cand file, None if there is no .cand file
+    """
+    cand_files = sorted(f for f in cand_files if not f.endswith("_all.cand"))
+    if not cand_files:
+        print("No .cand file")
+        return None
+    cands, beams = load_cand_files(cand_files)
+    out = coincide(cands, beams, time_tol, dm_tol, filter_tol)
+    if outdir is None:
+        outdir = os.path.dirname(cand_files[0])
+    all_cand_file = os.path.join(outdir, parse_cand_name(cand_files[0])[0] + "_all.cand")
+    write_all_cands(all_cand_file, out)
+    print("%d candidates of %d files: %s" % (cands.size, len(cand_files), all_cand_file))
+    return all_cand_file
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Coincidence of the candidates of Heimdall .cand files in a *_all.cand file")
+    parser.add_argument('cand_files', type=str, nargs='*', help=".cand files (Default: *.cand)")
+    parser.add_argument('--time_tol', type=int, default=0, help="Time tolerance in samples, on top of the boxcar width (Default: 0)")
+    parser.add_argument('--dm_tol', type=int, default=3, help="DM tolerance in DM trials (Default: 3)")
+    parser.add_argument('--filter_tol', type=int, default=2, help="Boxcar filter tolerance (Default: 2)")
+    parser.add_argument('--outdir', type=str, default=None, help="Output directory (Default: that of the .cand files)")
+    args = parser.parse_args()
+
+    coincidencer(args.cand_files or glob.glob("*.cand"), args.outdir, args.time_tol, args.dm_tol,
+                 args.filter_tol)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+"""
+Single pulse search on the CPU, for nodes without a GPU to run Heimdall.
+
+The file is dedispersed in time chunks over a Heimdall-like DM plan with a
+pool of processes (each process dedisperses a chunk for a range of DMs),
+the time series are matched filtered with boxcars of 1, 2, 4, ...,
+boxcar_max samples using cumulative sums, and the samples above the SNR
+threshold are grouped into candidates (neighbouring DM trials and samples).
+The candidates are written in the 14 column format of coincidencer's
+*_all.cand files, read by frb_detector_bl.py.
+
+For the negative DM searches the file can also be searched reversed in
+time, in frequency or both (FLIPS of filterbank_mmap.py) in the same pool,
+reading flipped views of the file instead of flipped copies. The
+candidates of all the directions are merged in one table with a flip
+column (times are those of the flipped data).
+
+Example: python cpu_search.py file.fil --lodm 100 --hidm 2000 -o out_all.cand
+"""
+import os
+from argparse import ArgumentParser
+from multiprocessing import Pool
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from filterbank_mmap import FilterbankMmap, FLIPS
+from dedisperse import delay_table, dedisperse
+from cand_io import ALL_CAND_NAMES, ALL_CAND_FORMATS
+
+# Candidates of several search directions
+FLIP_CAND_NAMES = ALL_CAND_NAMES + ('flip',)
+FLIP_CAND_FORMATS = ALL_CAND_FORMATS + ('U4',)
+
+
+def dm_plan(dmlo, dmhi, freqs, tsamp, pulse_width=40.0, tol=1.25):
+    """DM trials from dmlo to dmhi, spaced as in dedisp/Heimdall so that the
+        smearing between trials grows by at most a factor tol.
+
+        Input:
+            freqs: channel frequencies (MHz)
+            tsamp: sampling time (s)
+            pulse_width: expected intrinsic pulse width (us)
+    """
+    nchans = len(freqs)
+    df = abs(freqs[1] - freqs[0])
+    dt = tsamp*1e6
+    f = (np.max(freqs) - ((nchans/2) - 0.5)*df)*1e-3
+    tol2 = tol*tol
+    a = 8.3*df/(f*f*f)
+    a2 = a*a
+    b2 = a2*(nchans*nchans/16.0)
+    c = (dt*dt + pulse_width*pulse_width)*(tol2 - 1.0)
+    dms = [float(dmlo)]
+    while dms[-1] < dmhi:
+        prev = dms[-1]
+        prev2 = prev*prev
+        k = c + tol2*a2*prev2
+        dms.append((b2*prev + np.sqrt(-a2*b2*prev2 + (a2+b2)*k))/(a2+b2))
+    return np.array(dms)
+
+
+def boxcar_widths(boxcar_max):
+    """Boxcar widths 1, 2, 4, ... up to boxcar_max samples (filter = log2(width))"""
+    return [1 << i for i in range(int(np.log2(max(boxcar_max, 1))) + 1)]
+
+
+def normalise(ts):
+    """Remove the median and scale by the robust (MAD) rms of every row"""
+    med = np.median(ts, axis=1, keepdims=True)
+    ts = ts - med
+    rms = 1.4826*np.median(np.abs(ts), axis=1, keepdims=True)
+    rms[rms == 0] = 1.0
+    return ts/rms
+
+
+def boxcar_snr(ts, widths, nout):
+    """Best boxcar SNR (and its filter) of windows starting at the first nout
+        samples of the normalised time series ts (ndm, nsamp)
+    """
+    cs = np.zeros((ts.shape[0], ts.shape[1]+1), dtype='float64')
+    np.cumsum(ts, axis=1, out=cs[:, 1:])
+    best = np.full((ts.shape[0], nout), -np.inf, dtype='float32')
+    best_filter = np.zeros((ts.shape[0], nout), dtype='int8')
+    for ifilter, w in enumerate(widths):
+        snr = (cs[:, w:w+nout] - cs[:, :nout])/np.sqrt(w)
+        better = snr > best
+        best[better] = snr[better]
+        best_filter[better] = ifilter
+    return best, best_filter
+
+
+# State of a search worker: the opened filterbank file
+_search_state = {}
+
+
+def _search_init(fil_file, zap_chans):
+    fil = FilterbankMmap(fil_file)
+    _search_state['fil'] = fil
+    _search_state['views'] = dict((flip, fil.flipped(flip)) for flip in FLIPS)
+    _search_state['weights'] = None
+    if zap_chans:
+        weights = np.ones(fil.nchans, dtype='float32')
+        weights[list(zap_chans)] = 0
+        _search_state['weights'] = weights
+
+
+def search_block(fil, start, nown, delays, widths, snr_cut, weights=None, chans=None):
+    """Dedisperse and filter nown samples from start for the DM trials of
+        delays. The block read from fil also holds the sweep and the widest
+        boxcar after the last sample. Only the channels chans[0]:chans[1]
+        are searched if given. Returns the samples above the threshold
+        as rows of (samp, dm_idx, filter, snr), dm_idx counted in delays.
+    """
+    maxw = widths[-1]
+    nout = nown + maxw
+    block = fil.get_block(start, nout + int(delays.max()))
+    if chans is not None:
+        # A view of the channels of the sub-band
+        block = block[chans[0]:chans[1]]
+    nsamp = block.shape[1]
+    if nsamp < nout + int(delays.max()):
+        # End of the file
+        nout = nsamp - int(delays.max())
+        nown = min(nown, nout - maxw)
+        if nown <= 0:
+            return np.zeros((0, 4))
+    data = np.asarray(block, dtype='float32')
+    data = data - np.median(data, axis=1, keepdims=True)
+    ts = normalise(dedisperse(data, delays, nout, weights))
+    best, best_filter = boxcar_snr(ts, widths, nown)
+    idm, isamp = np.nonzero(best >= snr_cut)
+    filt = best_filter[idm, isamp]
+    # Report the centre of the boxcar
+    samp = start + isamp + (np.array(widths)[filt] // 2)
+    return np.column_stack([samp, idm, filt, best[idm, isamp]])
+
+
+def _search_task(task):
+    """Search one time chunk for a range of DM trials, in the direction flip,
+        in the channels chans (None for all)
+    """
+    start, nown, idm0, delays, widths, snr_cut, flip, chans = task
+    fil = _search_state['views'][flip]
+    if fil.nspec < start + nown + widths[-1] + int(delays.max()):
+        # The file may have grown since it was opened
+        fil.refresh()
+    weights = _search_state['weights']
+    if weights is not None and 'nF' in flip:
+        # Zapped channels are numbered in the file
+        weights = weights[::-1]
+    if weights is not None and chans is not None:
+        weights = weights[chans[0]:chans[1]]
+    points = search_block(fil, start, nown, delays, widths, snr_cut, weights, chans)
+    points[:, 1] += idm0
+    return points
+
+
+def group_points(samp, idm, snr, filt):
+    """Candidates from the samples above threshold: points on neighbouring
+        DM trials and samples (boxcars overlapping in time) are one candidate.
+
+        Output:
+            labels of the points and number of candidates
+    """
+    n = samp.size
+    if n == 0:
+        return np.zeros(0, dtype=int), 0
+    order = np.lexsort((samp, idm))
+    key_samp = samp[order]
+    key_dm = idm[order]
+    rows = []
+    cols = []
+    # Same DM trial: boxcars overlapping in time
+    same = (np.diff(key_dm) == 0) & (np.diff(key_samp) <= (1 << filt[order][:-1]))
+    rows.append(order[:-1][same])
+    cols.append(order[1:][same])
+    # Next DM trial: nearest point in time within the boxcar width
+    span = np.int64(samp.max() + (1 << int(filt.max())) + 2)
+    keys = key_dm.astype('int64')*span + key_samp
+    pos = np.searchsorted(keys, (key_dm.astype('int64') + 1)*span + key_samp)
+    for cand in [pos - 1, pos]:
+        ok = (cand >= 0) & (cand < n)
+        cand = np.clip(cand, 0, n-1)
+        near = ok & (key_dm[cand] == key_dm + 1) & \
+            (np.abs(key_samp[cand] - key_samp) <= np.maximum(1 << filt[order], 1 << filt[order][cand]))
+        rows.append(order[near])
+        cols.append(order[cand[near]])
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    graph = coo_matrix((np.ones(rows.size), (rows, cols)), shape=(n, n))
+    ncand, labels = connected_components(graph, directed=False)
+    return labels, ncand
+
+
+def make_cands(points, dms, tsamp, return_labels=False):
+    """14 column candidates of the grouped points. With return_labels, also
+        return the index in the candidates of every point.
+    """
+    dtype = {'names': ALL_CAND_NAMES, 'formats': ALL_CAND_FORMATS}
+    if points.shape[0] == 0:
+        if return_labels:
+            return np.zeros(0, dtype=dtype), np.zeros(0, dtype=int)
+        return np.zeros(0, dtype=dtype)
+    samp = points[:, 0].astype('int64')
+    idm = points[:, 1].astype('int64')
+    filt = points[:, 2].astype('int64')
+    snr = points[:, 3]
+    labels, ncand = group_points(samp, idm, snr, filt)
+    # Brightest point of every candidate
+    order = np.lexsort((-snr, labels))
+    first = order[np.r_[True, np.diff(labels[order]) != 0]]
+    cands = np.zeros(ncand, dtype=dtype)
+    best = np.empty(ncand, dtype=int)
+    best[labels[first]] = first
+    cands['snr'] = snr[best]
+    cands['samp_idx'] = samp[best]
+    cands['time'] = samp[best]*tsamp
+    cands['filter'] = filt[best]
+    cands['dm_trial'] = idm[best]
+    cands['dm'] = dms[idm[best]]
+    cands['members'] = np.bincount(labels, minlength=ncand)
+    begin = np.full(ncand, np.iinfo('int64').max)
+    end = np.full(ncand, np.iinfo('int64').min)
+    np.minimum.at(begin, labels, samp)
+    np.maximum.at(end, labels, samp)
+    cands['begin'] = begin
+    cands['end'] = end
+    # Single beam
+    cands['nbeams'] = 1
+    cands['beam_mask'] = 1
+    cands['prim_beam'] = 1
+    cands['max_snr'] = cands['snr']
+    cands['beam'] = 1
+    order = np.argsort(cands['samp_idx'], kind='stable')
+    if return_labels:
+        rank = np.empty(ncand, dtype=int)
+        rank[order] = np.arange(ncand)
+        return cands[order], rank[labels]
+    return cands[order]
+
+
+def write_all_cands(cand_file, cands, mode='w'):
+    with open(cand_file, mode) as f:
+        for c in cands:
+            f.write("%g\t%d\t%.6f\t%d\t%d\t%g\t%d\t%d\t%d\t%d\t%d\t%d\t%g\t%d\n" % tuple(c[n] for n in ALL_CAND_NAMES))
+
+
+def merge_flips(cands_of_flip):
+    """One table (FLIP_CAND_NAMES) of the candidates of every direction"""
+    tables = []
+    for flip in FLIPS:
+        if flip in cands_of_flip:
+            cands = cands_of_flip[flip]
+            table = np.zeros(cands.size, dtype={'names': FLIP_CAND_NAMES, 'formats': FLIP_CAND_FORMATS})
+            for name in ALL_CAND_NAMES:
+                table[name] = cands[name]
+            table['flip'] = flip
+            tables.append(table)
+    return np.concatenate(tables)
+
+
+def write_flip_cands(cand_file, cands):
+    """Write a merged table: the 14 *_all.cand columns plus the flip"""
+    with open(cand_file, 'w') as f:
+        for c in cands:
+            f.write("%g\t%d\t%.6f\t%d\t%d\t%g\t%d\t%d\t%d\t%d\t%d\t%d\t%g\t%d\t%s\n" % tuple(c[n] for n in FLIP_CAND_NAMES))
+
+
+def cpu_search(fil_file, dmlo, dmhi, snr_cut=6.0, boxcar_max=4096, nproc=None,
+               chunk_nsamp=32768, ndm_per_task=64, zap_chans=None, cand_file=None,
+               pulse_width=40.0, dm_tol=1.25, flips=None, flip_file=None):
+    """Search fil_file for single pulses from dmlo to dmhi.
+
+        Input:
+            snr_cut: SNR threshold of a detection
+            boxcar_max: widest boxcar (samples)
+            nproc: number of processes (Default: number of CPUs)
+            chunk_nsamp: samples searched by a task
+            ndm_per_task: DM trials dedispersed by a task
+            zap_chans: channels to leave out
+            cand_file: write the candidates to this *_all.cand file
+            flips: search these directions of the file (see FLIPS)
+            flip_file: write the merged candidates of the flips to this file
+                (cand_file then gets the candidates of 'none')
+
+        Output:
+            structured array of the candidates (ALL_CAND_NAMES), or with
+            flips, the merged candidates (FLIP_CAND_NAMES)
+    """
+    fil = FilterbankMmap(fil_file)
+    dms = dm_plan(dmlo, dmhi, fil.freqs, fil.tsamp, pulse_width, dm_tol)
+    delays = delay_table(fil.freqs, fil.tsamp, dms)
+    widths = boxcar_widths(boxcar_max)
+    nproc = nproc or os.cpu_count() or 1
+    print("CPU search of %s: %d DM trials from %.2f to %.2f, %d boxcars, %d processes"
+          % (fil_file, dms.size, dms[0], dms[-1], len(widths), nproc))
+
+    search_flips = flips or ['none']
+    tasks = []
+    for flip in search_flips:
+        for start in range(0, fil.nspec, chunk_nsamp):
+            for idm0 in range(0, dms.size, ndm_per_task):
+                tasks.append((start, chunk_nsamp, idm0, delays[idm0:idm0+ndm_per_task], widths,
+                              snr_cut, flip, None))
+    pool = Pool(max(1, min(nproc, len(tasks))), initializer=_search_init,
+                initargs=(fil_file, zap_chans))
+    try:
+        points = pool.map(_search_task, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    cands_of_flip = {}
+    for flip in search_flips:
+        flip_points = [p for p, task in zip(points, tasks) if task[6] == flip]
+        flip_points = np.concatenate(flip_points) if flip_points else np.zeros((0, 4))
+        cands_of_flip[flip] = make_cands(flip_points, dms, fil.tsamp)
+        print("%s: %d candidates from %d samples above SNR %.1f"
+              % (flip, cands_of_flip[flip].size, flip_points.shape[0], snr_cut))
+    if cand_file and 'none' in cands_of_flip:
+        write_all_cands(cand_file, cands_of_flip['none'])
+    if flips is None:
+        return cands_of_flip['none']
+    cands = merge_flips(cands_of_flip)
+    if flip_file:
+        write_flip_cands(flip_file, cands)
+    return cands
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Single pulse search on the CPU")
+    parser.add_argument('fil_file', type=str, help="Filterbank file")
+    parser.add_argument('--lodm', type=float, default=100.0, help="Lowest DM (Default: 100)")
+    parser.add_argument('--hidm', type=float, default=2000.0, help="Highest DM (Default: 2000)")
+    parser.add_argument('--snr_cut', type=float, default=6.0, help="SNR threshold (Default: 6)")
+    parser.add_argument('--boxcar_max', type=int, default=4096, help="Widest boxcar in samples (Default: 4096)")
+    parser.add_argument('--nproc', type=int, default=None, help="Number of processes (Default: all CPUs)")
+    parser.add_argument('--dm_tol', type=float, default=1.25, help="DM plan tolerance (Default: 1.25)")
+    parser.add_argument('-o', dest='cand_file', type=str, default="", help="Output *_all.cand file")
+    parser.add_argument('--negDM', action='store_true',
+                        help="Also search the file flipped in time, frequency and both (written to *_negdm.txt)")
+    args = parser.parse_args()
+
+    cand_file = args.cand_file or os.path.basename(args.fil_file)[:-4] + "_all.cand"
+    cpu_search(args.fil_file, args.lodm, args.hidm, args.snr_cut, args.boxcar_max, args.nproc,
+               cand_file=cand_file, dm_tol=args.dm_tol, flips=FLIPS if args.negDM else None,
+               flip_file=os.path.basename(args.fil_file)[:-4] + "_negdm.txt")
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Brute-force incoherent dedispersion with numpy, and DM-vs-time arrays of
+dedispersed blocks.
+
+Delays are relative to the highest frequency, as in Heimdall and presto,
+so the dedispersed time series give the arrival time at the top of the band.
+"""
+import numpy as np
+
+KDM = 4148.808  # MHz^2 / (pc cm^-3)
+
+
+def delay_table(freqs, tsamp, dms, ref_freq=None):
+    """Delays in samples of every channel for every DM.
+
+        Input:
+            freqs: channel frequencies (MHz)
+            tsamp: sampling time (s)
+            dms: DM trials
+            ref_freq: frequency of zero delay (Default: highest frequency)
+
+        Output:
+            (ndm, nchan) int array of delays
+    """
+    freqs = np.asarray(freqs, dtype=float)
+    if ref_freq is None:
+        ref_freq = freqs.max()
+    dms = np.atleast_1d(np.asarray(dms, dtype=float))
+    delays = KDM*dms[:, np.newaxis]*(freqs**-2 - ref_freq**-2)[np.newaxis, :]/tsamp
+    return np.round(delays).astype('int64')
+
+
+def dedisperse(block, delays, nout=None, weights=None):
+    """Dedisperse a (nchan, nsamp) block for the DMs of a delay table.
+
+        Input:
+            block: (nchan, nsamp) data
+            delays: (ndm, nchan) delays in samples (delay_table)
+            nout: number of output samples (Default: as many as the block
+                  holds for the largest delay)
+            weights: weight of each channel, 0 to zap it (Default: all 1)
+
+        Output:
+            (ndm, nout) float32 dedispersed time series
+    """
+    nchan, nsamp = block.shape
+    delays = np.atleast_2d(delays)
+    if nout is None:
+        nout = nsamp - int(delays.max())
+    if nout <= 0 or int(delays.max()) + nout > nsamp:
+        raise ValueError("Block of %d samples too short for %d output samples and a %d sample delay"
+                         % (nsamp, nout, int(delays.max())))
+    out = np.zeros((delays.shape[0], nout), dtype='float32')
+    idx = np.arange(nout)
+    for ichan in range(nchan):
+        if weights is not None and weights[ichan] == 0:
+            continue
+        chan = np.asarray(block[ichan], dtype='float32')
+        if weights is not None and weights[ichan] != 1:
+            chan = chan*np.float32(weights[ichan])
+        shifts = delays[:, ichan]
+        if np.all(shifts == shifts[0]):
+            out += chan[shifts[0]:shifts[0]+nout]
+        else:
+            out += chan[shifts[:, np.newaxis] + idx[np.newaxis, :]]
+    return out
+
+
+
+def dm_time(block, freqs, tsamp, ddms, nout=None, max_elems=1 << 24):
+    """DM-vs-time ("bowtie") array of a (nchan, nsamp) block dedispersed to
+        some DM, for the DM offsets ddms from it: every channel rotated by
+        its delay (as presto's Spectra.dedisperse(padval='rotate')) and
+        summed, without changing the block.
+
+        The sweeps of the offsets are rows of the FDMT (fdmt.Fdmt) of the
+        block, the negative offsets being the positive sweeps of the block
+        reversed in time: O(nsamp*(maxdt + nchan)*log2(nchan)) for the
+        largest sweep of maxdt samples, whatever the number of DMs. Sweeps
+        are rounded to whole samples.
+
+        Input:
+            block: (nchan, nsamp) data
+            freqs: channel frequencies (MHz)
+            tsamp: sampling time (s)
+            ddms: DM offsets, may be negative
+            nout: number of output samples (Default: nsamp)
+            max_elems: largest number of values of a level of the FDMT
+
+        Output:
+            (ndm, nout) float32 array
+    """
+    from fdmt import Fdmt
+    block = np.asarray(block, dtype='float32')
+    nchan, nsamp = block.shape
+    freqs = np.asarray(freqs, dtype=float)
+    ddms = np.atleast_1d(np.asarray(ddms, dtype=float))
+    if nout is None:
+        nout = nsamp
+    out = np.zeros((ddms.size, nout), dtype='float32')
+    if nchan < 2 or freqs.min() == freqs.max():
+        out[:] = block.sum(axis=0)[:nout]
+        return out
+    # Sweep in samples of every offset across the band
+    sweeps = np.round(KDM*np.abs(ddms)*(freqs.min()**-2 - freqs.max()**-2)/tsamp).astype('int64')
+    for sel, backwards in [(ddms >= 0, False), (ddms < 0, True)]:
+        if not sel.any():
+            continue
+        data = block[:, ::-1] if backwards else block
+        maxdt = int(sweeps[sel].max())
+        # Rotations: the block repeated over the sweep
+        ext = np.tile(data, (1, (nsamp + maxdt - 1)//nsamp + 1))[:, :nsamp + maxdt]
+        rows = Fdmt(freqs, maxdt).transform(ext, nsamp, max_elems=max_elems, rows=sweeps[sel])
+        out[sel] = rows[:, ::-1][:, :nout] if backwards else rows[:, :nout]
+    return out
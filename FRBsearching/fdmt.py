@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+Fast dispersion measure transform (FDMT, Zackay & Ofek 2017) of
+(nchan, nsamp) blocks with numpy.
+
+The transform dedisperses a block for all the sweeps of 0 to maxdt samples
+across the band at once. Every channel starts as a sub-band of one curve;
+adjacent sub-bands are merged pairwise log2(nchan) times, a curve of the
+merged sub-band being the sum of one curve of the upper half and one curve
+of the lower half shifted by the delay between the tops of the two halves.
+A level costs O(nsamp*(maxdt + nchan)): O(nsamp*nchan*log2(nchan)) in all
+for maxdt ~ nchan, instead of O(nsamp*nchan*ndm) for the brute force
+dedisperse.dedisperse. The delays are rounded at every merge, so a channel
+may be off its exact delay by up to about half a sample per level.
+
+As dedisperse.py, delays are relative to the highest frequency: row d is
+the time series of the arrival times at the top of the band for a sweep of
+d samples (DM Fdmt.dms(tsamp)[d]), and the last maxdt samples of a block
+only feed the sweeps of the earlier samples. Long blocks are transformed
+in chunks of bounded memory and a file is streamed in blocks overlapping
+by maxdt samples (Fdmt.blocks).
+
+Example: python fdmt.py file.fil --hidm 1000 --start 10 --duration 2
+"""
+from argparse import ArgumentParser
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from dedisperse import KDM
+
+
+def maxdt_of_dm(freqs, tsamp, dm):
+    """Sweep in samples of dm across the band (rounded up)"""
+    freqs = np.asarray(freqs, dtype=float)
+    return int(np.ceil(KDM*dm*(freqs.min()**-2 - freqs.max()**-2)/tsamp))
+
+
+class Fdmt(object):
+    """FDMT plan of a band (channel frequencies freqs, in any order) for
+        the sweeps of 0 to maxdt samples across it, shared by all the blocks
+        transformed.
+    """
+    def __init__(self, freqs, maxdt):
+        freqs = np.asarray(freqs, dtype=float)
+        if freqs.size < 2 or freqs.min() == freqs.max():
+            raise ValueError("FDMT needs at least two channel frequencies")
+        self.freqs = freqs
+        self.maxdt = int(maxdt)
+        # Channels from the top of the band
+        self.order = np.argsort(-freqs, kind='stable')
+        ff = freqs[self.order]**-2
+        span = ff[-1] - ff[0]
+
+        def ndt(top, bot):
+            """Curves of a sub-band of channels top to bot"""
+            if top == bot:
+                return 1
+            if bot == ff.size - 1 and top == 0:
+                return self.maxdt + 1
+            return int(np.ceil(self.maxdt*(ff[bot] - ff[top])/span)) + 2
+
+        # Sub-bands (first channel, last channel) of every level, and the
+        # merges of every level: (upper, lower, dt of the upper, shift of
+        # the lower, dt of the lower) for every curve of the merged sub-band
+        bands = [(ichan, ichan) for ichan in range(ff.size)]
+        self.levels = []
+        self.nrows = ff.size
+        while len(bands) > 1:
+            merges = []
+            merged = []
+            for iband in range(0, len(bands) - 1, 2):
+                top, ubot = bands[iband]
+                ltop, bot = bands[iband + 1]
+                dt = np.arange(ndt(top, bot))
+                rm = ff[bot] - ff[top]
+                # Delays of the bottom of the upper half and of the top of
+                # the lower half: no channel is delayed by more than dt
+                udt = np.round(dt*(ff[ubot] - ff[top])/rm).astype('int64')
+                shift = np.round(dt*(ff[ltop] - ff[top])/rm).astype('int64')
+                ldt = dt - shift
+                udt = np.minimum(udt, ndt(top, ubot) - 1)
+                ldt = np.minimum(ldt, ndt(ltop, bot) - 1)
+                merges.append((iband, iband + 1, udt, shift, ldt))
+                merged.append((top, bot))
+            if len(bands) % 2:
+                merges.append((len(bands) - 1, None, None, None, None))
+                merged.append(bands[-1])
+            self.levels.append(merges)
+            bands = merged
+            self.nrows = max(self.nrows, sum(ndt(top, bot) for top, bot in bands))
+
+    def dms(self, tsamp):
+        """DM of every row of the transform"""
+        return np.arange(self.maxdt + 1)*tsamp/(KDM*(self.freqs.min()**-2 - self.freqs.max()**-2))
+
+    def _transform(self, data, rows=None):
+        """Transform of a (nchan, nsamp) float32 block, sorted from the top of
+            the band, zeros after its end (the sweeps rows only)
+        """
+        nsamp = data.shape[1]
+        bands = [data[ichan:ichan+1] for ichan in range(data.shape[0])]
+        for level, merges in enumerate(self.levels):
+            merged = []
+            for iup, ilow, udt, shift, ldt in merges:
+                if ilow is None:
+                    merged.append(bands[iup])
+                    continue
+                if rows is not None and level == len(self.levels) - 1:
+                    # Last merge: the requested curves only
+                    udt, shift, ldt = udt[rows], shift[rows], ldt[rows]
+                low = bands[ilow]
+                # windows[i, s] is curve i of the lower half advanced by s samples
+                maxshift = int(shift.max())
+                padded = np.zeros((low.shape[0], nsamp + maxshift), dtype='float32')
+                padded[:, :nsamp] = low
+                windows = as_strided(padded, shape=(low.shape[0], maxshift + 1, nsamp),
+                                     strides=(padded.strides[0], padded.strides[1], padded.strides[1]))
+                merged.append(bands[iup][udt] + windows[ldt, shift])
+            bands = merged
+        return bands[0]
+
+    def transform(self, block, nout=None, weights=None, max_elems=1 << 26, rows=None):
+        """Dedisperse a (nchan, nsamp) block for all the sweeps.
+
+            Input:
+                block: (nchan, nsamp) data, channels as in freqs
+                nout: number of output samples (Default: nsamp - maxdt)
+                weights: weight of each channel, 0 to zap it (Default: all 1)
+                max_elems: largest number of values held by a level of the
+                    transform (chunks of the block along time)
+                rows: sweeps (in samples) to return (Default: 0 to maxdt)
+
+            Output:
+                (maxdt + 1, nout) float32 dedispersed time series, or
+                (len(rows), nout) for the sweeps rows
+        """
+        nchan, nsamp = block.shape
+        if nout is None:
+            nout = nsamp - self.maxdt
+        if nout <= 0 or self.maxdt + nout > nsamp:
+            raise ValueError("Block of %d samples too short for %d output samples and a %d sample sweep"
+                             % (nsamp, nout, self.maxdt))
+        if rows is not None:
+            rows = np.asarray(rows, dtype='int64')
+        out = np.zeros((self.maxdt + 1 if rows is None else rows.size, nout), dtype='float32')
+        chunk = max(self.maxdt, max_elems//self.nrows - self.maxdt, 1)
+        for start in range(0, nout, chunk):
+            nown = min(chunk, nout - start)
+            data = np.asarray(block[self.order, start:start+nown+self.maxdt], dtype='float32')
+            if weights is not None:
+                data = data*np.asarray(weights, dtype='float32')[self.order, np.newaxis]
+            out[:, start:start+nown] = self._transform(data, rows)[:, :nown]
+        return out
+
+    def blocks(self, fil, start=0, nspec=None, nout=65536, weights=None):
+        """Transform nspec samples (Default: to the end) of a filterbank
+            (FilterbankMmap) from start, in blocks of nout output samples
+            read with the maxdt samples of their sweep.
+
+            Output:
+                generator of (first sample, transform of the block)
+        """
+        if nspec is None:
+            nspec = fil.nspec - start
+        stop = min(start + nspec, fil.nspec - self.maxdt)
+        for bstart in range(start, stop, nout):
+            nown = min(nout, stop - bstart)
+            block = fil.get_block(bstart, nown + self.maxdt)
+            yield bstart, self.transform(block, nown, weights)
+
+
+if __name__ == "__main__":
+    from filterbank_mmap import FilterbankMmap
+    parser = ArgumentParser(description="FDMT of a filterbank file: brightest sweep of every block")
+    parser.add_argument('fil_file', type=str, help="Filterbank file")
+    parser.add_argument('--hidm', type=float, default=1000.0, help="Highest DM (Default: 1000)")
+    parser.add_argument('--start', type=float, default=0.0, help="Start time in sec (Default: 0)")
+    parser.add_argument('--duration', type=float, default=None, help="Duration in sec (Default: to the end)")
+    parser.add_argument('--block', type=int, default=65536, help="Output samples per block (Default: 65536)")
+    parser.add_argument('-o', '--output', type=str, default=None, help="Save the DM-vs-time array (.npy)")
+    args = parser.parse_args()
+
+    fil = FilterbankMmap(args.fil_file)
+    fdmt = Fdmt(fil.freqs, maxdt_of_dm(fil.freqs, fil.tsamp, args.hidm))
+    dms = fdmt.dms(fil.tsamp)
+    start = int(args.start/fil.tsamp)
+    nspec = int(args.duration/fil.tsamp) if args.duration else None
+    parts = []
+    for bstart, out in fdmt.blocks(fil, start, nspec, args.block):
+        out -= np.median(out, axis=1, keepdims=True)
+        idm, isamp = np.unravel_index(np.argmax(out), out.shape)
+        print("%.3f sec: brightest at %.3f sec, DM %.2f" % (bstart*fil.tsamp, (bstart + isamp)*fil.tsamp, dms[idm]))
+        if args.output:
+            parts.append(out)
+    if args.output:
+        np.save(args.output, np.concatenate(parts, axis=1))
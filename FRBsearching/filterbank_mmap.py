@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+"""
+Memory-mapped reader for SIGPROC filterbank (.fil) files.
+
+The data section is mapped once and blocks of spectra are handed out as
+(nchan, nsamp) views of the file, so extracting a candidate cutout does
+not copy the data. 8, 16 and 32-bit files are read as views, 1, 2 and
+4-bit files are unpacked with vectorized numpy operations.
+
+FilterbankMmap can be used in place of presto's FilterbankFile with
+waterfaller_vg.waterfall().
+
+A file can also be read flipped in time ('nT'), frequency ('nF') or both
+('nTnF'), as negative-stride views of the same mapping, for the negative
+DM searches (the header, and so the frequencies, are not flipped).
+"""
+import os
+import copy
+import struct
+import numpy as np
+
+# Types of the SIGPROC header keywords
+HEADER_STRINGS = ['rawdatafile', 'source_name']
+HEADER_INTS = ['telescope_id', 'machine_id', 'data_type', 'barycentric',
+               'pulsarcentric', 'nbits', 'nsamples', 'nchans', 'nifs',
+               'nbeams', 'ibeam']
+HEADER_DOUBLES = ['tstart', 'tsamp', 'fch1', 'foff', 'refdm', 'az_start',
+                  'za_start', 'src_raj', 'src_dej', 'period', 'fchannel']
+HEADER_BYTES = ['signed']
+
+# Directions a file can be read in: as written, reversed in time, in
+# frequency or in both (the FTdirection prefixes of the source names)
+FLIPS = ('none', 'nT', 'nF', 'nTnF')
+
+
+def _read_string(f):
+    nchar = struct.unpack('<i', f.read(4))[0]
+    if nchar < 1 or nchar > 80:
+        raise ValueError("Not a SIGPROC filterbank header (string of length %d)" % nchar)
+    return f.read(nchar).decode('ascii', 'replace')
+
+
+def read_header(fil_file):
+    """Parse the header of a SIGPROC filterbank file.
+
+        Input:
+            fil_file: name of the filterbank file
+
+        Output:
+            header: dictionary of header keywords
+            header_size: size of the header in bytes
+    """
+    header = {}
+    with open(fil_file, 'rb') as f:
+        if _read_string(f) != 'HEADER_START':
+            raise ValueError("%s is not a SIGPROC filterbank file" % fil_file)
+        while True:
+            key = _read_string(f)
+            if key == 'HEADER_END':
+                break
+            elif key in HEADER_STRINGS:
+                header[key] = _read_string(f)
+            elif key in HEADER_INTS:
+                header[key] = struct.unpack('<i', f.read(4))[0]
+            elif key in HEADER_DOUBLES:
+                header[key] = struct.unpack('<d', f.read(8))[0]
+            elif key in HEADER_BYTES:
+                header[key] = struct.unpack('<b', f.read(1))[0]
+            elif key in ['FREQUENCY_START', 'FREQUENCY_END']:
+                continue
+            else:
+                raise ValueError("Unknown SIGPROC header keyword '%s' in %s" % (key, fil_file))
+        header_size = f.tell()
+    header.setdefault('source_name', '')
+    header.setdefault('nifs', 1)
+    return header, header_size
+
+
+def _write_string(f, s):
+    f.write(struct.pack('<i', len(s)))
+    f.write(s.encode('ascii'))
+
+
+def write_header(f, header):
+    """Write a SIGPROC header for the keywords in the header dictionary
+        to the open (binary) file object f.
+    """
+    _write_string(f, 'HEADER_START')
+    for key, val in header.items():
+        if key in HEADER_STRINGS:
+            _write_string(f, key)
+            _write_string(f, str(val))
+        elif key in HEADER_INTS:
+            _write_string(f, key)
+            f.write(struct.pack('<i', int(val)))
+        elif key in HEADER_DOUBLES:
+            _write_string(f, key)
+            f.write(struct.pack('<d', float(val)))
+        elif key in HEADER_BYTES:
+            _write_string(f, key)
+            f.write(struct.pack('<b', int(val)))
+    _write_string(f, 'HEADER_END')
+
+
+def data_dtype(nbits, signed=False):
+    """Numpy type of one sample of a nbits filterbank file (>= 8 bits)"""
+    if nbits == 8:
+        return np.dtype('int8') if signed else np.dtype('uint8')
+    elif nbits == 16:
+        return np.dtype('<u2')
+    elif nbits == 32:
+        return np.dtype('<f4')
+    elif nbits == 64:
+        return np.dtype('<f8')
+    raise ValueError("Can not read %d-bit filterbank data" % nbits)
+
+
+def unpack_bits(raw, nbits):
+    """Unpack 1, 2 or 4-bit samples packed in the bytes of raw.
+        SIGPROC puts the first sample in the lowest bits of a byte.
+
+        Input:
+            raw: (nspec, nbytes) uint8 array
+            nbits: bits per sample
+
+        Output:
+            (nspec, nbytes*8/nbits) uint8 array
+    """
+    shifts = np.arange(0, 8, nbits, dtype='uint8')
+    mask = np.uint8((1 << nbits) - 1)
+    out = (raw[..., np.newaxis] >> shifts) & mask
+    return out.reshape(raw.shape[0], -1)
+
+
+class FilterbankMmap(object):
+    def __init__(self, fil_file, flip='none'):
+        if flip not in FLIPS:
+            raise ValueError("Unknown flip '%s' (one of %s)" % (flip, ", ".join(FLIPS)))
+        self.filename = fil_file
+        self.flip = flip
+        self.header, self.header_size = read_header(fil_file)
+        self.nchans = self.header['nchans']
+        self.nbits = self.header['nbits']
+        self.nifs = self.header['nifs']
+        if self.nifs != 1:
+            raise ValueError("Only total intensity (nifs=1) files are supported, %s has %d IFs"
+                             % (fil_file, self.nifs))
+        if self.nbits < 8:
+            self.dtype = np.dtype('uint8')
+        else:
+            self.dtype = data_dtype(self.nbits, self.header.get('signed', 0) == 1)
+        self.bytes_per_spectrum = self.nchans*self.nbits // 8
+        self._data = None
+        self._block = None
+        self._block_start = 0
+        self._map()
+
+    def _map(self):
+        """(Re)map the data section of the file"""
+        data_size = os.path.getsize(self.filename) - self.header_size
+        nspec = data_size // self.bytes_per_spectrum
+        if nspec <= 0:
+            self._raw = np.zeros((0, self.bytes_per_spectrum*8//self.nbits), dtype=self.dtype)
+        elif self.nbits < 8:
+            self._raw = np.memmap(self.filename, dtype='uint8', mode='r',
+                                  offset=self.header_size,
+                                  shape=(nspec, self.bytes_per_spectrum))
+        else:
+            self._raw = np.memmap(self.filename, dtype=self.dtype, mode='r',
+                                  offset=self.header_size, shape=(nspec, self.nchans))
+        self._data = self._flip_view(self._raw, self.nbits >= 8)
+
+    def _flip_view(self, data, flip_freq=True):
+        """(nspec, nchan) data in the direction of the file (packed bytes
+            are only flipped in time, the channels once unpacked)
+        """
+        if 'nT' in self.flip:
+            data = data[::-1]
+        if 'nF' in self.flip and flip_freq:
+            data = data[:, ::-1]
+        return data
+
+    def _unpack(self, raw):
+        """Samples of packed spectra of self._data (already in time order)"""
+        data = unpack_bits(np.asarray(raw), self.nbits)
+        return data[:, ::-1] if 'nF' in self.flip else data
+
+    def flipped(self, flip):
+        """The same file read in the direction flip (see FLIPS), as a view
+            of the same mapping (the data are not copied)
+        """
+        if flip not in FLIPS:
+            raise ValueError("Unknown flip '%s' (one of %s)" % (flip, ", ".join(FLIPS)))
+        view = copy.copy(self)
+        view.flip = flip
+        view._block = None
+        view._data = view._flip_view(self._raw, self.nbits >= 8)
+        return view
+
+    def refresh(self):
+        """Map the file again to see the spectra appended to it since it
+            was opened (a file being written by the recorder).
+            Returns the number of spectra.
+        """
+        self._block = None
+        self._map()
+        return self.nspec
+
+    @property
+    def nchan(self):
+        return self.nchans
+
+    @property
+    def nspec(self):
+        return self._data.shape[0]
+
+    @property
+    def tsamp(self):
+        return self.header['tsamp']
+
+    @property
+    def tobs(self):
+        return self.nspec*self.tsamp
+
+    @property
+    def frequencies(self):
+        return self.header['fch1'] + self.header['foff']*np.arange(self.nchans)
+
+    @property
+    def freqs(self):
+        return self.frequencies
+
+    def _clip(self, start, nspec):
+        start = max(int(start), 0)
+        stop = min(start + int(nspec), self.nspec)
+        return start, max(stop, start)
+
+    def load_block(self, start, nspec):
+        """Read nspec spectra starting at sample start into memory with one
+            sequential read. Later get_block()/get_spectra() calls that fall
+            inside the loaded block are served as views of it.
+        """
+        start, stop = self._clip(start, nspec)
+        if self._block is not None and self._block_start == start \
+                and self._block.shape[0] == stop - start:
+            return
+        block = np.array(self._data[start:stop])
+        if self.nbits < 8:
+            block = np.ascontiguousarray(self._unpack(block))
+        self._block = block
+        self._block_start = start
+
+    def release_block(self):
+        """Drop the block read by load_block()"""
+        self._block = None
+
+    def get_block(self, start, nspec):
+        """Return nspec spectra starting at sample start as a (nchan, nsamp)
+            array. For files with 8 or more bits this is a view of the
+            memory-mapped file (read only), otherwise the unpacked samples.
+            A view of the block read by load_block() is returned if it
+            holds the requested spectra.
+        """
+        start, stop = self._clip(start, nspec)
+        if self._block is not None:
+            bstart = self._block_start
+            if bstart <= start and stop <= bstart + self._block.shape[0]:
+                return self._block[start-bstart:stop-bstart].T
+        block = self._data[start:stop]
+        if self.nbits < 8:
+            block = self._unpack(block)
+        return block.T
+
+    def get_spectra(self, start, nspec):
+        """Same as presto's FilterbankFile.get_spectra: return a Spectra
+            object of nspec spectra starting at sample start.
+        """
+        from presto import spectra
+        start = max(int(start), 0)
+        block = self.get_block(start, nspec)
+        return spectra.Spectra(self.freqs, self.tsamp, block,
+                               starttime=start*self.tsamp, dm=0.0)
+
+
+def plan_blocks(windows, max_nspec):
+    """Plan a single sequential pass over a file for a list of windows.
+        Windows are sorted by start sample and overlapping (or touching)
+        windows are merged into blocks of at most max_nspec spectra. A
+        window longer than max_nspec gets a block of its own.
+
+        Input:
+            windows: list of (start, nspec) windows in samples
+            max_nspec: largest number of spectra of a merged block
+
+        Output:
+            list of (start, nspec, indices) blocks in file order, indices
+            being the positions in windows of the windows inside the block
+    """
+    order = sorted(range(len(windows)), key=lambda ii: (windows[ii][0], windows[ii][1]))
+    blocks = []
+    for ii in order:
+        start, nspec = int(windows[ii][0]), int(windows[ii][1])
+        stop = start + max(nspec, 0)
+        if blocks:
+            bstart, bstop, indices = blocks[-1]
+            if start <= bstop and max(stop, bstop) - bstart <= max_nspec:
+                blocks[-1] = (bstart, max(stop, bstop), indices + [ii])
+                continue
+        blocks.append((start, stop, [ii]))
+    return [(bstart, bstop - bstart, indices) for bstart, bstop, indices in blocks]
@@ -6,6 +6,8 @@
 
 import sys, math
 import numpy as np
+from cand_io import load_cands
+from multibeam import BeamLayout, is_coinc_rfi
 from math import sin, pi
 
 class Classifier(object):
@@ -18,6 +20,7 @@ class Classifier(object):
         self.filter_cut  = 8
         self.beam_mask   = (1<<13) - 1  # 1111111111111 allow all beams
 	# For 13 beam mask. These number are in decimal but if we convert them to binnary they generate valid beam masks. 
+        self.layout      = None  # BeamLayout of the beams (Default: the valid_masks)
         self.valid_masks = [1, 2, 3, 4, 5, 6, 7, 8, 9, 12, 13, 15, 16, 17, 24, 25, 29, 32, 33, 48, 49, 57, 64, 65, 66, 67, 71, 96, 97, 99, 113, 128, 130, 192, 194, 195, 256, 258, 260, 262, 263, 386, 512, 516, 520, 524, 525, 772, 1024, 1032, 1040, 1048, 1049, 1544, 2048, 2064, 2080, 2096, 2097, 3088, 4096, 4128, 4160, 4192, 4193, 4288, 6176]
 
     def is_hidden(self, cand):
@@ -27,6 +30,13 @@ class Classifier(object):
     def is_noise(self, cand):
         return cand['members'] < self.members_cut
 
+    # seen in too many beams, or in beams that are not neighbours
+    def is_coinc_rfi(self, cand):
+        beam_mask = cand['beam_mask'] & self.beam_mask
+        if self.layout is None:
+            return np.isin(beam_mask, self.valid_masks) == False
+        return is_coinc_rfi({'beam_mask': beam_mask}, self.layout, self.nbeams_cut)
+
     # test if candidate is galactic or low dm in BL case
     def is_galactic(self, cand):
       return cand['dm'] <= self.dm_cut
@@ -42,57 +52,183 @@ class Classifier(object):
     def max_time(self, cand):
         return np.amax(cand['time'])
 
+    # candidates per second in a window of event_time sec around every epoch
+    # (shortened at the edges of the observation), counting the candidates
+    # at times (sorted)
+    def cands_per_sec(self, times, epochs, min_time, max_time, event_time=8.0):
+      times = np.asarray(times, dtype=float)
+      epochs = np.asarray(epochs, dtype=float)
+      half = event_time / 2.0
+      new_time = np.where(epochs - half < min_time, epochs - min_time, half) + \
+                 np.where(epochs + half > max_time, max_time - epochs, half)
+      half_time = new_time / 2.0
+      event_sum = np.searchsorted(times, epochs + half_time, side='right') - \
+                  np.searchsorted(times, epochs - half_time, side='left')
+      cands_per_second = np.zeros(len(epochs))
+      measured = new_time > 0
+      cands_per_second[measured] = event_sum[measured] / new_time[measured]
+      return cands_per_second
+
+# Columns of the *_all.cand file, as classified
+ALL_CANDS_DTYPE = {'names': ('snr', 'samp_idx', 'time', 'filter',
+                             'dm_trial', 'dm', 'members', 'begin', 'end',
+                             'nbeams', 'beam_mask', 'prim_beam',
+                             'max_snr', 'beam'),
+                   'formats': ('f4', 'i4', 'f4', 'i4',
+                               'i4', 'f4', 'i4', 'i4', 'i4',
+                               'i4', 'i8', 'i4',
+                               'f4', 'i4')}
+
+# to clear the 17th bit (RFI tag)
+CLEAR_RFI_MASK = 0b10001111111111111
+
+def load_all_cands(filenames, clear_rfi_tag=True):
+    """Candidates of one or several *_all.cand files, beams 0-based.
+    (parsed once, then from their .npy cache). clear_rfi_tag: clear the
+    RFI tag of Heimdall's 13 beam coincidencer in beam_mask."""
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    all_cands = np.concatenate([np.zeros(0, dtype=ALL_CANDS_DTYPE)] +
+                               [load_cands(filename).astype(ALL_CANDS_DTYPE) for filename in filenames])
+    # Adjust for 0-based indexing
+    all_cands['prim_beam'] -= 1
+    all_cands['beam'] -= 1
+    if clear_rfi_tag:
+      all_cands['beam_mask'] &= CLEAR_RFI_MASK
+    return all_cands
+
+def classify(all_cands, gdm=1.0, snr_cut=10.0, filter_cut=8, nbeams_cut=4, beam_mask=None,
+             members_cut=3, max_cands_per_sec=2.0, event_time=8.0, layout=None):
+    """Classify the candidates in one pass.
+
+    Input:
+        all_cands: candidates (ALL_CANDS_DTYPE)
+        gdm, snr_cut, filter_cut, nbeams_cut, beam_mask, members_cut: cuts of the Classifier
+            (beam_mask Default: all the beams of the layout, 13 beams without)
+        max_cands_per_sec: RFI storm cut (None: no RFI storm cut)
+        event_time: window of the RFI storm cut in sec
+        layout: BeamLayout of the beams, to classify the candidates seen in
+            more than nbeams_cut beams or in beams that are not neighbours
+            as coincident RFI (None: no coincident RFI cut)
+
+    Output:
+        categories: dict of the candidates classified as hidden, noise, galactic
+            (coinc with a layout) and valid
+        counts: dict of the number of candidates loaded and of every category,
+            rfi_storm included
+        rates: (time, candidates per second) of the candidates checked for
+            an RFI storm
+    """
+    classifier = Classifier(math.fabs(gdm))
+    classifier.snr_cut = snr_cut
+    classifier.filter_cut = filter_cut
+    classifier.nbeams_cut = nbeams_cut
+    if beam_mask is None:
+      beam_mask = (1 << (layout.nbeams if layout is not None else 13)) - 1
+    classifier.beam_mask = beam_mask
+    classifier.members_cut = members_cut
+    classifier.layout = layout
+
+    categories = {}
+
+    is_hidden      = classifier.is_hidden(all_cands)
+    is_noise       = classifier.is_noise(all_cands)
+    #is_coinc_dumb  = classifier.is_coinc_rfi_dumb(all_cands)
+    #is_coinc_smart = classifier.is_coinc_rfi_smart(all_cands)
+    is_galactic    = classifier.is_galactic(all_cands)
+    is_valid       = (is_hidden == False) & (is_noise == False) & (is_galactic == False)
+    if layout is not None:
+      is_coinc     = classifier.is_coinc_rfi(all_cands)
+      categories["coinc"] = all_cands[(is_hidden == False) & (is_noise == False) & is_coinc]
+      is_galactic &= (is_coinc == False)
+      is_valid    &= (is_coinc == False)
+
+    categories["hidden"]      = all_cands[is_hidden]
+    categories["noise"]       = all_cands[(is_hidden == False) & is_noise]
+    #categories["coinc_dumb"]  = all_cands[(is_hidden == False) & (is_noise == False) & is_coinc_dumb]
+    #categories["coinc_smart"] = all_cands[(is_hidden == False) & (is_noise == False) & (is_coinc_dumb == False) & is_coinc_smart]
+    categories["galactic"]    = all_cands[(is_hidden == False) & (is_noise == False) & is_galactic]
+    categories["valid"]       = all_cands[is_valid]
+
+    pre_valid = len(categories["valid"])
+    rates = (np.zeros(0), np.zeros(0))
+
+    # for valid events, check the event rate around the time of the event
+    if max_cands_per_sec is not None and len(categories['valid']) > 0:
+      min_time = classifier.min_time(all_cands)
+      max_time = classifier.max_time(all_cands)
+
+      # Here we check if the event rate excedes set maximum number of events per sec
+      times = np.sort(all_cands['time'][is_noise == False])
+      cands_per_second = classifier.cands_per_sec(times, categories['valid']['time'],
+                                                  min_time, max_time, event_time)
+      rates = (categories['valid']['time'], cands_per_second)
+      categories['valid'] = categories['valid'][cands_per_second < max_cands_per_sec]
+
+    counts = dict((name, len(categories[name])) for name in categories)
+    counts['loaded'] = len(all_cands)
+    counts['rfi_storm'] = pre_valid - len(categories["valid"])
+    return categories, counts, rates
+
 class TextOutput(object):
     def __init__(self):
         self.dm_base = 1.0
         self.snr_min = 6.0
 
-    def print_html(self, data):
+    def print_html(self, data, out=sys.stdout):
         if len(data['valid']) > 0:
-            sys.stdout.write("<table width='100%' border=1 cellpadding=4px cellspacing=4px>\n")
-            sys.stdout.write("<tr><th align=left>SNR</th><th align=left>Time</th><th align=left>DM</th><th align=left>Filter [ms]</th><th align=left>Beam</th></tr>\n")
-            for (i, item) in enumerate(data['valid']['snr']):
-                sys.stdout.write ("<tr>" + \
-                                  "<td>" + str(data['valid']['snr'][i]) + "</td>" + \
-                                  "<td>" + str(data['valid']['time'][i]) + "</td>" + \
-                                  "<td>" + str(data['valid']['dm'][i]) + "</td>" + \
-                                  "<td>" + str(0.064 * (2 **data['valid']['filter'][i])) + "</td>" + \
-                                  "<td>" + str(data['valid']['prim_beam'][i]+1) + "</td>" + \
-                                  "</tr>\n")
-            sys.stdout.write("</table>\n")
-
-    def print_text(self, data):
+            lines = ["<table width='100%' border=1 cellpadding=4px cellspacing=4px>\n",
+                     "<tr><th align=left>SNR</th><th align=left>Time</th><th align=left>DM</th><th align=left>Filter [ms]</th><th align=left>Beam</th></tr>\n"]
+            for c in data['valid']:
+                lines.append("<tr>" + \
+                             "<td>" + str(c['snr']) + "</td>" + \
+                             "<td>" + str(c['time']) + "</td>" + \
+                             "<td>" + str(c['dm']) + "</td>" + \
+                             "<td>" + str(0.064 * (2 **c['filter'])) + "</td>" + \
+                             "<td>" + str(c['prim_beam']+1) + "</td>" + \
+                             "</tr>\n")
+            lines.append("</table>\n")
+            out.write("".join(lines))
+
+    def print_text(self, data, out=sys.stdout):
         
         cand_type = 'valid'
     
         if len(data[cand_type]) > 0:
 
-          # get indicies list for sorting via time
-          sorted_indices = [i[0] for i in sorted(enumerate(data[cand_type]['time']), key=lambda x:x[1])]
+          # sorted via time
+          cands = data[cand_type][np.argsort(data[cand_type]['time'], kind='stable')]
+
+          #out.write ( "SNR\tTIME\tSAMP\tDM\tFILTER\tBEAM\n")
+          out.write ("".join(str(c['snr']) + "\t" + \
+                             str(c['time']) + "\t" + \
+                             str(c['samp_idx']) + "\t" + \
+                             str(c['dm']) + "\t" + \
+                             str(c['filter']) + "\t" + \
+                             str(c['prim_beam']+1) + \
+                             "\n" for c in cands))
 
-          #sys.stdout.write ( "SNR\tTIME\tSAMP\tDM\tFILTER\tBEAM\n")
-          for i in sorted_indices:
-                sys.stdout.write (str(data[cand_type]['snr'][i]) + "\t" + \
-                                  str(data[cand_type]['time'][i]) + "\t" + \
-                                  str(data[cand_type]['samp_idx'][i]) + "\t" + \
-                                  str(data[cand_type]['dm'][i]) + "\t" + \
-                                  str(data[cand_type]['filter'][i]) + "\t" + \
-                                  str(data[cand_type]['prim_beam'][i]+1) + \
-                                  "\n")
+    def print_xml(self, data, out=sys.stdout):
+        # sorted via snr
+        cands = data['valid'][np.argsort(-data['valid']['snr'], kind='stable')]
 
-    def print_xml(self, data):
-        # get indicie list for sorting via snr
-        snr_sorted_indices = [i[0] for i in sorted(enumerate(data['valid']['snr']), key=lambda x:x[1],reverse=True)]
+        out.write ("".join("<candidate snr='" + str(c['snr']) + \
+                           "' time='" + str(c['time']) + \
+                           "' dm='" + str(c['dm']) + \
+                           "' samp_idx='" + str(c['samp_idx']) + \
+                           "' filter='" + str(c['filter']) + \
+                           "' prim_beam='" + str(c['prim_beam'] + 1) + "'/>\n" for c in cands))
 
-        cand_i = 0
-        for i in snr_sorted_indices:
-            cand_i += 1
-            sys.stdout.write ("<candidate snr='" + str(data['valid']['snr'][i]) + \
-                                       "' time='" + str(data['valid']['time'][i]) + \
-                                       "' dm='" + str(data['valid']['dm'][i]) + \
-                                       "' samp_idx='" + str(data['valid']['samp_idx'][i]) + \
-                                       "' filter='" + str(data['valid']['filter'][i]) + \
-                                       "' prim_beam='" + str(data['valid']['prim_beam'][i] + 1) + "'/>\n")
+    def print_summary(self, counts, rates, max_cands_per_sec, out=sys.stderr):
+        out.write ("".join("cands_per_second around %f was %f [max = %f]\n" % (t, c, max_cands_per_sec)
+                           for t, c in zip(*rates)))
+        out.write ( "Classified %i as hidden \n" % counts["hidden"])
+        out.write ( "           %i as noise spikes\n" % counts["noise"])
+        if "coinc" in counts:
+          out.write ( "           %i as coinc RFI\n" % counts["coinc"])
+        out.write ( "           %i as low DM spikes\n" % counts["galactic"])
+        out.write ( "           %i as RFI storm\n" % counts["rfi_storm"])
+        out.write ( "           %i as valid FRB candidates\n" % counts["valid"])
 
 
 
@@ -103,170 +239,46 @@ if __name__ == "__main__":
     
     parser = argparse.ArgumentParser(description="Detects FRB's in candidates file")
     parser.add_argument('-gdm',default=1, type=float)
-    parser.add_argument('-cands_file', default="all_candidates.dat")
+    parser.add_argument('-cands_file', default=["all_candidates.dat"], nargs='+')
 
     parser.add_argument('-snr_cut', type=float, default=10)
     parser.add_argument('-filter_cut', type=int, default=8)
     parser.add_argument('-nbeams_cut', type=int, default=4)
-    parser.add_argument('-beam_mask', type=int, default=(1<<13)-1)
+    parser.add_argument('-beam_mask', type=int, default=None, help="Beams to classify (Default: all the beams of the layout, 13 beams without)")
 
     parser.add_argument('-max_cands_per_sec', type=float, default=2)
     parser.add_argument('-cand_list_xml', action="store_true")
     parser.add_argument('-cand_list_html', action="store_true")
     parser.add_argument('-verbose', action="store_true")
     parser.add_argument('-min_members_cut',type=float,default=3)
+    parser.add_argument('-layout', default=None, help="Beam layout file: beam x y per line (see multibeam.py)")
+    parser.add_argument('-radius', type=float, default=1.0, help="Largest distance of neighbouring beams")
     args = parser.parse_args()
 	 
-    max_cands_per_second = args.max_cands_per_sec
-    filename = args.cands_file
     verbose = args.verbose
-    cand_list_xml = args.cand_list_xml
-    cand_list_html = args.cand_list_html
-
-    # Define converters to handle the integer fields correctly
-    converters = {
-        1: lambda s: int(float(s)),  # 'samp_idx'
-        3: lambda s: int(float(s)),  # 'filter'
-        4: lambda s: int(float(s)),  # 'dm_trial'
-        6: lambda s: int(float(s)),  # 'members'
-        7: lambda s: int(float(s)),  # 'begin'
-        8: lambda s: int(float(s)),  # 'end'
-        9: lambda s: int(float(s)),  # 'nbeams'
-        10: lambda s: int(float(s)), # 'beam_mask'
-        11: lambda s: int(float(s)), # 'prim_beam'
-        13: lambda s: int(float(s))  # 'beam'
-    }   
-
-    # Load candidates from all_candidates file
-    all_cands = np.loadtxt(filename,
-                       dtype={'names': ('snr', 'samp_idx', 'time', 'filter',
-                                        'dm_trial', 'dm', 'members', 'begin', 'end',
-                                        'nbeams', 'beam_mask', 'prim_beam',
-                                        'max_snr', 'beam'),
-                              'formats': ('f4', 'i4', 'f4', 'i4',
-                                          'i4', 'f4', 'i4', 'i4', 'i4',
-                                          'i4', 'i4', 'i4',
-                                          'f4', 'i4')},
-                       converters=converters)
-
-
-    '''
-    all_cands = \
-        np.loadtxt(filename,
-                   dtype={'names': ('snr','samp_idx','time','filter',
-                                    'dm_trial','dm','members','begin','end',
-                                    'nbeams','beam_mask','prim_beam',
-                                    'max_snr','beam'),
-                          'formats': ('f4', 'i4', 'f4', 'i4',
-                                      'i4', 'f4', 'i4', 'i4', 'i4',
-                                      'i4', 'i4', 'i4',
-                                      'f4', 'i4')})
-    '''
-    # Adjust for 0-based indexing
-    all_cands['prim_beam'] -= 1
-    all_cands['beam'] -= 1
-
-    # to clear the 17th bit (RFI tag)
-    clear_rfi_mask = 0b10001111111111111;
 
-    all_cands['beam_mask'] &= clear_rfi_mask
+    layout = BeamLayout.from_file(args.layout, args.radius) if args.layout else None
+    all_cands = load_all_cands(args.cands_file, clear_rfi_tag=layout is None)
 
     if verbose:
       sys.stderr.write ("Loaded %i candidates\n" % len(all_cands))
-    
-    classifier = Classifier(math.fabs(args.gdm))
-    classifier.snr_cut = args.snr_cut
-    classifier.filter_cut = args.filter_cut
-    classifier.nbeams_cut = args.nbeams_cut
-    classifier.beam_mask = args.beam_mask
-    classifier.members_cut = args.min_members_cut    
-    # Filter candidates based on classifications
-    if verbose:
       sys.stderr.write ("Classifying candidates...\n")
 
-    categories = {}
-
-    is_hidden      = classifier.is_hidden(all_cands)
-    is_noise       = classifier.is_noise(all_cands)
-    #is_coinc_dumb  = classifier.is_coinc_rfi_dumb(all_cands)
-    #is_coinc_smart = classifier.is_coinc_rfi_smart(all_cands)
-    is_galactic    = classifier.is_galactic(all_cands)
-    is_valid       = (is_hidden == False) & (is_noise == False) & (is_galactic == False)
-
-    categories["hidden"]      = all_cands[is_hidden]
-    categories["noise"]       = all_cands[(is_hidden == False) & is_noise]
-    #categories["coinc_dumb"]  = all_cands[(is_hidden == False) & (is_noise == False) & is_coinc_dumb]
-    #categories["coinc_smart"] = all_cands[(is_hidden == False) & (is_noise == False) & (is_coinc_dumb == False) & is_coinc_smart]
-    categories["galactic"]    = all_cands[(is_hidden == False) & (is_noise == False) & is_galactic]
-    categories["valid"]       = all_cands[is_valid]
-
-    pre_valid = len(categories["valid"])
-
-    # for valid events, check the event rate around the time of the event
-    if len(categories['valid']) > 0 & False:
-      min_time = classifier.min_time(all_cands)
-      max_time = classifier.max_time(all_cands)
-
-      # look in a 8 second window around the event for excessive RFI
-      event_time = 8
-
-      # Here we check if the event rate excedes set maximum number of events per sec
-	
-      for (i, item) in reversed(list(enumerate(categories['valid']))):
-        #cands_per_second = classifier.events_per_sec (all_cands, item['time'], min_time, max_time)
-        #print "cands_per_second(orig)="+str(cands_per_second)
-
-        epoch = item['time']
-        half_time = event_time / 2.0
-        new_time = 0
-
-        if (epoch - half_time) < min_time:
-          new_time += (epoch - min_time)
-        else:
-          new_time += half_time
-
-        if (epoch + half_time) > max_time:
-          new_time += (max_time - epoch)
-        else:
-          new_time += half_time
+    categories, counts, rates = classify(all_cands, args.gdm, args.snr_cut, args.filter_cut,
+                                         args.nbeams_cut, args.beam_mask, args.min_members_cut,
+                                         args.max_cands_per_sec, layout=layout)
 
-        half_time = new_time / 2.0
-
-        is_not_adjacent = (is_noise == False) & classifier.is_not_adjacent(all_cands, epoch, half_time)
-        is_valid = (is_noise == False) & (is_not_adjacent == False)
-
-        event_sum = float(np.count_nonzero(is_valid))
-        cands_per_second = event_sum / new_time
-
-        if cands_per_second < 0:
-          sys.stderr.write ( "cands_per_second = %f \n" % ( cands_per_second )) 
-          cands_per_second = max_cands_per_second
-        if verbose:
-          sys.stderr.write ( "cands_per_second around %f was %f [max = %f]\n" % ( item['time'], cands_per_second, max_cands_per_second )) 
-        if cands_per_second >= max_cands_per_second:
-          categories['valid'] = np.delete(categories['valid'], i, axis=0)
-
-    rfi_storm = pre_valid - len(categories["valid"])
+    text_output = TextOutput()
 
     if verbose:
-      sys.stderr.write ( "Classified %i as hidden \n" % len(categories["hidden"]))
-      sys.stderr.write ( "           %i as noise spikes\n" % len(categories["noise"]))
-      #sys.stderr.write ( "           %i as coinc RFI [nbeam > %i]\n" % (len(categories["coinc_dumb"]), classifier.nbeams_cut))
-      #sys.stderr.write ( "           %i as coinc RFI [mask_rule]\n" % len(categories["coinc_smart"]))
-      sys.stderr.write ( "           %i as low DM spikes\n" % len(categories["galactic"]))
-      sys.stderr.write ( "           %i as RFI storm\n" % rfi_storm)
-      sys.stderr.write ( "           %i as valid FRB candidates\n" % len(categories["valid"]))
+      text_output.print_summary(counts, rates, args.max_cands_per_sec)
 
-    text_output = TextOutput()
-
-    if cand_list_xml:
+    if args.cand_list_xml:
       text_output.print_xml(categories)
-    elif cand_list_html:
+    elif args.cand_list_html:
       text_output.print_html(categories)
     else:
       text_output.print_text(categories)
 
     if verbose:
       sys.stderr.write ( "Done\n")
-
-
@@ -6,6 +6,7 @@
 
 import sys, math
 import numpy as np
+from cand_io import load_cands
 from math import sin, pi
 
 class Classifier(object):
@@ -126,17 +127,17 @@ if __name__ == "__main__":
     cand_list_xml = args.cand_list_xml
     cand_list_html = args.cand_list_html
 
-    # Load candidates from all_candidates file
+    # Load candidates from all_candidates file (parsed once, then from its .npy cache)
     all_cands = \
-        np.loadtxt(filename,
-                   dtype={'names': ('snr','samp_idx','time','filter',
-                                    'dm_trial','dm','members','begin','end',
-                                    'nbeams','beam_mask','prim_beam',
-                                    'max_snr','beam'),
-                          'formats': ('f4', 'i4', 'f4', 'i4',
-                                      'i4', 'f4', 'i4', 'i4', 'i4',
-                                      'i4', 'i4', 'i4',
-                                      'f4', 'i4')})
+        load_cands(filename).astype(
+                   {'names': ('snr','samp_idx','time','filter',
+                              'dm_trial','dm','members','begin','end',
+                              'nbeams','beam_mask','prim_beam',
+                              'max_snr','beam'),
+                    'formats': ('f4', 'i4', 'f4', 'i4',
+                                'i4', 'f4', 'i4', 'i4', 'i4',
+                                'i4', 'i4', 'i4',
+                                'f4', 'i4')})
 
     # Adjust for 0-based indexing
     all_cands['prim_beam'] -= 1
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+Run Heimdall on a long observation in time chunks.
+
+The file is split into chunks of chunk_time seconds. Each chunk is padded
+at the end by the dispersion delay of the highest DM (plus the widest
+boxcar) so a pulse starting in the chunk is fully inside the data handed
+to Heimdall. Chunks run concurrently, each in its own directory, and a
+'done' file is written when a chunk finished, so running again after a
+crash only searches the missing chunks.
+
+The candidates of the chunks are moved to the time of the whole file and
+a candidate is kept only by the chunk that owns its sample (the padding
+of a chunk is owned by the next one). Detections of the same pulse on
+both sides of a chunk boundary are merged into the brightest one.
+"""
+import os
+import glob
+import json
+import subprocess as sb
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from filterbank_mmap import FilterbankMmap, write_header
+from cand_io import CAND_NAMES, CAND_FORMATS, load_cands
+
+KDM = 4148.808  # MHz^2 / (pc cm^-3)
+
+
+def max_delay_nsamp(freqs, tsamp, dmhi, boxcar_max=0):
+    """Number of samples of the dispersion sweep at dmhi plus the widest boxcar"""
+    flo = np.min(freqs)
+    fhi = np.max(freqs)
+    delay = KDM*dmhi*(1.0/flo**2 - 1.0/fhi**2)
+    return int(np.ceil(delay/tsamp)) + int(boxcar_max)
+
+
+def plan_chunks(nspec, chunk_nspec, pad_nspec):
+    """Split nspec samples in chunks of chunk_nspec samples padded by pad_nspec.
+
+        Output:
+            list of (start, nspec, own_start, own_stop); the chunk reads
+            [start, start+nspec) and owns the candidates in [own_start, own_stop)
+    """
+    chunk_nspec = max(int(chunk_nspec), 1)
+    chunks = []
+    for own_start in range(0, nspec, chunk_nspec):
+        own_stop = min(own_start + chunk_nspec, nspec)
+        stop = min(own_stop + pad_nspec, nspec)
+        chunks.append((own_start, stop - own_start, own_start, own_stop))
+    return chunks
+
+
+def read_cands(cand_file):
+    """Read a 9 column Heimdall .cand file in a structured array"""
+    return load_cands(cand_file, CAND_NAMES, CAND_FORMATS, cache=False)
+
+
+def write_cands(cand_file, cands):
+    with open(cand_file, 'w') as f:
+        for c in cands:
+            f.write("%g\t%d\t%.6f\t%d\t%d\t%g\t%d\t%d\t%d\n" % (c['snr'], c['samp_idx'], c['time'],
+                    c['filter'], c['dm_trial'], c['dm'], c['members'], c['begin'], c['end']))
+
+
+def write_chunk(fil, chunk_file, start, nspec):
+    """Write samples [start, start+nspec) of fil (a FilterbankMmap) to a new
+        filterbank file with the start time of the chunk.
+    """
+    header = dict(fil.header)
+    header['tstart'] = header.get('tstart', 0.0) + start*fil.tsamp/86400.0
+    header.pop('nsamples', None)
+    with open(chunk_file + ".tmp", 'wb') as f:
+        write_header(f, header)
+        fil._data[start:start+nspec].tofile(f)
+    os.rename(chunk_file + ".tmp", chunk_file)
+
+
+def run_chunk(cmd, ntries=3):
+    """Run one Heimdall command, trying again after a failure.
+        Returns the exit code of the last try.
+    """
+    for itry in range(ntries):
+        if itry: print("Try %d after failure: %s" % (itry+1, cmd))
+        p = sb.Popen(cmd, stdout=sb.PIPE, shell=True)
+        p.communicate()
+        if p.returncode == 0:
+            break
+    return p.returncode
+
+
+def _chunk_dir(workdir, ichunk):
+    return os.path.join(workdir, "chunk_%04d" % ichunk)
+
+
+def _search_chunk(args):
+    ichunk, chunk, fil_file, workdir, heimdall_args, heimdall, ntries = args
+    start, nspec, own_start, own_stop = chunk
+    cdir = _chunk_dir(workdir, ichunk)
+    done_file = os.path.join(cdir, "done")
+    params = {'fil_file': fil_file, 'start': start, 'nspec': nspec, 'args': heimdall_args}
+    if os.path.isfile(done_file):
+        with open(done_file) as f:
+            if json.load(f) == params:
+                print("Chunk %d already searched" % ichunk)
+                return 0
+    if os.path.isdir(cdir):
+        for old in glob.glob(os.path.join(cdir, "*")):
+            os.remove(old)
+    else:
+        os.makedirs(cdir)
+    chunk_file = os.path.join(cdir, "chunk.fil")
+    write_chunk(FilterbankMmap(fil_file), chunk_file, start, nspec)
+    cmd = "%s -f %s -output_dir %s %s" % (heimdall, chunk_file, cdir, heimdall_args)
+    print(cmd)
+    returncode = run_chunk(cmd, ntries)
+    os.remove(chunk_file)
+    if returncode == 0:
+        with open(done_file, 'w') as f:
+            json.dump(params, f)
+    else:
+        print("HEIMDALL_ERROR=%d in chunk %d" % (returncode, ichunk))
+    return returncode
+
+
+def merge_chunks(chunks, workdir, tsamp):
+    """Candidates of all the chunks in file samples, keeping a candidate
+        only in the chunk owning its sample and merging the detections of a
+        pulse on both sides of a chunk boundary.
+
+        Output:
+            structured array of the candidates sorted by samp_idx
+            name of the first .cand file written by Heimdall
+    """
+    parts = []
+    first_name = None
+    for ichunk, (start, nspec, own_start, own_stop) in enumerate(chunks):
+        cand_files = sorted(glob.glob(os.path.join(_chunk_dir(workdir, ichunk), "*.cand")))
+        if cand_files and first_name is None:
+            first_name = os.path.basename(cand_files[0])
+        for cand_file in cand_files:
+            c = read_cands(cand_file)
+            c['samp_idx'] += start
+            c['begin'] += start
+            c['end'] += start
+            c['time'] = c['samp_idx']*tsamp
+            c = c[(c['samp_idx'] >= own_start) & (c['samp_idx'] < own_stop)]
+            parts.append((c, np.full(c.size, ichunk)))
+    if not parts:
+        return np.zeros(0, dtype={'names': CAND_NAMES, 'formats': CAND_FORMATS}), first_name
+    cands = np.concatenate([p[0] for p in parts])
+    ichunks = np.concatenate([p[1] for p in parts])
+
+    # Same pulse seen by two neighbouring chunks: same DM trial (+-1) and
+    # overlapping boxcars on both sides of the boundary; keep the brightest.
+    keep = np.ones(cands.size, dtype=bool)
+    for ichunk in range(1, len(chunks)):
+        boundary = chunks[ichunk][2]
+        before = np.where(ichunks == ichunk-1)[0]
+        after = np.where(ichunks == ichunk)[0]
+        before = before[cands['end'][before] >= boundary - (1 << cands['filter'][before])]
+        after = after[cands['begin'][after] <= boundary + (1 << cands['filter'][after])]
+        if not before.size or not after.size:
+            continue
+        b = cands[before]
+        a = cands[after]
+        width = np.maximum(1 << b['filter'][:, None], 1 << a['filter'][None, :])
+        same = (np.abs(b['samp_idx'][:, None] - a['samp_idx'][None, :]) <= width) & \
+               (np.abs(b['dm_trial'][:, None] - a['dm_trial'][None, :]) <= 1)
+        for ib, ia in zip(*np.nonzero(same)):
+            if b['snr'][ib] >= a['snr'][ia]:
+                keep[after[ia]] = False
+            else:
+                keep[before[ib]] = False
+    cands = cands[keep]
+    return cands[np.argsort(cands['samp_idx'], kind='stable')], first_name
+
+
+def heimdall_chunked(fil_file, heimdall_args, outdir, dmhi, boxcar_max, chunk_time,
+                     nworkers=2, heimdall="heimdall", ntries=3, workdir=None):
+    """Search fil_file with Heimdall in chunks of chunk_time seconds with
+        nworkers concurrent Heimdall runs and write the merged candidates to
+        a .cand file in outdir.
+
+        Input:
+            heimdall_args: Heimdall options other than -f and -output_dir
+            dmhi, boxcar_max: largest DM and boxcar of the search (for the padding)
+            ntries: number of runs of a failing chunk
+            workdir: directory of the chunk searches (Default: outdir/heimdall_chunks)
+
+        Output:
+            name of the merged .cand file, None if a chunk failed
+    """
+    if workdir is None:
+        workdir = os.path.join(outdir, "heimdall_chunks")
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    fil = FilterbankMmap(fil_file)
+    pad = max_delay_nsamp(fil.freqs, fil.tsamp, dmhi, boxcar_max)
+    chunk_nspec = int(round(chunk_time/fil.tsamp))
+    chunks = plan_chunks(fil.nspec, chunk_nspec, pad)
+    print("Running Heimdall on %d chunks of %.1f sec (padding %d samples) with %d workers"
+          % (len(chunks), chunk_time, pad, nworkers))
+
+    tasks = [(ichunk, chunk, fil_file, workdir, heimdall_args, heimdall, ntries)
+             for ichunk, chunk in enumerate(chunks)]
+    pool = ThreadPool(max(1, min(nworkers, len(chunks))))
+    try:
+        returncodes = pool.map(_search_chunk, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    failed = [ichunk for ichunk, r in enumerate(returncodes) if r != 0]
+    if failed:
+        print("HEIMDALL_ERROR=1 chunks %s failed, run again to search only these" % failed)
+        return None
+    print("HEIMDALL_ERROR=0")
+
+    cands, first_name = merge_chunks(chunks, workdir, fil.tsamp)
+    if first_name is None:
+        first_name = os.path.basename(fil_file)[:-4] + ".cand"
+    cand_file = os.path.join(outdir, first_name)
+    write_cands(cand_file, cands)
+    print("%d candidates from %d chunks in %s" % (cands.size, len(chunks), cand_file))
+    return cand_file
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Share one loaded ML model between the SPANDAK runs of a batch.
+
+serve() loads the model(s) once and answers the predict requests of the
+runs (SP_search_BL.py --ml_server) over a local socket, one request at a
+time. remote_predict() is the client side: it does what
+'predict.py FRBcand model -f file.fil' does, with the model of the server.
+The server and its clients share the authentication key through the
+SPANDAK_ML_AUTHKEY environment variable.
+"""
+import os
+import sys
+import time
+import threading
+from multiprocessing.managers import BaseManager
+
+# Directory of predict.py
+ML_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../ML/simulateFRBclassification')
+AUTHKEY_ENV = "SPANDAK_ML_AUTHKEY"
+
+
+class MLManager(BaseManager):
+    pass
+
+
+class ModelServer(object):
+    def __init__(self, model_names):
+        sys.path.insert(0, ML_DIR)
+        from predict import load_models
+        self.model = load_models(model_names)
+        self.lock = threading.Lock()
+
+    def predict(self, frb_cand_path, fil_file, manualzap="None"):
+        """Write FRBcand_prob.txt next to frb_cand_path, returns the number
+            of candidates predicted
+        """
+        from predict import predict_candidates
+        with self.lock:
+            # predict.py is run from the directory of the FRBcand file
+            cwd = os.getcwd()
+            os.chdir(os.path.dirname(os.path.abspath(frb_cand_path)))
+            try:
+                predictions = predict_candidates(self.model, os.path.abspath(frb_cand_path),
+                                                 fil_file, manualzap=manualzap)[2]
+            finally:
+                os.chdir(cwd)
+        return len(predictions)
+
+
+def authkey():
+    return os.environ[AUTHKEY_ENV].encode()
+
+
+def serve(model_names, address):
+    """Load the model(s) and answer requests on address (a socket path)
+        until the process is terminated
+    """
+    model = ModelServer(model_names)
+    MLManager.register('model', callable=lambda: model)
+    manager = MLManager(address=address, authkey=authkey())
+    print("ML model %s served on %s" % (" ".join(model_names), address))
+    manager.get_server().serve_forever()
+
+
+def remote_predict(address, frb_cand_path, fil_file, manualzap="None", timeout=600.0):
+    """Predict the candidates of frb_cand_path with the model of the
+        server at address, waiting up to timeout seconds for the server to
+        be up (it may still be loading the model)
+    """
+    MLManager.register('model')
+    manager = MLManager(address=address, authkey=authkey())
+    start = time.time()
+    while True:
+        try:
+            manager.connect()
+            break
+        except (IOError, OSError):
+            if time.time() - start > timeout:
+                raise
+            time.sleep(1)
+    return manager.model().predict(frb_cand_path, fil_file, manualzap)
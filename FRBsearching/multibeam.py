@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""
+Coincidence of the candidates of many beams (e.g. the synthesized beams of
+the ATA beamformer) searched at the same time.
+
+The candidates of all the beams are sorted in time once. Every candidate is
+joined to the candidates of all beams within its time window (the wider of
+the two boxcars plus time_tol samples) and dm_tol DM trials, by binary
+searches on the sorted times of the candidates of every filter, in blocks
+of bounded size. As in coincidencer.py (and Heimdall's coincidencer),
+every candidate is kept and gets the beams it was seen in: beam_mask has
+bit i set for (0-based) beam i, nbeams is its number of bits, prim_beam
+(1-based) and max_snr are those of the brightest match.
+
+Which beams are neighbours comes from the beam layout (BeamLayout): the
+beam positions in a text file and a radius. A pulse seen in more than
+nbeams_cut beams, or in beams not connected through neighbours, is
+coincident RFI (is_coinc_rfi). Without a layout all beams are neighbours.
+Up to 63 beams.
+
+Example: python multibeam.py *.cand --layout beams.txt --radius 1.5
+         (beams.txt: beam number (1-based), x and y of every beam)
+"""
+import os
+import glob
+from argparse import ArgumentParser
+import numpy as np
+from cand_io import CAND_NAMES, CAND_FORMATS, ALL_CAND_NAMES, ALL_CAND_FORMATS, popcount
+from coincidencer import load_cand_files, parse_cand_name
+from cpu_search import write_all_cands
+
+# Largest number of candidate pairs joined at once
+MAX_PAIRS = 1 << 22
+
+
+class BeamLayout(object):
+    """Neighbouring beams: beams closer than radius, from their positions.
+        Without positions, nbeams beams all neighbours of each other.
+    """
+    def __init__(self, positions=None, radius=1.0, nbeams=None):
+        if positions is None:
+            self.nbeams = nbeams
+            everyone = (1 << nbeams) - 1
+            self.neighbours = np.full(nbeams, everyone, dtype='int64')
+            return
+        positions = np.asarray(positions, dtype=float)
+        self.nbeams = positions.shape[0]
+        if self.nbeams > 63:
+            raise ValueError("%d beams, at most 63 beams in a beam mask" % self.nbeams)
+        dist = np.hypot(*(positions[:, None, :] - positions[None, :, :]).T)
+        near = dist <= radius
+        # neighbours[b]: mask of the beams near beam b (b included)
+        self.neighbours = (near.astype('int64') << np.arange(self.nbeams, dtype='int64')).sum(axis=1)
+
+    @classmethod
+    def from_file(cls, layout_file, radius):
+        """Layout of a text file: beam number (1-based), x and y per line"""
+        table = np.loadtxt(layout_file, ndmin=2)
+        positions = np.zeros((int(table[:, 0].max()), 2))
+        positions[table[:, 0].astype(int) - 1] = table[:, 1:3]
+        return cls(positions, radius)
+
+    def is_connected(self, masks):
+        """True for the beam masks whose beams are connected through neighbours"""
+        masks = np.asarray(masks).astype('int64')
+        # Grow from the lowest beam of every mask
+        reach = masks & -masks
+        while True:
+            grown = reach.copy()
+            for beam in range(self.nbeams):
+                grown |= np.where((reach >> beam) & 1, self.neighbours[beam], 0)
+            grown &= masks
+            if np.array_equal(grown, reach):
+                return reach == masks
+            reach = grown
+
+
+def join(samp, idm, filt, time_tol=0, dm_tol=3):
+    """Pairs (i, j) of candidates seen together: within the wider boxcar plus
+        time_tol samples and dm_tol DM trials (i with itself included),
+        i sorted, in blocks of at most MAX_PAIRS pairs.
+        samp must be sorted.
+
+        The candidates of every filter are searched apart, with the window
+        of their pair of filters: a few wide boxcars do not widen the
+        window of all the others.
+    """
+    n = samp.size
+    classes = np.unique(filt)
+    # Candidates of every filter, sorted by sample
+    members = np.argsort(filt, kind='stable')
+    bounds = np.r_[np.searchsorted(filt[members], classes), n]
+    lo = np.zeros((n, classes.size), dtype='int64')
+    hi = np.zeros((n, classes.size), dtype='int64')
+    for k, fclass in enumerate(classes):
+        csamp = samp[members[bounds[k]:bounds[k + 1]]]
+        window = np.left_shift(1, np.maximum(filt, fclass)) + time_tol
+        lo[:, k] = bounds[k] + np.searchsorted(csamp, samp - window, side='left')
+        hi[:, k] = bounds[k] + np.searchsorted(csamp, samp + window, side='right')
+    cells = hi - lo
+    counts = cells.sum(axis=1)
+    ends = np.cumsum(counts)
+    start = 0
+    while start < n:
+        # Block of candidates with at most MAX_PAIRS pairs (at least one)
+        stop = max(start + 1, np.searchsorted(ends, ends[start] - counts[start] + MAX_PAIRS, side='right'))
+        c = cells[start:stop].ravel()
+        i = np.repeat(np.repeat(np.arange(start, stop), classes.size), c)
+        j = members[np.arange(c.sum()) - np.repeat(np.cumsum(c) - c, c) + np.repeat(lo[start:stop].ravel(), c)]
+        ok = np.abs(idm[j] - idm[i]) <= dm_tol
+        yield i[ok], j[ok]
+        start = stop
+
+
+def coincide_beams(cands_of_beam, time_tol=0, dm_tol=3):
+    """Cross-beam coincidence of the candidates of every beam.
+
+        Input:
+            cands_of_beam: list of the candidates (at least the 9 .cand
+                columns) of every beam, beam 1 first
+            time_tol, dm_tol: join tolerances (see above)
+
+        Output:
+            candidates of all beams (ALL_CAND_NAMES), sorted by sample
+    """
+    beams = np.concatenate([np.full(c.size, ibeam, dtype='int64') for ibeam, c in enumerate(cands_of_beam)])
+    cands = np.zeros(beams.size, dtype={'names': CAND_NAMES, 'formats': CAND_FORMATS})
+    for name in CAND_NAMES:
+        cands[name] = np.concatenate([c[name] for c in cands_of_beam])
+    out = np.zeros(cands.size, dtype={'names': ALL_CAND_NAMES, 'formats': ALL_CAND_FORMATS})
+    if cands.size == 0:
+        return out
+    order = np.argsort(cands['samp_idx'], kind='stable')
+    cands = cands[order]
+    beams = beams[order]
+    snr = cands['snr'].astype(float)
+    mask = np.zeros(cands.size, dtype='int64')
+    max_snr = np.zeros(cands.size)
+    prim_beam = np.zeros(cands.size, dtype='int64')
+    for i, j in join(cands['samp_idx'].astype('int64'), cands['dm_trial'].astype('int64'),
+                     cands['filter'].astype('int64'), time_tol, dm_tol):
+        # i is sorted and every candidate matches itself: one run of i per candidate
+        starts = np.flatnonzero(np.r_[True, i[1:] != i[:-1]])
+        first = i[starts]
+        mask[first] = np.bitwise_or.reduceat(np.left_shift(1, beams[j]), starts)
+        max_snr[first] = np.maximum.reduceat(snr[j], starts)
+        # Brightest match (the first one in time for equal SNRs)
+        brightest = np.where(snr[j] == np.repeat(max_snr[first], np.diff(np.r_[starts, i.size])), j, cands.size)
+        prim_beam[first] = beams[np.minimum.reduceat(brightest, starts)]
+    for name in cands.dtype.names:
+        out[name] = cands[name]
+    out['beam_mask'] = mask
+    out['nbeams'] = popcount(mask)
+    out['prim_beam'] = prim_beam + 1
+    out['max_snr'] = max_snr
+    out['beam'] = beams + 1
+    return out
+
+
+def is_coinc_rfi(cands, layout, nbeams_cut=4):
+    """Coincident RFI: seen in more than nbeams_cut beams, or in beams that
+        are not neighbours (beam_mask of 0-based beams)
+    """
+    return (popcount(cands['beam_mask']) > nbeams_cut) | (layout.is_connected(cands['beam_mask']) == False)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Coincidence of the .cand files of many beams (<utc>_<beam>.cand)")
+    parser.add_argument('cand_files', type=str, nargs='*', help=".cand files (Default: *.cand)")
+    parser.add_argument('--layout', type=str, default=None, help="Beam layout file: beam x y per line (Default: all beams neighbours)")
+    parser.add_argument('--radius', type=float, default=1.0, help="Largest distance of neighbouring beams (Default: 1)")
+    parser.add_argument('--time_tol', type=int, default=0, help="Time tolerance in samples, on top of the boxcar width (Default: 0)")
+    parser.add_argument('--dm_tol', type=int, default=3, help="DM tolerance in DM trials (Default: 3)")
+    parser.add_argument('--nbeams_cut', type=int, default=4, help="Coincident RFI above this number of beams (Default: 4)")
+    args = parser.parse_args()
+
+    cand_files = sorted(f for f in (args.cand_files or glob.glob("*.cand")) if not f.endswith("_all.cand"))
+    cands, beam = load_cand_files(cand_files)
+    nbeams = int(beam.max()) if beam.size else 1
+    cands = coincide_beams([cands[beam == b] for b in range(1, nbeams + 1)], args.time_tol, args.dm_tol)
+    if args.layout:
+        layout = BeamLayout.from_file(args.layout, args.radius)
+    else:
+        layout = BeamLayout(nbeams=nbeams)
+    rfi = is_coinc_rfi(cands, layout, args.nbeams_cut)
+    all_cand_file = os.path.join(os.path.dirname(cand_files[0]), parse_cand_name(cand_files[0])[0] + "_all.cand")
+    write_all_cands(all_cand_file, cands)
+    print("%d candidates of %d beams, %d coincident RFI: %s" % (cands.size, nbeams, np.count_nonzero(rfi), all_cand_file))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+Header and statistics of an observation, computed once and shared by the
+stages of the pipeline.
+
+obs_info() reads the SIGPROC header in-process (no 'header' binary) and,
+if asked, scans the data once for per-channel mean, std, median, bandpass
+and fraction of zero samples. The results are saved next to the
+filterbank file (or in the working directory if that is not writable) in
+a <file>.obsinfo.json / <file>.obsinfo.npz sidecar, which is used again
+as long as the size and modification time of the file did not change.
+
+Example: python obsinfo.py file.fil --stats
+"""
+import os
+import json
+from argparse import ArgumentParser
+import numpy as np
+from filterbank_mmap import FilterbankMmap
+
+# Bytes of float32 data of a block of the statistics scan
+STATS_BLOCK_BYTES = 256*1024**2
+# Spectra of a block used for its median
+MEDIAN_SPECTRA = 4096
+
+
+def _sidecar(fil_file):
+    """Name (without extension) of the sidecar of fil_file"""
+    name = fil_file + ".obsinfo"
+    if os.access(os.path.dirname(os.path.abspath(fil_file)), os.W_OK):
+        return name
+    return os.path.join(os.getcwd(), os.path.basename(name))
+
+
+def _file_key(fil_file):
+    st = os.stat(fil_file)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def header_info(fil):
+    """Header values and derived quantities of a FilterbankMmap"""
+    info = dict(fil.header)
+    info['nspec'] = fil.nspec
+    info['tobs'] = fil.tobs
+    info['fh'] = float(fil.freqs.max())
+    info['fl'] = float(fil.freqs.min())
+    return info
+
+
+def scan_stats(fil, block=None):
+    """Per-channel statistics of the whole file in one pass, in blocks of
+        about STATS_BLOCK_BYTES (block spectra if given). The median is the
+        median of the medians of up to MEDIAN_SPECTRA evenly spaced spectra
+        of every block.
+    """
+    nchan = fil.nchans
+    if block is None:
+        block = max(1, STATS_BLOCK_BYTES//(4*nchan))
+    total = np.zeros(nchan)
+    total2 = np.zeros(nchan)
+    nzero = np.zeros(nchan)
+    medians = []
+    for start in range(0, fil.nspec, block):
+        data = fil.get_block(start, block)
+        # A copy: squared in place below
+        fdata = np.array(data, dtype='float32')
+        step = max(1, fdata.shape[1]//MEDIAN_SPECTRA)
+        medians.append(np.median(fdata[:, ::step], axis=1))
+        nzero += (data == 0).sum(axis=1)
+        total += fdata.sum(axis=1, dtype='float64')
+        # Squares in place: no second copy of the block
+        total2 += np.square(fdata, out=fdata).sum(axis=1, dtype='float64')
+    nspec = max(fil.nspec, 1)
+    mean = total/nspec
+    std = np.sqrt(np.maximum(total2/nspec - mean*mean, 0))
+    median = np.median(medians, axis=0) if medians else np.zeros(nchan)
+    return {'mean': mean, 'std': std, 'median': median,
+            'bandpass': mean/np.median(mean) if np.median(mean) else mean,
+            'zero_frac': nzero/nspec}
+
+
+def obs_info(fil_file, stats=False):
+    """Header (and statistics) of fil_file, from the sidecar when it is
+        up to date.
+
+        Input:
+            fil_file: name of the filterbank file
+            stats: also return the per-channel statistics
+
+        Output:
+            dictionary of the header keywords plus nspec, tobs, fl and fh;
+            with stats, also the per-channel arrays mean, std, median,
+            bandpass and zero_frac
+    """
+    sidecar = _sidecar(fil_file)
+    key = _file_key(fil_file)
+    info = None
+    if os.path.isfile(sidecar + ".json"):
+        with open(sidecar + ".json") as f:
+            saved = json.load(f)
+        if saved.get('key') == key:
+            info = saved['info']
+    if info is None:
+        info = header_info(FilterbankMmap(fil_file))
+        _save(sidecar, key, info)
+    if stats:
+        saved_stats = None
+        if os.path.isfile(sidecar + ".npz"):
+            npz = np.load(sidecar + ".npz")
+            if npz['size'] == key['size'] and npz['mtime'] == key['mtime']:
+                saved_stats = dict((name, npz[name]) for name in
+                                   ['mean', 'std', 'median', 'bandpass', 'zero_frac'])
+        if saved_stats is None:
+            print("Scanning %s for channel statistics" % fil_file)
+            saved_stats = scan_stats(FilterbankMmap(fil_file))
+            try:
+                np.savez(sidecar + ".npz", size=key['size'], mtime=key['mtime'], **saved_stats)
+            except IOError as e:
+                print("Can not save %s.npz: %s" % (sidecar, e))
+        info.update(saved_stats)
+    return info
+
+
+def _save(sidecar, key, info):
+    try:
+        with open(sidecar + ".json", 'w') as f:
+            json.dump({'key': key, 'info': info}, f, indent=1)
+    except IOError as e:
+        print("Can not save %s.json: %s" % (sidecar, e))
+
+
+def base_name(info, default_source="Unknown"):
+    """Source name, MJD (4 decimals, '.' replaced by '_') and base name
+        (source_MJD) of the files written for an observation.
+    """
+    source_name = info.get('source_name', "").strip()
+    if source_name == "":
+        source_name = default_source
+    source_name = source_name.replace(" ", "_")
+    MJD = ("%.12f" % info['tstart']).replace(".", "_")
+    MJD = MJD[:MJD.index("_") + 5]
+    return source_name, MJD, source_name + "_" + MJD
+
+
+def dead_channels(info):
+    """Channels without data (all zero or constant) in the statistics of obs_info"""
+    return [int(i) for i in np.where((info['zero_frac'] >= 1.0) | (info['std'] == 0))[0]]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Header and channel statistics of a filterbank file")
+    parser.add_argument('fil_file', type=str, help="Filterbank file")
+    parser.add_argument('--stats', action='store_true', help="Also scan the data for channel statistics")
+    args = parser.parse_args()
+
+    info = obs_info(args.fil_file, args.stats)
+    for name in sorted(info):
+        if np.ndim(info[name]) == 0:
+            print("%-14s: %s" % (name, info[name]))
+    if args.stats:
+        print("Dead channels : %s" % dead_channels(info))
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""
+Reduce a filterbank file to 8 bits, optionally summing adjacent channels
+(like sum_fil -obits 8 -fcollapse N), without the sum_fil binary.
+
+Every channel is requantized with its own offset and scale, measured on
+the first qlen spectra, so that the 8-bit data has a mean of OUT_MEAN and
+an rms of OUT_RMS. The file is processed in chunks on a pool of threads
+and written in order to a file. The file can also be copied to a named
+pipe (FIFO) as it is written (FifoFeeder), so that a search reading the
+pipe starts while the reduction is still running. The file is written
+whatever the reader of the pipe does: it may open the pipe late, exit
+early or never come (close_fifo of the ReduceThread releases the pipe).
+
+Example: python reduce_fil.py in.fil out_8bit.fil --fcollapse 2 --fifo /tmp/heimdall.fil
+"""
+import os
+import time
+import errno
+import fcntl
+import threading
+from collections import deque
+from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from filterbank_mmap import FilterbankMmap, write_header
+
+# Mean and rms of the requantized 8-bit data
+OUT_MEAN = 128.0
+OUT_RMS = 18.0
+
+
+def reduced_header(header, fcollapse):
+    """Header of the 8-bit file with fcollapse channels summed"""
+    header = dict(header)
+    nchans = header['nchans'] // fcollapse
+    foff = header['foff']
+    # Frequency of the first channel is the centre of the summed channels
+    header['fch1'] = header['fch1'] + 0.5*(fcollapse - 1)*foff
+    header['foff'] = foff*fcollapse
+    header['nchans'] = nchans
+    header['nbits'] = 8
+    header.pop('signed', None)
+    header.pop('nsamples', None)
+    return header
+
+
+def reduced_info(info, fcollapse):
+    """obs_info() of the reduced file, from the obs_info() of the input file
+        (for a reduced file still being written)
+    """
+    info = reduced_header(info, fcollapse)
+    freqs = info['fch1'] + info['foff']*np.arange(info['nchans'])
+    info['fh'] = float(freqs.max())
+    info['fl'] = float(freqs.min())
+    return info
+
+
+def collapse(block, fcollapse):
+    """Sum groups of fcollapse adjacent channels of a (nchan, nsamp) block"""
+    data = np.asarray(block, dtype='float32')
+    if fcollapse == 1:
+        return data
+    nchan = (data.shape[0] // fcollapse)*fcollapse
+    return data[:nchan].reshape(-1, fcollapse, data.shape[1]).sum(axis=1)
+
+
+def channel_scales(data):
+    """Offset and scale of every channel of a (nchan, nsamp) float block"""
+    mean = data.mean(axis=1)
+    rms = data.std(axis=1)
+    scale = np.where(rms > 0, OUT_RMS/np.where(rms > 0, rms, 1), 0.0)
+    return mean.astype('float32'), scale.astype('float32')
+
+
+def requantize(data, offset, scale):
+    """(nsamp, nchan) uint8 spectra of a (nchan, nsamp) float block"""
+    out = (data - offset[:, np.newaxis])*scale[:, np.newaxis] + OUT_MEAN
+    return np.clip(np.round(out), 0, 255).astype('uint8').T
+
+
+def reduce_fil(fil_file, out_file, fcollapse=1, qlen=10000, nthreads=4,
+               chunk_nspec=16384, fifo=None, feeder=None, stop=None):
+    """Write the 8-bit, channel-collapsed version of fil_file.
+
+        Input:
+            out_file: reduced filterbank file
+            fcollapse: number of adjacent channels summed
+            qlen: number of spectra used to measure the channel scaling
+            nthreads: number of threads reducing chunks
+            chunk_nspec: spectra in a chunk
+            fifo: named pipe also receiving the reduced file
+            feeder: FifoFeeder copying the file to the pipe (Default: one
+                for fifo), waited for before returning
+            stop: threading.Event stopping the reduction when set
+
+        Output:
+            number of spectra written
+    """
+    if feeder is None and fifo:
+        feeder = FifoFeeder(fifo, out_file)
+    fil = FilterbankMmap(fil_file)
+    if fil.nchans % fcollapse:
+        raise ValueError("%d channels can not be collapsed by %d" % (fil.nchans, fcollapse))
+    header = reduced_header(fil.header, fcollapse)
+    offset, scale = channel_scales(collapse(fil.get_block(0, qlen), fcollapse))
+
+    def reduce_chunk(start):
+        return requantize(collapse(fil.get_block(start, chunk_nspec), fcollapse), offset, scale).tobytes()
+
+    try:
+        with open(out_file, 'wb') as out:
+            if feeder is not None and feeder.ident is None:
+                feeder.start()
+
+            def write(buf):
+                out.write(buf)
+                out.flush()
+                if feeder is not None:
+                    feeder.grow(out.tell())
+
+            write_header(out, header)
+            # The header goes to the pipe first
+            write(b'')
+            pool = ThreadPool(max(1, nthreads))
+            pending = deque()
+            try:
+                # At most 2*nthreads chunks in memory, written in order
+                for start in range(0, fil.nspec, chunk_nspec):
+                    if stop is not None and stop.is_set():
+                        raise RuntimeError("Reduction of %s stopped" % fil_file)
+                    pending.append(pool.apply_async(reduce_chunk, (start,)))
+                    if len(pending) >= 2*nthreads:
+                        write(pending.popleft().get())
+                while pending:
+                    write(pending.popleft().get())
+            finally:
+                pool.close()
+                pool.join()
+    except Exception:
+        if feeder is not None:
+            feeder.cancel()
+        raise
+    if feeder is not None:
+        feeder.grow(feeder.size, done=True)
+        feeder.join()
+    return fil.nspec
+
+
+def open_fifo(fifo, cancelled, poll=0.05):
+    """Open the named pipe for writing once a reader opened it, without
+        blocking: None if cancelled (a threading.Event) is set first
+    """
+    while True:
+        try:
+            fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            # No reader yet
+            if cancelled.wait(poll):
+                return None
+            continue
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        return os.fdopen(fd, 'wb')
+
+
+class FifoFeeder(threading.Thread):
+    """Copy a file to a named pipe as it is written: grow() gives the size
+        written, cancel() gives up the pipe (a reader that never opened it
+        or is gone). The writer of the file never waits for the pipe.
+    """
+    def __init__(self, fifo, file_name):
+        threading.Thread.__init__(self)
+        # A reader stuck without reading must not keep the process alive
+        self.daemon = True
+        self.fifo = fifo
+        self.file_name = file_name
+        self.size = 0
+        self.done = False
+        self.pos = 0
+        self.cancelled = threading.Event()
+        self.cond = threading.Condition()
+
+    def grow(self, size, done=False):
+        with self.cond:
+            self.size = size
+            self.done = done
+            self.cond.notify_all()
+
+    def cancel(self):
+        self.cancelled.set()
+        with self.cond:
+            self.cond.notify_all()
+
+    def run(self):
+        dst = open_fifo(self.fifo, self.cancelled)
+        if dst is None:
+            return
+        try:
+            with open(self.file_name, 'rb') as src:
+                while True:
+                    with self.cond:
+                        while self.pos == self.size and not self.done and not self.cancelled.is_set():
+                            self.cond.wait()
+                        size = self.size
+                    if self.cancelled.is_set() or self.pos == size:
+                        break
+                    buf = src.read(min(size - self.pos, 1 << 22))
+                    if not buf:
+                        break
+                    dst.write(buf)
+                    self.pos += len(buf)
+        except (IOError, OSError) as e:
+            if e.errno != errno.EPIPE:
+                raise
+            print("Reader of %s exited" % self.fifo)
+        finally:
+            _close(dst)
+
+
+def _close(f):
+    try:
+        f.close()
+    except (IOError, OSError) as e:
+        # Data left in the buffer of a pipe without reader
+        if e.errno != errno.EPIPE:
+            raise
+
+
+class ReduceThread(threading.Thread):
+    """reduce_fil in a thread, the reduced file also copied to a named pipe
+        (fifo). After finish(), error is the exception that stopped it (None
+        if the reduced file is complete).
+    """
+    def __init__(self, fil_file, out_file, fcollapse=1, nthreads=4, fifo=None):
+        threading.Thread.__init__(self)
+        self.out_file = out_file
+        self.feeder = FifoFeeder(fifo, out_file) if fifo else None
+        self.stop = threading.Event()
+        self.reduce_args = (fil_file, out_file, fcollapse)
+        self.reduce_kwargs = {'nthreads': nthreads, 'feeder': self.feeder, 'stop': self.stop}
+        self.error = None
+        self.nspec = 0
+
+    def run(self):
+        try:
+            self.nspec = reduce_fil(*self.reduce_args, **self.reduce_kwargs)
+        except Exception as e:
+            print("Reducing %s failed: %s" % (self.reduce_args[0], e))
+            self.error = e
+
+    def close_fifo(self):
+        """Give up the pipe (its reader exited or never started)"""
+        if self.feeder is not None:
+            self.feeder.cancel()
+
+    def progress(self):
+        """Bytes written to the reduced file and to the pipe"""
+        size = os.path.getsize(self.out_file) if os.path.exists(self.out_file) else 0
+        return size + (self.feeder.pos if self.feeder is not None else 0)
+
+    def finish(self, timeout=600.0, poll=1.0):
+        """Wait for the reduction. Without any progress for timeout sec, the
+            reduction is stopped and RuntimeError raised.
+        """
+        last = self.progress()
+        since = time.time()
+        while self.is_alive():
+            self.join(poll)
+            now = self.progress()
+            if now != last:
+                last = now
+                since = time.time()
+            elif self.is_alive() and time.time() - since > timeout:
+                self.stop.set()
+                self.close_fifo()
+                self.join(poll)
+                self.error = RuntimeError("Reducing %s made no progress for %d sec, stopped"
+                                          % (self.reduce_args[0], timeout))
+                raise self.error
+
+
+def start_reduce(fil_file, out_file, fcollapse=1, nthreads=4, fifo=None):
+    """Run reduce_fil in a thread, returns the (started) ReduceThread"""
+    thread = ReduceThread(fil_file, out_file, fcollapse, nthreads, fifo)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Reduce a filterbank file to 8 bits (replaces sum_fil)")
+    parser.add_argument('fil_file', type=str, help="Input filterbank file")
+    parser.add_argument('out_file', type=str, help="Output 8-bit filterbank file")
+    parser.add_argument('--fcollapse', type=int, default=1, help="Number of channels to sum (Default: 1)")
+    parser.add_argument('--qlen', type=int, default=10000, help="Spectra used for the scaling (Default: 10000)")
+    parser.add_argument('--nthreads', type=int, default=4, help="Number of threads (Default: 4)")
+    parser.add_argument('--fifo', type=str, default=None, help="Also write to this named pipe")
+    args = parser.parse_args()
+
+    reduce_fil(args.fil_file, args.out_file, args.fcollapse, args.qlen, args.nthreads, fifo=args.fifo)
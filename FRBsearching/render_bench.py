@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Compare the candidate plotting speed of the old path (one waterfaller_vg.py
+process per candidate through exeparallel) with the pooled in-process
+renderer (render_candidates).
+
+Example: python render_bench.py file.fil FRBcand --nproc 20
+"""
+import os
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+import numpy as np
+from PlotCand import candPlotList, candPlotCmd, exeparallel, render_candidates
+from obsinfo import obs_info
+
+def run_bench(fil_file, frb_cands, nproc, mask_file="", keep=False):
+    f = obs_info(fil_file)
+    nchan = f['nchans']
+    fch1 = f['fch1']
+    foff = f['foff']
+    tint = f['tsamp']
+    Ttot = f['tobs']
+    fh = fch1
+    fl = fch1 + (foff*nchan)
+    cands = candPlotList(frb_cands, fl, fh, tint, Ttot, [], nchan, 0.0)
+    print("%d candidates to plot" % len(cands))
+
+    rates = {}
+    cwd = os.getcwd()
+    for name in ['subprocess', 'pool']:
+        wdir = tempfile.mkdtemp(prefix="render_bench_%s_" % name, dir=cwd)
+        os.chdir(wdir)
+        start = time.time()
+        if name == 'subprocess':
+            cmd_array = [candPlotCmd(fil_file, cand, mask_file, False, "", None) for cand in cands]
+            exeparallel(cmd_array, nproc)
+        else:
+            render_candidates(fil_file, cands, mask_file, False, "", None, nproc)
+        rates[name] = len(cands)/(time.time() - start)
+        os.chdir(cwd)
+        if not keep: shutil.rmtree(wdir)
+    return rates
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark candidate plotting")
+    parser.add_argument('fil_file', type=str, help="Filterbank file")
+    parser.add_argument('cand_file', type=str, help="FRBcand file (output of frb_detector_bl.py)")
+    parser.add_argument('--nproc', type=int, default=20, help="Number of parallel plots (Default: 20)")
+    parser.add_argument('--mask', type=str, default="", help="rfifind mask file")
+    parser.add_argument('--keep', action='store_true', help="Keep the plots of both runs")
+    args = parser.parse_args()
+
+    frb_cands = np.loadtxt(args.cand_file, dtype={'names': ('snr','time','samp_idx','dm','filter','prim_beam'),
+                                                 'formats': ('f4', 'f4', 'i4','f4','i4','i4')})
+    rates = run_bench(os.path.abspath(args.fil_file), frb_cands, args.nproc, args.mask, args.keep)
+    print("waterfaller_vg.py per candidate : %.2f candidates/sec" % rates['subprocess'])
+    print("pooled render_candidates        : %.2f candidates/sec" % rates['pool'])
+    print("Speed-up                        : %.1fx" % (rates['pool']/rates['subprocess']))
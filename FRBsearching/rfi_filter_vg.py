@@ -11,6 +11,8 @@ from argparse import ArgumentParser
 import os
 import rfi_quality_check_vg as rfiqul
 import bird_wrapper
+from obsinfo import obs_info
+from obsinfo import base_name as obs_base_name
 import timeit
 import sys
 
@@ -22,20 +24,11 @@ def rfi_filter(fil_file, time, timesig, freqsig, chanfrac, intfrac, max_percent,
 	# """Name and MJD are hardcoded for now, until we involve SIGPROC."""
 	# pulsar_name = "DIAG_PSR_J0034-0721"
 	# pulsar_MJD = "57640_130983796298"
-	file_name = fil_file[:-4] #file_name is filterbank file without .fil extension
-	hdrbase = file_name #file_name.split("/")[-1]
-	hdr_file_name = hdrbase+".hdr" #create name for .hdr file
-	os.system("/home/sonata/src/bl_sigproc/src/header {0} -source_name -tstart -tsamp -nchans > {1}".format(fil_file, hdr_file_name)) #create .hdr file with header information from .fil file
-	hdr_file = open(hdr_file_name, "r")
-	hdr_data = hdr_file.readlines()
-	source_name = hdr_data[0].strip("\n")
-	MJD = hdr_data[1].strip("\n").replace(".", "_")
-	if (len(MJD) - MJD.index("_") - 1) > 4: #check to see if the MJD has more than 4 decimal places
-		MJD = MJD[:MJD.index("_") + 5] #reduce the MJD to 4 decimal places
-	if source_name == "": source_name = "Unknown"
-	base_name = source_name + "_" + MJD #create a base filename for files that will be created from the pipeline.
-	tsamp = hdr_data[2].strip("\n")
-	nchans = hdr_data[3].strip("\n")
+	#Header from the observation sidecar (see obsinfo.py) instead of the header binary
+	info = obs_info(fil_file)
+	source_name, MJD, base_name = obs_base_name(info) #create a base filename for files that will be created from the pipeline.
+	tsamp = str(info['tsamp'])
+	nchans = str(info['nchans'])
 	#Call PRESTO's rfifind command using the given inputs.
 	if not mask:
 		cmd= "rfifind -ncpus 12 -time {0} -timesig {1} -freqsig {2} -chanfrac {3} -intfrac {4} -o {5} {6}".format(time, timesig, freqsig, chanfrac, intfrac, base_name, fil_file)
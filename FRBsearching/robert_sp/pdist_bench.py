@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Compare the duplicate spatial statistics of the former per-pulse loop
+(pairs of itertools.combinations of the duplicates of every group) with
+the batched get_pdist_stats, on a synthetic multi-beam candidate list.
+
+Example: python pdist_bench.py --nbeams 72 --ngroups 2000 --maxhits 200
+"""
+import time
+from argparse import ArgumentParser
+from itertools import combinations
+import numpy as np
+from sp_cand_table import PULSE_NAMES, PULSE_FORMATS, CandTable, find_duplicates, get_pdist_stats, \
+    beam_coords
+
+
+def synthetic_cands(nbeams, ngroups, maxhits, seed=0):
+    """
+    Groups of pulses seen in random beams of a hexagonal grid of nbeams
+    beams 3 arcmin apart (near RA 180, Dec 0), one group per second
+    """
+    rng = np.random.RandomState(seed)
+    side = int(np.ceil(np.sqrt(nbeams)))
+    ii, jj = np.divmod(np.arange(nbeams), side)
+    coords = np.column_stack([180.0 + (jj + 0.5*(ii % 2)) * 0.05, ii * 0.05 * np.sqrt(3)/2])
+    nhits = rng.randint(1, maxhits + 1, ngroups)
+    pulses = np.zeros(nhits.sum(), dtype={'names': PULSE_NAMES, 'formats': PULSE_FORMATS})
+    pulses['time'] = np.repeat(np.arange(ngroups) + 0.5, nhits)
+    pulses['dm'] = rng.uniform(100, 110, pulses.size)
+    pulses['sigma'] = rng.uniform(6, 20, pulses.size)
+    # Beams around a random beam of every group
+    center = np.repeat(rng.randint(0, nbeams, ngroups), nhits)
+    pulses['beam'] = np.clip(center + rng.randint(-side - 1, side + 2, pulses.size), 0, nbeams - 1)
+    return CandTable(pulses), coords
+
+
+def pdist_loop(table, coords):
+    """
+    Mean and std of the separations of the duplicates of every row, as the
+    former Pulse.get_pdist_stats computed them
+    """
+    means = np.zeros(len(table))
+    stds = np.zeros(len(table))
+    for nn, cand in enumerate(table):
+        if cand.nhits > 1:
+            ras = np.array([coords[bb][0] for bb in cand.dupes_beams])
+            decs = np.array([coords[bb][1] for bb in cand.dupes_beams])
+            pidx = np.array([ii for ii in combinations(np.arange(cand.nhits), 2)])
+            dra = (ras[pidx[:, 0]] - ras[pidx[:, 1]]) * 3600.
+            ddec = (decs[pidx[:, 0]] - decs[pidx[:, 1]]) * 3600.
+            dd = np.sqrt(dra**2.0 + ddec**2.0)
+            means[nn] = np.mean(dd)
+            stds[nn] = np.std(dd)
+    return means, stds
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the duplicate spatial statistics")
+    parser.add_argument('--nbeams', type=int, default=72, help="Number of beams (Default: 72)")
+    parser.add_argument('--ngroups', type=int, default=2000, help="Number of pulse groups (Default: 2000)")
+    parser.add_argument('--maxhits', type=int, default=200, help="Largest group (Default: 200)")
+    args = parser.parse_args()
+
+    table, coords = synthetic_cands(args.nbeams, args.ngroups, args.maxhits)
+    table = find_duplicates(table, 0.1, 1000.0)
+    print("%d pulses in %d groups of %d beams" % (len(table), np.count_nonzero(table['nhits']), args.nbeams))
+    start = time.time()
+    means, stds = pdist_loop(table, beam_coords(coords))
+    loop_time = time.time() - start
+    start = time.time()
+    get_pdist_stats(table, coords)
+    batch_time = time.time() - start
+    # The loop uses flat offsets: close to the angular separations near Dec 0
+    print("Largest difference of the means : %.3g arcsec" % np.max(np.abs(table['dupes_dist_mean'] - means)))
+    print("per-group combinations loop     : %.3f sec" % loop_time)
+    print("batched get_pdist_stats         : %.3f sec" % batch_time)
+    print("Speed-up                        : %.1fx" % (loop_time/batch_time))
@@ -0,0 +1,445 @@
+"""
+Columnar table of the single pulse candidates of PRESTO *.singlepulse
+files, and their grouping (duplicates of the same pulse in several DMs and
+beams, friends of friends in time and DM) and the separations of the beams
+of a group, without per-pulse objects. Used by sp_cand_find.
+"""
+import os
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+# Columns of a *.singlepulse line, and the beam of the file
+PULSE_NAMES   = ('dm', 'sigma', 'time', 'sample', 'dfact', 'beam')
+PULSE_FORMATS = ('f8', 'f8', 'f8', 'i8', 'i8', 'i4')
+
+# Largest number of pulse pairs compared at once
+MAX_PAIRS = 1 << 22
+
+
+class CandRow(object):
+    """
+    One candidate of a CandTable, with the attributes of the former
+    Pulse objects (dm, sigma, ..., nhits, dupes_dms, ...)
+    """
+    def __init__(self, table, row):
+        self.table = table
+        self.row   = row
+
+    def __getattr__(self, attr):
+        if attr.startswith('dupes_') and attr[6:-1] in PULSE_NAMES:
+            start = self.table['dupes_start'][self.row]
+            count = self.table['dupes_count'][self.row]
+            return list(self.table.pulses[attr[6:-1]][start:start+count])
+        return self.table[attr][self.row]
+
+    def __repr__(self):
+        out_str = "Pulse(T=%.3f, "    %(self.time) +\
+                        "DM=%.2f, "   %(self.dm)   +\
+                        "beam=%d, "   %(self.beam) +\
+                        "width=%d, "  %(self.dfact) +\
+                        "sigma=%.2f) " %(self.sigma)
+        return out_str
+
+
+class CandTable(object):
+    """
+    Candidates of *.singlepulse files as columns.
+
+    pulses is the structured array (PULSE_NAMES) of all the pulses read;
+    the rows of the table are the pulses pulses[index] with the columns of
+    the grouping (nhits, ndms, ...) in cols. The duplicates of a row are the
+    pulses pulses[dupes_start:dupes_start+dupes_count] (the pulses are
+    sorted by group by find_duplicates), the pulse of the row first.
+
+    table['sigma'] is a column, table[ii] a CandRow, table[array] the
+    table of the rows array (a mask, indices or a list of CandRow).
+    """
+    def __init__(self, pulses, index=None, cols=None):
+        self.pulses = pulses
+        if index is None:
+            index = np.arange(pulses.size)
+        self.index = index
+        if cols is None:
+            cols = {'nhits': np.zeros(index.size, dtype='int'),
+                    'ndms': np.zeros(index.size, dtype='int'),
+                    'dupes_start': index.copy(),
+                    'dupes_count': np.ones(index.size, dtype='int')}
+        self.cols = cols
+
+    def __len__(self):
+        return self.index.size
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield CandRow(self, ii)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key in self.cols:
+                return self.cols[key]
+            if key == 'dupes_maxsnr':
+                # The brightest duplicate is the first one
+                return self.pulses['sigma'][self.cols['dupes_start']]
+            return self.pulses[key][self.index]
+        if isinstance(key, (int, np.integer)):
+            return CandRow(self, key)
+        if isinstance(key, list) and len(key) and isinstance(key[0], CandRow):
+            key = [cc.row for cc in key]
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.flatnonzero(key)
+        return CandTable(self.pulses, self.index[key],
+                         dict((name, col[key]) for name, col in self.cols.items()))
+
+    def dupes(self, attr):
+        """
+        Values of attr of the duplicates of every row: a list of arrays
+        (views of one array of the pulses)
+        """
+        values = self.pulses[attr]
+        return [values[ss:ss+nn] for ss, nn in zip(self['dupes_start'], self['dupes_count'])]
+
+    def dupes_any(self, attr, value):
+        """
+        True for the rows with a duplicate of attr equal to value
+        """
+        hits = np.r_[0, np.cumsum(self.pulses[attr] == value)]
+        start = self['dupes_start']
+        return hits[start + self['dupes_count']] - hits[start] > 0
+
+
+def as_table(cands):
+    """
+    CandTable of cands: a CandTable or a list of its CandRow
+    """
+    if isinstance(cands, CandTable):
+        return cands
+    return cands[0].table[list(cands)]
+
+
+def read_singlepulse(infile, beam):
+    """
+    Structured array (PULSE_NAMES) of the pulses of the file "infile",
+    in the format of a PRESTO *.singlepulse file, parsed at once.
+    """
+    pulses = np.zeros(0, dtype={'names': PULSE_NAMES, 'formats': PULSE_FORMATS})
+    if os.path.getsize(infile) == 0:
+        return pulses
+    values = np.loadtxt(infile, comments='#', usecols=range(5), ndmin=2)
+    pulses = np.zeros(values.shape[0], dtype=pulses.dtype)
+    for icol, name in enumerate(PULSE_NAMES[:5]):
+        pulses[name] = values[:, icol]
+    pulses['beam'] = beam
+    return pulses
+
+
+def cands_from_file(infile, beam):
+    """
+    Return the CandTable of the pulses of the file "infile".
+    Assumes this file is in the same format as a PRESTO
+    *.singlepulse file.
+    """
+    return CandTable(read_singlepulse(infile, beam))
+
+
+def cands_from_many_files(beam_nums, cands_dir):
+    """
+    Assumes all the files have the name format "beam%03d.cands"
+    and are located in cands_dir
+    """
+    pulses = [np.zeros(0, dtype={'names': PULSE_NAMES, 'formats': PULSE_FORMATS})]
+    for bnum in beam_nums:
+        sp_file = "%s/beam%04d.cands" %(cands_dir, bnum)
+        # check that file exists
+        if not os.path.isfile(sp_file):
+            sp_file = "%s/beam%03d.cands" %(cands_dir, bnum)
+            if not os.path.isfile(sp_file):
+                print("File not found: %s" %sp_file)
+                continue
+            else: pass
+        else: pass
+        pulses.append(read_singlepulse(sp_file, bnum))
+    return CandTable(np.concatenate(pulses))
+
+
+def _group_starts(*keys):
+    """
+    First row of every run of equal keys (sorted rows)
+    """
+    new = np.zeros(keys[0].size, dtype=bool)
+    new[:1] = True
+    for kk in keys:
+        new[1:] |= kk[1:] != kk[:-1]
+    return np.flatnonzero(new)
+
+
+def _pairs(lo, hi, max_pairs=MAX_PAIRS):
+    """
+    Pairs (i, j) with lo[i] <= j < hi[i], in blocks of at most max_pairs
+    pairs (at least one row)
+    """
+    counts = np.maximum(hi - lo, 0)
+    ends = np.cumsum(counts)
+    start = 0
+    while start < lo.size:
+        stop = max(start + 1, np.searchsorted(ends, ends[start] - counts[start] + max_pairs, side='right'))
+        cc = counts[start:stop]
+        ii = np.repeat(np.arange(start, stop), cc)
+        jj = np.arange(cc.sum()) - np.repeat(np.cumsum(cc) - cc, cc) + np.repeat(lo[start:stop], cc)
+        yield ii, jj
+        start = stop
+
+
+def friends_of_friends(time, dm, dt, ddm=np.inf, split=None):
+    """
+    Friends-of-friends groups of pulses: two pulses are friends when they
+    are at most dt apart in time and ddm apart in DM (and have the same
+    split value, e.g. the beam, if given).
+
+    The pulses are hashed in rows of DM cells of width ddm and sorted in
+    time within a row. In its own row, a pulse is linked to the next one in
+    time; in the next row, to all its friends, found by binary searches of
+    its time window. O(N log N) for a bounded number of friends per window.
+
+    Returns the group of every pulse, the groups numbered in time of
+    their first pulse.
+    """
+    time = np.asarray(time, dtype=float)
+    dm = np.asarray(dm, dtype=float)
+    n = time.size
+    if n == 0:
+        return np.zeros(0, dtype='int')
+    if np.isfinite(ddm):
+        row = np.floor((dm - dm.min()) / ddm).astype('int64')
+    else:
+        row = np.zeros(n, dtype='int64')
+    if split is not None:
+        # An empty row between splits: no friends across them
+        split = np.unique(split, return_inverse=True)[1].reshape(-1)
+        row = split * (row.max() + 2) + row
+    tt = time - time.min()
+    span = tt.max() + 2.0*dt + 1.0
+    order = np.lexsort((tt, row))
+    srow = row[order]
+    stt = tt[order]
+    sdm = dm[order]
+    keys = srow * span + stt
+    # Next pulse of the same row
+    nn = np.flatnonzero((srow[1:] == srow[:-1]) & (stt[1:] - stt[:-1] <= dt))
+    links_i = [nn]
+    links_j = [nn + 1]
+    # Friends in the next row
+    target = (srow + 1) * span + stt
+    lo = np.searchsorted(keys, target - dt, side='left')
+    hi = np.searchsorted(keys, target + dt, side='right')
+    for ii, jj in _pairs(lo, hi):
+        ok = (np.abs(sdm[jj] - sdm[ii]) <= ddm) & (np.abs(stt[jj] - stt[ii]) <= dt)
+        links_i.append(ii[ok])
+        links_j.append(jj[ok])
+    links_i = np.concatenate(links_i)
+    links_j = np.concatenate(links_j)
+    graph = coo_matrix((np.ones(links_i.size), (links_i, links_j)), shape=(n, n))
+    ngroup, label = connected_components(graph, directed=False)
+    # Number the groups in time
+    first = np.full(ngroup, np.inf)
+    np.minimum.at(first, label, stt)
+    rank = np.empty(ngroup, dtype='int')
+    rank[np.lexsort((np.arange(ngroup), first))] = np.arange(ngroup)
+    group = np.empty(n, dtype='int')
+    group[order] = rank[label]
+    return group
+
+
+def group_stats(sigma, dm, group):
+    """
+    Hits, best DM (DM of the brightest pulse) and max SNR of every group
+    (group ids from 0)
+    """
+    ngroup = group.max() + 1 if group.size else 0
+    nhits = np.bincount(group, minlength=ngroup)
+    order = np.lexsort((-sigma, group))
+    best = order[_group_starts(group[order])]
+    return nhits, dm[best], sigma[best]
+
+
+def find_duplicates(plist, dt, ddm):
+    """
+    Group the pulses friends of friends in time (linking length dt) and
+    DM (linking length ddm), brightest first. Returns a CandTable of all
+    the pulses sorted by group and decreasing sigma; the brightest pulse of
+    a group has nhits (the size of the group), its duplicates and
+    dupes_nbeams (number of beams of the group), the other pulses nhits = 0.
+    Every pulse has its group.
+    """
+    pulses = plist.pulses[plist.index]
+    group = friends_of_friends(pulses['time'], pulses['dm'], dt, ddm)
+    order = np.lexsort((-pulses['sigma'], group))
+    pulses = pulses[order]
+    group = group[order]
+    starts = _group_starts(group)
+    counts = np.diff(np.r_[starts, pulses.size])
+    table = CandTable(pulses)
+    table['nhits'][starts] = counts
+    table['dupes_count'][starts] = counts
+    # Beams of every group
+    border = np.lexsort((pulses['beam'], group))
+    nbeams = np.bincount(group[border][_group_starts(group[border], pulses['beam'][border])],
+                         minlength=starts.size)
+    table.cols['dupes_nbeams'] = np.zeros(pulses.size, dtype='int')
+    table.cols['dupes_nbeams'][starts] = nbeams
+    table.cols['group'] = group
+    return table
+
+
+def get_best_DM(plist, dt):
+    """
+    For pulses of the same beam friends of friends in time (linking length
+    dt), select the dm that maximizes the source sigma: returns the table
+    sorted by beam, time group and decreasing sigma, the brightest pulse of
+    every group with ndms, the number of its DMs.
+    """
+    tgroup = friends_of_friends(plist['time'], plist['dm'], dt, split=plist['beam'])
+    order = np.lexsort((-plist['sigma'], tgroup, plist['beam']))
+    ppi = plist[order]
+    tgroup = tgroup[order]
+    starts = _group_starts(tgroup)
+    ppi.cols['ndms'] = np.zeros(len(ppi), dtype='int')
+    ppi.cols['ndms'][starts] = np.diff(np.r_[starts, len(ppi)])
+    ppi.cols['tgroup'] = tgroup
+    return ppi
+
+
+def beam_coords(coords):
+    """
+    Array of the (RA, Dec) of every beam number, of an array or a dict
+    """
+    if isinstance(coords, dict):
+        out = np.zeros((max(coords) + 1, 2))
+        for bb, cc in coords.items():
+            out[bb] = cc[:2]
+        return out
+    return np.asarray(coords, dtype=float)[:, :2]
+
+
+def beam_to_radec(table, coords):
+    """
+    RA and Dec (deg) of the beam of every row: columns ra and dec.
+    coords: (RA, Dec) of every beam number (an array or a dict)
+    """
+    coords = beam_coords(coords)
+    table.cols['ra'] = coords[table['beam'], 0]
+    table.cols['dec'] = coords[table['beam'], 1]
+    return table
+
+
+def beam_separations(coords):
+    """
+    Angular separation (arcsec) of every pair of beams, from the chords
+    between their unit vectors (precise for the small separations of
+    neighbouring beams, unlike the arccos of their dot products)
+    """
+    coords = np.radians(beam_coords(coords))
+    ra, dec = coords[:, 0], coords[:, 1]
+    uvec = np.column_stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+    chord = np.sqrt(((uvec[:, None, :] - uvec[None, :, :])**2).sum(axis=2))
+    return np.degrees(2.0 * np.arcsin(np.minimum(chord / 2.0, 1.0))) * 3600.0
+
+
+def get_pdist_stats(table, coords):
+    """
+    Mean and std of the pairwise separations (arcsec) of the beams of the
+    duplicates of every row: columns dupes_dist_mean and dupes_dist_std
+    (0 for a single pulse).
+
+    Duplicates in the same beam are at distance 0: the pairs of a group are
+    counted per pair of distinct beams (weighted by their numbers of
+    duplicates), all the groups at once, in blocks of at most MAX_PAIRS
+    pairs.
+    """
+    sep = beam_separations(coords)
+    nrows = len(table)
+    start = table['dupes_start']
+    count = table['dupes_count']
+    # Beam of every duplicate of every row, and the duplicates per (row, beam)
+    row = np.repeat(np.arange(nrows), count)
+    idx = np.arange(row.size) - np.repeat(np.cumsum(count) - count, count) + np.repeat(start, count)
+    beam = table.pulses['beam'][idx]
+    order = np.lexsort((beam, row))
+    row, beam = row[order], beam[order]
+    first = _group_starts(row, beam)
+    weight = np.diff(np.r_[first, row.size]).astype(float)
+    row, beam = row[first], beam[first]
+    # Pairs of distinct beams of the same row
+    rstart = _group_starts(row)
+    rend = np.repeat(np.r_[rstart[1:], row.size], np.diff(np.r_[rstart, row.size]))
+    sum1 = np.zeros(nrows)
+    sum2 = np.zeros(nrows)
+    for ii, jj in _pairs(np.arange(row.size) + 1, rend):
+        dd = sep[beam[ii], beam[jj]]
+        ww = weight[ii] * weight[jj]
+        sum1 += np.bincount(row[ii], weights=ww*dd, minlength=nrows)
+        sum2 += np.bincount(row[ii], weights=ww*dd*dd, minlength=nrows)
+    npairs = count * (count - 1) / 2.0
+    mean = np.where(npairs > 0, sum1 / np.maximum(npairs, 1), 0.0)
+    var = np.where(npairs > 0, sum2 / np.maximum(npairs, 1), 0.0) - mean**2
+    table.cols['dupes_dist_mean'] = mean
+    table.cols['dupes_dist_std'] = np.sqrt(np.maximum(var, 0.0))
+    return table
+
+
+def filter_plist(plist, dt, hit_min=1, hit_max=10, ndms_min=1):
+    ppi = get_best_DM(plist, dt)
+    keep = (ppi['nhits'] >= hit_min) & (ppi['nhits'] <= hit_max) & (ppi['ndms'] >= ndms_min)
+    return ppi[keep]
+
+
+def add_time_allcands(cands, dt):
+    cands.pulses['time'] += dt
+    return cands
+
+
+def dm_delay(freq_lo, freq_hi, DM):
+    return 4.15e3 * (freq_lo**-2.0 - freq_hi**-2.0) * DM
+
+
+def attrarr(obj_list, attr):
+    obj_list = as_table(obj_list)
+    try:
+        return np.asarray(obj_list[attr])
+    except (KeyError, ValueError):
+        print("List has no attribute \"%s\" " %attr)
+        return
+
+
+def write_cands_save(outfile, cands):
+    """
+    Output cand info sorted by snr
+    """
+    cands = as_table(cands)
+    idx = np.argsort(cands['sigma'])
+    idx = idx[::-1]
+    table = np.column_stack([cands['time'][idx], cands['beam'][idx], cands['dm'][idx],
+                             cands['sigma'][idx]])
+    hdr = '#{:<12}{:<10}{:<10}{:<10}'.format( \
+        'Time', 'Beam', 'DM', 'SNR')
+    np.savetxt(outfile, table, fmt='%-12.3f%-10d%-10.2f%-10.2f', delimiter='',
+               header=hdr, comments='')
+    return
+
+
+def write_cands(outfile, cands):
+    """
+    Output cand info sorted by snr
+    """
+    cands = as_table(cands)
+    idx = np.argsort(cands['sigma'])
+    idx = idx[::-1]
+    table = np.column_stack([cands['time'][idx], cands['beam'][idx], cands['dm'][idx],
+                             cands['sigma'][idx], cands['nhits'][idx]])
+    hdr = '#{:<12}{:<10}{:<10}{:<10}{:<10}'.format( \
+        'Time', 'Beam', 'DM', 'SNR', 'Nhits')
+    np.savetxt(outfile, table, fmt='%-12.3f%-10d%-10.2f%-10.2f%-10d', delimiter='',
+               header=hdr, comments='')
+    return
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""
+Run SP_search_BL.py on many filterbank files.
+
+Every file is searched by its own SP_search_BL.py process, started in its
+own working directory <outdir>/<file name>, so that the runs share no
+globals, current directory or shell globs. The number of files searched at
+the same time is bounded by a CPU and a memory budget. With --ML the model
+is loaded once by a server process shared by all the runs (ml_share.py).
+A summary of the runs is printed and saved to <outdir>/batch_summary.csv.
+
+The options not known to the batch are passed to SP_search_BL.py.
+
+Example: python spandak_batch.py '/data/*.fil' --outdir /scratch/batch --cpus 32 --mem 128 --cpu --hidm 2000
+"""
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import binascii
+import tempfile
+import subprocess as sb
+from argparse import ArgumentParser
+from multiprocessing import Process
+from multiprocessing.pool import ThreadPool
+from stage_timer import count_lines
+from ml_share import serve, AUTHKEY_ENV
+
+SPANDAK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "SP_search_BL.py")
+SUMMARY_FIELDS = ['file', 'status', 'returncode', 'wall', 'candidates', 'plots', 'slowest_stage', 'log']
+
+
+def expand_files(patterns):
+    """Filterbank files of a list of names, glob patterns and @list files
+        (one name or pattern per line), without duplicates
+    """
+    files = []
+    for pattern in patterns:
+        if pattern.startswith("@"):
+            with open(pattern[1:]) as f:
+                files.extend(expand_files([line.strip() for line in f if line.strip()]))
+        else:
+            files.extend(sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern])
+    seen = set()
+    out = []
+    for fname in files:
+        fname = os.path.abspath(fname)
+        if fname not in seen:
+            seen.add(fname)
+            out.append(fname)
+    return out
+
+
+def total_memory():
+    """Physical memory in GB"""
+    return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')/1e9
+
+
+def concurrency(njobs, cpus=None, mem=None, job_cpus=1, job_mem=4.0, max_jobs=None):
+    """Number of runs at the same time within a budget of cpus CPUs and
+        mem GB of memory, each run using job_cpus CPUs and job_mem GB
+    """
+    cpus = cpus or os.cpu_count() or 1
+    mem = mem or total_memory()
+    n = min(njobs, int(cpus//max(job_cpus, 1)), int(mem//job_mem) if job_mem > 0 else njobs)
+    if max_jobs:
+        n = min(n, max_jobs)
+    return max(1, n)
+
+
+def workdir_of(outdir, fil_file):
+    return os.path.join(outdir, os.path.basename(fil_file)[:-4])
+
+
+def run_one(task):
+    """Run SP_search_BL.py on one file in its working directory"""
+    fil_file, workdir, spandak_args, env, spandak = task
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    log_file = os.path.join(workdir, "spandak.log")
+    cmd = [sys.executable, spandak, "--fil", fil_file, "--outdir", workdir] + list(spandak_args)
+    print("Starting %s" % fil_file)
+    start = time.time()
+    with open(log_file, 'w') as log:
+        returncode = sb.call(cmd, cwd=workdir, stdout=log, stderr=sb.STDOUT, env=env)
+    wall = time.time() - start
+    print("Finished %s in %.1f sec (return code %d)" % (fil_file, wall, returncode))
+    return summarize(fil_file, workdir, returncode, wall, log_file)
+
+
+def summarize(fil_file, workdir, returncode, wall, log_file=""):
+    """Summary of the run on fil_file, from the files in its working directory"""
+    slowest = ""
+    for timing_file in glob.glob(os.path.join(workdir, "*", "timing.json")):
+        with open(timing_file) as f:
+            stages = [s for s in json.load(f)['stages'] if not s['skipped']]
+        if stages:
+            stage = max(stages, key=lambda s: s['wall'])
+            slowest = "%s (%.1f sec)" % (stage['stage'], stage['wall'])
+    return {'file': fil_file,
+            'status': "ok" if returncode == 0 else "failed",
+            'returncode': returncode,
+            'wall': round(wall, 1),
+            'candidates': count_lines(glob.glob(os.path.join(workdir, "*", "FRBcand"))),
+            'plots': len(glob.glob(os.path.join(workdir, "*", "*.png"))),
+            'slowest_stage': slowest,
+            'log': log_file}
+
+
+def write_summary(rows, summary_file):
+    with open(summary_file, 'w') as f:
+        writer = csv.DictWriter(f, SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print("%-40s %-7s %9s %6s %6s  %s" % ("file", "status", "wall(s)", "cands", "plots", "slowest stage"))
+    for row in rows:
+        print("%-40s %-7s %9.1f %6d %6d  %s" % (os.path.basename(row['file']), row['status'], row['wall'],
+                                               row['candidates'], row['plots'], row['slowest_stage']))
+    print("%d files, %d failed. Summary in %s" % (len(rows), sum(r['status'] != "ok" for r in rows),
+                                                  summary_file))
+
+
+def batch(fil_files, outdir, spandak_args=(), cpus=None, mem=None, job_cpus=1, job_mem=4.0,
+          max_jobs=None, ml_models=None, spandak=SPANDAK):
+    """Search fil_files with SP_search_BL.py.
+
+        Input:
+            outdir: directory of the working directories of the files
+            spandak_args: options of SP_search_BL.py
+            cpus, mem: CPU and memory (GB) budgets (Default: the whole machine)
+            job_cpus, job_mem: CPUs and memory (GB) used by a run
+            max_jobs: maximum number of runs at the same time
+            ml_models: ML models to load once and use in all the runs
+
+        Output:
+            list of the summaries of the runs (in the order of fil_files)
+    """
+    outdir = os.path.abspath(outdir)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    spandak_args = list(spandak_args)
+    if '--cpu' in spandak_args and '--cpu_workers' not in spandak_args:
+        spandak_args += ['--cpu_workers', str(job_cpus)]
+    env = dict(os.environ)
+    server = None
+    if ml_models:
+        address = os.path.join(tempfile.gettempdir(), "spandak_ml_%d.sock" % os.getpid())
+        env[AUTHKEY_ENV] = os.environ[AUTHKEY_ENV] = binascii.hexlify(os.urandom(16)).decode()
+        server = Process(target=serve, args=(ml_models, address))
+        server.daemon = True
+        server.start()
+        spandak_args += ['--ML', ml_models[0], '--ml_server', address]
+
+    nrun = concurrency(len(fil_files), cpus, mem, job_cpus, job_mem, max_jobs)
+    print("Searching %d files, %d at a time" % (len(fil_files), nrun))
+    tasks = [(fil_file, workdir_of(outdir, fil_file), spandak_args, env, spandak) for fil_file in fil_files]
+    pool = ThreadPool(nrun)
+    try:
+        rows = pool.map(run_one, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        if server is not None:
+            server.terminate()
+            server.join()
+            if os.path.exists(address):
+                os.remove(address)
+    write_summary(rows, os.path.join(outdir, "batch_summary.csv"))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Run SP_search_BL.py on many filterbank files")
+    parser.add_argument('files', type=str, nargs='+', help="Filterbank files, glob patterns or @file_list")
+    parser.add_argument('--outdir', type=str, default=".", help="Output directory (Default: current)")
+    parser.add_argument('--cpus', type=int, default=None, help="CPU budget (Default: all CPUs)")
+    parser.add_argument('--mem', type=float, default=None, help="Memory budget in GB (Default: all memory)")
+    parser.add_argument('--job_cpus', type=int, default=1, help="CPUs used by a run (Default: 1)")
+    parser.add_argument('--job_mem', type=float, default=4.0, help="Memory used by a run in GB (Default: 4)")
+    parser.add_argument('--max_jobs', type=int, default=None, help="Maximum number of runs at the same time")
+    parser.add_argument('--ML', type=str, nargs='+', default=None, help="ML model(s), loaded once for all runs")
+    args, spandak_args = parser.parse_known_args()
+
+    rows = batch(expand_files(args.files), args.outdir, spandak_args, args.cpus, args.mem,
+                 args.job_cpus, args.job_mem, args.max_jobs, args.ML)
+    sys.exit(0 if all(r['status'] == "ok" for r in rows) else 1)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Manifest of the stages of a SPANDAK run, to skip the stages that are up
+to date when the pipeline is run again.
+
+The key of a stage is a hash of its input files (size and modification
+time), its parameters, the source of the code it runs and the outputs and
+results of the stages it depends on. A stage is up to date when the
+manifest holds the same key and its output files were not changed since.
+A new parameter thus reruns the stage that uses it and, because its
+outputs change, the stages after it.
+
+Example:
+    cache = StageCache("spandak_manifest.json")
+    mask = cache.run('rfifind', rfi, args, inputs=[fil_file], params={...},
+                     code=['rfi_filter_vg.py'], outputs=['*.mask'])
+"""
+import os
+import copy
+import glob
+import json
+import hashlib
+
+# Directory of the pipeline code (code= names are relative to it)
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def file_key(fname):
+    """Size and modification time of a file (None if it does not exist)"""
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+
+def code_hash(names):
+    """Hash of the source of the pipeline files in names"""
+    h = hashlib.sha1()
+    for name in names:
+        path = name if os.path.isabs(name) else os.path.join(CODE_DIR, name)
+        h.update(name.encode())
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+class StageCache(object):
+    def __init__(self, manifest_file, timer=None):
+        """timer: StageTimer measuring the stages that run"""
+        self.manifest_file = os.path.abspath(manifest_file)
+        self.timer = timer
+        self.manifest = {}
+        if os.path.isfile(self.manifest_file):
+            try:
+                with open(self.manifest_file) as f:
+                    self.manifest = json.load(f)
+            except ValueError:
+                print("Ignoring unreadable stage manifest %s" % self.manifest_file)
+
+    def key(self, stage, inputs=(), params=None, code=(), upstream=()):
+        """Key of a stage from its inputs, parameters, code and upstream stages"""
+        desc = {'inputs': dict((os.path.abspath(i), file_key(i)) for i in inputs),
+                'params': params or {},
+                'code': code_hash(code),
+                'upstream': dict((u, [self.manifest.get(u, {}).get('key'),
+                                      self.manifest.get(u, {}).get('outputs'),
+                                      self.manifest.get(u, {}).get('result')]) for u in upstream)}
+        return hashlib.sha1(json.dumps(desc, sort_keys=True).encode()).hexdigest()
+
+    def fresh(self, stage, key):
+        """True if the stage ran with this key and its outputs are unchanged"""
+        entry = self.manifest.get(stage)
+        if entry is None or entry.get('key') != key:
+            return False
+        return all(file_key(out) == saved for out, saved in entry.get('outputs', {}).items())
+
+    def record(self, stage, key, outputs=(), result=None):
+        """Save the key, the output files (names or glob patterns) and the
+            (JSON) result of a stage that just ran
+        """
+        files = []
+        for pattern in outputs:
+            files.extend(glob.glob(pattern) if glob.has_magic(pattern) else [pattern])
+        self.manifest[stage] = {'key': key,
+                                'outputs': dict((os.path.abspath(f), file_key(f)) for f in sorted(set(files))),
+                                'result': copy.deepcopy(result)}
+        tmp = self.manifest_file + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.manifest_file)
+
+    def result(self, stage):
+        """Saved result of a stage (a copy: changing it leaves the manifest as is)"""
+        return copy.deepcopy(self.manifest.get(stage, {}).get('result'))
+
+    def run(self, stage, func, args=(), inputs=(), params=None, code=(), upstream=(), outputs=()):
+        """Call func(*args) unless the stage is up to date. outputs is a list
+            of file names or glob patterns, or a function of the result
+            returning it.
+            Returns the result of func, or the saved result of the last run.
+        """
+        key = self.key(stage, inputs, params, code, upstream)
+        if self.fresh(stage, key):
+            print("Stage %s is up to date, skipping" % stage)
+            if self.timer is not None:
+                self.timer.skip(stage)
+            return self.result(stage)
+        print("Running stage %s" % stage)
+        if self.timer is None:
+            result = func(*args)
+        else:
+            with self.timer.stage(stage):
+                result = func(*args)
+        if callable(outputs):
+            outputs = outputs(result)
+        self.record(stage, key, outputs, result)
+        return result
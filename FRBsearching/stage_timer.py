@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Wall time, CPU time, peak memory and disk reads of the stages of a
+SPANDAK run.
+
+Every stage is measured with getrusage for the pipeline process and for
+its children (heimdall, rfifind, the python scripts and the worker
+processes it waited for). The peak RSS of the pipeline process is reset
+before each stage where the kernel allows it (/proc/self/clear_refs), so it
+is the peak of that stage; the peak RSS of the children is the largest
+child since the start of the run. Bytes read are the blocks read from disk
+(data served from the page cache is not counted).
+
+The report is written as JSON (timing.json) and can be appended as one
+line to a log shared by many runs; the command line aggregates reports.
+
+Example: python stage_timer.py run1/timing.json run2/timing.json all_runs.jsonl
+"""
+import os
+import sys
+import json
+import time
+import socket
+import resource
+from contextlib import contextmanager
+from argparse import ArgumentParser
+
+# ru_maxrss is in kB on Linux, in bytes on macOS
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _peak_rss():
+    """Peak RSS (bytes) of this process since the last reset"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])*1024
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*RSS_UNIT
+
+
+def _usage():
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    ch = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'wall': time.time(),
+            'cpu': me.ru_utime + me.ru_stime,
+            'cpu_children': ch.ru_utime + ch.ru_stime,
+            'inblock': me.ru_inblock + ch.ru_inblock,
+            'rss_children': ch.ru_maxrss*RSS_UNIT}
+
+
+class StageTimer(object):
+    def __init__(self, name=""):
+        self.name = name
+        self.start = time.time()
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the code run inside the with block as stage name"""
+        reset = _reset_peak_rss()
+        before = _usage()
+        entry = {'stage': name, 'skipped': False, 'counts': {}}
+        self.stages.append(entry)
+        try:
+            yield entry
+        finally:
+            after = _usage()
+            entry['wall'] = after['wall'] - before['wall']
+            entry['cpu'] = after['cpu'] - before['cpu']
+            entry['cpu_children'] = after['cpu_children'] - before['cpu_children']
+            entry['peak_rss'] = _peak_rss() if reset else None
+            entry['peak_rss_children'] = after['rss_children']
+            entry['bytes_read'] = (after['inblock'] - before['inblock'])*512
+
+    def skip(self, name):
+        """Record a stage that was up to date and not run"""
+        self.stages.append({'stage': name, 'skipped': True, 'counts': {}, 'wall': 0.0,
+                            'cpu': 0.0, 'cpu_children': 0.0, 'peak_rss': None,
+                            'peak_rss_children': None, 'bytes_read': 0})
+
+    def count(self, name, item, n):
+        """Add n items (candidates, plots, ...) to the last run of stage name"""
+        for entry in reversed(self.stages):
+            if entry['stage'] == name:
+                entry['counts'][item] = entry['counts'].get(item, 0) + int(n)
+                return
+
+    def report(self):
+        usage = _usage()
+        return {'name': self.name,
+                'host': socket.gethostname(),
+                'start': self.start,
+                'wall': usage['wall'] - self.start,
+                'cpu': usage['cpu'],
+                'cpu_children': usage['cpu_children'],
+                'stages': self.stages}
+
+    def write(self, timing_file, log_file=None):
+        """Write the report to timing_file and append it to log_file"""
+        report = self.report()
+        with open(timing_file, 'w') as f:
+            json.dump(report, f, indent=1)
+        if log_file:
+            with open(log_file, 'a') as f:
+                f.write(json.dumps(report) + "\n")
+        return report
+
+
+def count_lines(fnames):
+    """Number of non-empty lines of the files (e.g. candidates)"""
+    n = 0
+    for fname in fnames:
+        if os.path.isfile(fname):
+            with open(fname) as f:
+                n += sum(1 for line in f if line.strip())
+    return n
+
+
+def load_reports(fnames):
+    """Reports of timing.json files and of logs with one report per line"""
+    reports = []
+    for fname in fnames:
+        with open(fname) as f:
+            text = f.read().strip()
+        try:
+            reports.append(json.loads(text))
+        except ValueError:
+            reports.extend(json.loads(line) for line in text.splitlines() if line.strip())
+    return reports
+
+
+def aggregate(reports):
+    """Totals per stage over the reports, in the order the stages first ran.
+
+        Output:
+            list of dictionaries with stage, runs, skipped, wall, cpu,
+            cpu_children, bytes_read (sums), max_wall, peak_rss (max) and
+            counts (sums)
+    """
+    stages = {}
+    order = []
+    for report in reports:
+        for entry in report['stages']:
+            name = entry['stage']
+            if name not in stages:
+                order.append(name)
+                stages[name] = {'stage': name, 'runs': 0, 'skipped': 0, 'wall': 0.0, 'max_wall': 0.0,
+                                'cpu': 0.0, 'cpu_children': 0.0, 'bytes_read': 0, 'peak_rss': 0,
+                                'counts': {}}
+            agg = stages[name]
+            if entry['skipped']:
+                agg['skipped'] += 1
+                continue
+            agg['runs'] += 1
+            for key in ['wall', 'cpu', 'cpu_children', 'bytes_read']:
+                agg[key] += entry[key]
+            agg['max_wall'] = max(agg['max_wall'], entry['wall'])
+            agg['peak_rss'] = max(agg['peak_rss'], entry['peak_rss'] or 0, entry['peak_rss_children'] or 0)
+            for item, n in entry['counts'].items():
+                agg['counts'][item] = agg['counts'].get(item, 0) + n
+    return [stages[name] for name in order]
+
+
+def print_table(stages):
+    total = sum(s['wall'] for s in stages) or 1.0
+    print("%-14s %5s %5s %10s %6s %10s %10s %10s %10s  %s" % (
+        "stage", "runs", "skip", "wall(s)", "wall%", "cpu(s)", "child(s)", "rss(MB)", "read(MB)", "counts"))
+    for s in stages:
+        print("%-14s %5d %5d %10.2f %6.1f %10.2f %10.2f %10.1f %10.1f  %s" % (
+            s['stage'], s['runs'], s['skipped'], s['wall'], 100*s['wall']/total, s['cpu'],
+            s['cpu_children'], s['peak_rss']/1e6, s['bytes_read']/1e6,
+            " ".join("%s=%d" % kv for kv in sorted(s['counts'].items()))))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Aggregate the stage timing of SPANDAK runs")
+    parser.add_argument('reports', type=str, nargs='+', help="timing.json files or logs of --timing_log")
+    parser.add_argument('--json', type=str, default=None, help="Also write the totals to this JSON file")
+    args = parser.parse_args()
+
+    reports = load_reports(args.reports)
+    stages = aggregate(reports)
+    print("%d runs" % len(reports))
+    print_table(stages)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'runs': len(reports), 'stages': stages}, f, indent=1)
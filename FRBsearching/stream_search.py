@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+Search a filterbank file while the recorder is still writing it.
+
+The file is followed in blocks of block_time seconds. A block is searched
+(cpu_search) as soon as the file holds the block plus the dispersion sweep
+of the highest DM and the widest boxcar, so a pulse is found about one
+block after it was recorded. Candidates still growing at the end of a block
+are kept until the next block; the finished ones are appended to the
+*_all.cand file, classified as frb_detector_bl.py does and the valid ones
+are appended to FRBcand and plotted.
+
+The search stops when the file has not grown for idle_timeout seconds.
+
+Example: python stream_search.py file.fil --lodm 100 --hidm 2000 --block_time 10
+"""
+import os
+import time
+from argparse import ArgumentParser
+from multiprocessing import Pool
+import numpy as np
+from filterbank_mmap import FilterbankMmap
+from dedisperse import delay_table
+from cpu_search import dm_plan, boxcar_widths, make_cands, write_all_cands, \
+    _search_init, _search_task
+
+
+def classify(cands, snr_cut, filter_cut, members_cut, gdm):
+    """Valid candidates of cands, with the cuts of frb_detector_bl.py.
+        The RFI storm cut needs the whole observation and is not applied.
+    """
+    from frb_detector_bl import classify as classify_all
+    categories, counts, rates = classify_all(cands, gdm, snr_cut, filter_cut, members_cut=members_cut,
+                                             max_cands_per_sec=None)
+    return categories['valid']
+
+
+def append_frbcand(frbcand_file, cands):
+    """Append candidates to a FRBcand file (as printed by frb_detector_bl.py)"""
+    with open(frbcand_file, 'a') as f:
+        for c in cands[np.argsort(cands['time'], kind='stable')]:
+            f.write("%s\t%s\t%s\t%s\t%s\t%s\n" % (c['snr'], c['time'], c['samp_idx'],
+                                                  c['dm'], c['filter'], c['prim_beam']))
+
+
+def plot_cands(fil_file, cands, tint, Ttot, nchan, fl, fh, nproc, mask_file="", smooth=0.0):
+    from PlotCand import candPlotList, render_candidates
+    frb_cands = np.zeros(cands.size, dtype={'names': ('snr', 'time', 'samp_idx', 'dm', 'filter', 'prim_beam'),
+                                            'formats': ('f4', 'f4', 'i4', 'f4', 'i4', 'i4')})
+    for name in frb_cands.dtype.names:
+        frb_cands[name] = cands[name]
+    plots = candPlotList(frb_cands, fl, fh, tint, Ttot, [], nchan, smooth)
+    return render_candidates(fil_file, plots, mask_file, False, "", None, nproc)
+
+
+def follow(fil_file, dmlo, dmhi, block_time=10.0, snr_cut=10.0, boxcar_max=4096,
+           filter_cut=8, members_cut=3, gdm=6.0, nproc=None, zap_chans=None,
+           poll=1.0, idle_timeout=60.0, base_name=None, noplot=False, dm_tol=1.25,
+           detect_cut=6.0):
+    """Search fil_file block by block while it is being written.
+
+        Input:
+            block_time: length of a searched block (s)
+            snr_cut, filter_cut, members_cut, gdm: cuts of frb_detector_bl.py
+            poll: time between two looks at the size of the file (s)
+            idle_timeout: stop when the file did not grow for this long (s)
+            base_name: prefix of the output files (Default: name of the file)
+            detect_cut: SNR threshold of the search
+
+        Output:
+            structured array of all the valid candidates
+    """
+    if base_name is None:
+        base_name = os.path.basename(fil_file)[:-4]
+    all_cand_file = base_name + "_all.cand"
+    frbcand_file = "FRBcand"
+    for out in [all_cand_file, frbcand_file]:
+        open(out, 'w').close()
+
+    fil = FilterbankMmap(fil_file)
+    tsamp = fil.tsamp
+    dms = dm_plan(dmlo, dmhi, fil.freqs, tsamp, tol=dm_tol)
+    delays = delay_table(fil.freqs, tsamp, dms)
+    widths = boxcar_widths(boxcar_max)
+    maxdelay = int(delays.max())
+    block_nspec = int(round(block_time/tsamp))
+    # A candidate is final once the search went this far past its end
+    margin = 2*widths[-1]
+    nproc = nproc or os.cpu_count() or 1
+    ndm_per_task = max(1, int(np.ceil(dms.size/float(nproc))))
+    fl = fil.freqs.min()
+    fh = fil.freqs.max()
+    print("Following %s: blocks of %.1f sec, %d DM trials, sweep of %d samples"
+          % (fil_file, block_time, dms.size, maxdelay))
+
+    pool = Pool(nproc, initializer=_search_init, initargs=(fil_file, zap_chans))
+    pos = 0
+    pending = np.zeros((0, 4))
+    valid = []
+    last_growth = time.time()
+    last_nspec = fil.nspec
+    try:
+        while True:
+            nspec = fil.refresh()
+            if nspec != last_nspec:
+                last_nspec = nspec
+                last_growth = time.time()
+            finished = time.time() - last_growth > idle_timeout
+            if nspec >= pos + block_nspec + maxdelay + widths[-1]:
+                nown = block_nspec
+            elif finished and pos < nspec:
+                nown = nspec - pos
+            elif finished:
+                break
+            else:
+                time.sleep(poll)
+                continue
+
+            tasks = [(pos, nown, idm0, delays[idm0:idm0+ndm_per_task], widths, detect_cut, 'none', None)
+                     for idm0 in range(0, dms.size, ndm_per_task)]
+            points = pool.map(_search_task, tasks)
+            pos += nown
+            pending = np.concatenate([pending] + points)
+            cands, point_cand = make_cands(pending, dms, tsamp, return_labels=True)
+            if finished:
+                done = np.ones(cands.size, dtype=bool)
+            else:
+                done = cands['end'] < pos - margin
+            # Keep the points of the candidates still growing
+            pending = pending[~done[point_cand]]
+            new = cands[done]
+            if new.size:
+                write_all_cands(all_cand_file, new, 'a')
+                new_valid = classify(new, snr_cut, filter_cut, members_cut, gdm)
+                print("Block up to %.2f sec: %d candidates, %d valid" % (pos*tsamp, new.size, new_valid.size))
+                if new_valid.size:
+                    append_frbcand(frbcand_file, new_valid)
+                    valid.append(new_valid)
+                    if not noplot:
+                        plot_cands(fil_file, new_valid, tsamp, nspec*tsamp, fil.nchans, fl, fh, nproc)
+            if finished and pos >= nspec:
+                break
+    finally:
+        pool.close()
+        pool.join()
+    if valid:
+        return np.concatenate(valid)
+    return make_cands(np.zeros((0, 4)), dms, tsamp)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Search a filterbank file while it is being recorded")
+    parser.add_argument('fil_file', type=str, help="Filterbank file")
+    parser.add_argument('--lodm', type=float, default=100.0, help="Lowest DM (Default: 100)")
+    parser.add_argument('--hidm', type=float, default=2000.0, help="Highest DM (Default: 2000)")
+    parser.add_argument('--block_time', type=float, default=10.0, help="Length of a block in sec (Default: 10)")
+    parser.add_argument('--snr_cut', type=float, default=10.0, help="SNR of a valid candidate (Default: 10)")
+    parser.add_argument('--boxcar_max', type=int, default=4096, help="Widest boxcar in samples (Default: 4096)")
+    parser.add_argument('--idle_timeout', type=float, default=60.0,
+                        help="Stop when the file did not grow for this many sec (Default: 60)")
+    parser.add_argument('--nproc', type=int, default=None, help="Number of processes (Default: all CPUs)")
+    parser.add_argument('--noplot', action='store_true', help="Do not plot the candidates")
+    args = parser.parse_args()
+
+    follow(os.path.abspath(args.fil_file), args.lodm, args.hidm, args.block_time, args.snr_cut,
+           args.boxcar_max, nproc=args.nproc, idle_timeout=args.idle_timeout, noplot=args.noplot)
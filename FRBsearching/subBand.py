@@ -1,23 +1,194 @@
 #!/usr/bin/env python
 """
-Take .fil file as an input and produces given number of sub-band .fil files using bldice
+Sub-band single pulse search, for narrow-band signals lost in a search of
+the full band.
+
+The band is split into nsub sub-bands of adjacent channels. Every sub-band
+is searched with the CPU search (cpu_search.py) as a channel slice of the
+memory-mapped file (no sub-band files are written with bldice), with its
+own DM plan, the sub-bands being searched in the same process pool. The
+times of all sub-bands are referred to the top of the full band, and the
+candidates of the sub-bands overlapping in time are merged when their DMs
+agree within the DM resolution of their sub-bands. In the merged
+*_all.cand file the beam columns hold the band occupancy: nbeams is the
+number of sub-bands the pulse was found in, beam_mask has bit i set for
+sub-band i, prim_beam and beam are the (1-based) sub-band of the highest
+SNR. The frequency range of these sub-bands is also written to
+<base>_subbands.txt.
+
+Example: python subBand.py file.fil 4                 (print the sub-bands)
+         python subBand.py file.fil 4 --search --lodm 100 --hidm 2000
 """
+import os
+from argparse import ArgumentParser
+from multiprocessing import Pool
 import numpy as np
-import sys,os
-from sigpyproc.Readers import FilReader
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from filterbank_mmap import FilterbankMmap
+from dedisperse import KDM, delay_table
+from cpu_search import ALL_CAND_NAMES, ALL_CAND_FORMATS, dm_plan, boxcar_widths, make_cands, \
+    write_all_cands, _search_init, _search_task
+
+# Merged candidates: the *_all.cand columns and the frequency range of the sub-bands
+SUBBAND_CAND_NAMES = ALL_CAND_NAMES + ('flo', 'fhi')
+SUBBAND_CAND_FORMATS = ALL_CAND_FORMATS + ('f8', 'f8')
+
+
+def subband_edges(nchans, nsub):
+    """First and last+1 channel of the nsub sub-bands"""
+    edges = np.linspace(0, nchans, nsub + 1).astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def merge_subbands(cands_of_sub, band_freqs, tsamp, sweep_tol=1.0):
+    """Merge the candidates of the sub-bands overlapping in time with
+        agreeing DMs.
+
+        Input:
+            cands_of_sub: list of the candidates (ALL_CAND_NAMES) of every
+                sub-band, times at the top of the full band
+            band_freqs: (flo, fhi) of every sub-band
+            tsamp: sampling time (s)
+            sweep_tol: DM tolerance of a candidate, in DM steps sweeping its
+                boxcar width across its sub-band: narrow sub-bands measure
+                the DM coarsely
+
+        Output:
+            merged candidates (SUBBAND_CAND_NAMES), sorted by sample
+    """
+    sub = np.concatenate([np.full(c.size, i, dtype=int) for i, c in enumerate(cands_of_sub)])
+    cands = np.concatenate(cands_of_sub)
+    out = np.zeros(cands.size, dtype={'names': SUBBAND_CAND_NAMES, 'formats': SUBBAND_CAND_FORMATS})
+    if cands.size == 0:
+        return out
+    n = cands.size
+    width = np.left_shift(1, cands['filter'].astype('int64'))
+    flo, fhi = np.array(band_freqs, dtype=float).T
+    ddm = sweep_tol*width*tsamp/(KDM*(flo[sub]**-2 - fhi[sub]**-2))
+    # Pairs overlapping in time (widened by the boxcar): j starting within i
+    begin = cands['begin'] - width
+    end = cands['end'] + width
+    order = np.argsort(begin, kind='stable')
+    counts = np.searchsorted(begin[order], end[order], side='right') - np.arange(n) - 1
+    i = np.repeat(np.arange(n), counts)
+    j = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + i + 1
+    i = order[i]
+    j = order[j]
+    # ... at DMs agreeing within the resolution of both sub-bands
+    near = np.abs(cands['dm'][i] - cands['dm'][j]) <= ddm[i] + ddm[j]
+    graph = coo_matrix((np.ones(np.count_nonzero(near)), (i[near], j[near])), shape=(n, n))
+    ngroup, group = connected_components(graph, directed=False)
+
+    # Brightest candidate of every group
+    order = np.lexsort((-cands['snr'], group))
+    starts = np.flatnonzero(np.r_[True, np.diff(group[order]) != 0])
+    best = order[starts]
+    out = out[:ngroup]
+    for name in ALL_CAND_NAMES:
+        out[name] = cands[name][best]
+    out['members'] = np.bincount(group, weights=cands['members'], minlength=ngroup)
+    out['begin'] = np.minimum.reduceat(cands['begin'][order], starts)
+    out['end'] = np.maximum.reduceat(cands['end'][order], starts)
+    # Band occupancy
+    mask = np.zeros(ngroup, dtype='int64')
+    np.bitwise_or.at(mask, group, np.left_shift(1, sub))
+    out['beam_mask'] = mask
+    out['nbeams'] = sum((mask >> isub) & 1 for isub in range(sub.max() + 1))
+    out['prim_beam'] = sub[best] + 1
+    out['beam'] = sub[best] + 1
+    out['max_snr'] = out['snr']
+    out['flo'] = np.inf
+    out['fhi'] = -np.inf
+    np.minimum.at(out['flo'], group, np.array([f[0] for f in band_freqs])[sub])
+    np.maximum.at(out['fhi'], group, np.array([f[1] for f in band_freqs])[sub])
+    return out[np.argsort(out['samp_idx'], kind='stable')]
+
+
+def write_subband_cands(cand_file, cands):
+    """Write the merged candidates: the 14 *_all.cand columns plus flo and fhi"""
+    with open(cand_file, 'w') as f:
+        for c in cands:
+            f.write("%g\t%d\t%.6f\t%d\t%d\t%g\t%d\t%d\t%d\t%d\t%d\t%d\t%g\t%d\t%.4f\t%.4f\n"
+                    % tuple(c[n] for n in SUBBAND_CAND_NAMES))
+
+
+def subband_search(fil_file, dmlo, dmhi, nsub, snr_cut=6.0, boxcar_max=4096, nproc=None,
+                   chunk_nsamp=32768, ndm_per_task=64, zap_chans=None, cand_file=None,
+                   subband_file=None, pulse_width=40.0, dm_tol=1.25):
+    """Search the nsub sub-bands of fil_file for single pulses.
 
+        Input:
+            snr_cut, boxcar_max, nproc, chunk_nsamp, ndm_per_task, zap_chans:
+                as cpu_search()
+            cand_file: write the merged candidates to this *_all.cand file
+            subband_file: write them with the frequency range to this file
 
-fil_file = str(sys.argv[1]) 
-nsub = int(sys.argv[2])
+        Output:
+            merged candidates (SUBBAND_CAND_NAMES)
+    """
+    fil = FilterbankMmap(fil_file)
+    freqs = fil.freqs
+    ftop = freqs.max()
+    widths = boxcar_widths(boxcar_max)
+    nproc = nproc or os.cpu_count() or 1
+    bands = subband_edges(fil.nchans, nsub)
+    band_dms = []
+    band_freqs = []
+    tasks = []
+    for isub, (c0, c1) in enumerate(bands):
+        sub_freqs = freqs[c0:c1]
+        dms = dm_plan(dmlo, dmhi, sub_freqs, fil.tsamp, pulse_width, dm_tol)
+        # Delays from the top of the full band: times of all sub-bands agree
+        delays = delay_table(sub_freqs, fil.tsamp, dms, ref_freq=ftop)
+        band_dms.append(dms)
+        band_freqs.append((sub_freqs.min() - 0.5*abs(fil.header['foff']),
+                           sub_freqs.max() + 0.5*abs(fil.header['foff'])))
+        for start in range(0, fil.nspec, chunk_nsamp):
+            for idm0 in range(0, dms.size, ndm_per_task):
+                tasks.append((start, chunk_nsamp, idm0, delays[idm0:idm0+ndm_per_task], widths,
+                              snr_cut, 'none', (c0, c1)))
+        print("Sub-band %d: channels %d to %d, %.2f to %.2f MHz, %d DM trials"
+              % (isub, c0, c1 - 1, band_freqs[-1][0], band_freqs[-1][1], dms.size))
 
-fhdr = FilReader(fil_file)
+    pool = Pool(max(1, min(nproc, len(tasks))), initializer=_search_init,
+                initargs=(fil_file, zap_chans))
+    try:
+        points = pool.map(_search_task, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    cands_of_sub = []
+    for isub, chans in enumerate(bands):
+        sub_points = [p for p, task in zip(points, tasks) if task[7] == chans]
+        sub_points = np.concatenate(sub_points) if sub_points else np.zeros((0, 4))
+        cands_of_sub.append(make_cands(sub_points, band_dms[isub], fil.tsamp))
+    cands = merge_subbands(cands_of_sub, band_freqs, fil.tsamp)
+    print("%d candidates in %d sub-bands" % (cands.size, nsub))
+    if cand_file:
+        write_all_cands(cand_file, cands)
+    if subband_file:
+        write_subband_cands(subband_file, cands)
+    return cands
 
-chans = fhdr.header['nchans']
-fch1 = fhdr.header['fch1']
-foff = fhdr.header['foff']
 
-subsize = int(np.floor(chans/nsub))
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Sub-bands of a filterbank file, and sub-band single pulse search")
+    parser.add_argument('fil_file', type=str, help="Filterbank file")
+    parser.add_argument('nsub', type=int, help="Number of sub-bands")
+    parser.add_argument('--search', action='store_true', help="Search the sub-bands")
+    parser.add_argument('--lodm', type=float, default=100.0, help="Lowest DM (Default: 100)")
+    parser.add_argument('--hidm', type=float, default=2000.0, help="Highest DM (Default: 2000)")
+    parser.add_argument('--snr_cut', type=float, default=6.0, help="SNR threshold (Default: 6)")
+    parser.add_argument('--boxcar_max', type=int, default=4096, help="Widest boxcar in samples (Default: 4096)")
+    parser.add_argument('--nproc', type=int, default=None, help="Number of processes (Default: all CPUs)")
+    args = parser.parse_args()
 
-for i in range(nsub): 
-	print fch1+foff*i*subsize,fch1 + foff*(i+1)*subsize
-		
+    fil = FilterbankMmap(args.fil_file)
+    if not args.search:
+        for c0, c1 in subband_edges(fil.nchans, args.nsub):
+            print(fil.freqs[c0], fil.freqs[c1 - 1] + fil.header['foff'])
+    else:
+        base = os.path.basename(args.fil_file)[:-4]
+        subband_search(args.fil_file, args.lodm, args.hidm, args.nsub, args.snr_cut, args.boxcar_max,
+                       args.nproc, cand_file=base + "_all.cand", subband_file=base + "_subbands.txt")
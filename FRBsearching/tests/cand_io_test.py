@@ -0,0 +1,76 @@
+import os
+import numpy as np
+from cand_io import CAND_NAMES, CAND_FORMATS, ALL_CAND_NAMES, ALL_CAND_FORMATS, load_cands
+from cpu_search import write_all_cands
+
+
+def make_cands(n):
+    cands = np.zeros(n, dtype={'names': ALL_CAND_NAMES, 'formats': ALL_CAND_FORMATS})
+    cands['snr'] = np.linspace(6, 20, n)
+    cands['samp_idx'] = np.arange(n)*1000
+    cands['time'] = cands['samp_idx']*0.001
+    cands['filter'] = np.arange(n) % 8
+    cands['dm'] = np.linspace(100, 500, n)
+    cands['members'] = 3
+    cands['prim_beam'] = 1
+    cands['beam'] = 1
+    return cands
+
+
+class TestCandIO(object):
+    def test_round_trip_and_cache(self, tmp_path):
+        fn = str(tmp_path / "x_all.cand")
+        ref = make_cands(50)
+        write_all_cands(fn, ref)
+        cands = load_cands(fn)
+        assert os.path.isfile(fn + ".npy")
+        assert np.array_equal(cands['samp_idx'], ref['samp_idx'])
+        assert np.allclose(cands['snr'], ref['snr'], rtol=1e-5)
+        assert open(fn + ".npy.stat").read().split() == [str(os.path.getsize(fn)),
+                                                         str(os.stat(fn).st_mtime_ns)]
+        # Second read maps the cache
+        cached = load_cands(fn)
+        assert isinstance(cached, np.memmap)
+        assert np.array_equal(cached, cands)
+
+    def test_stale_cache(self, tmp_path):
+        fn = str(tmp_path / "x_all.cand")
+        write_all_cands(fn, make_cands(10))
+        load_cands(fn)
+        write_all_cands(fn, make_cands(4))
+        # Older than the cache: still stale
+        os.utime(fn, (os.path.getmtime(fn + ".npy") - 10,)*2)
+        assert load_cands(fn).size == 4
+
+    def test_same_mtime(self, tmp_path):
+        # Rewritten within the mtime resolution: the size tells
+        fn = str(tmp_path / "x_all.cand")
+        write_all_cands(fn, make_cands(10))
+        mtime_ns = os.stat(fn).st_mtime_ns
+        load_cands(fn)
+        write_all_cands(fn, make_cands(4))
+        os.utime(fn, ns=(mtime_ns, mtime_ns))
+        assert load_cands(fn).size == 4
+        # Touched, same content: parsed again
+        load_cands(fn)
+        os.utime(fn, ns=(mtime_ns + 1, mtime_ns + 1))
+        assert not isinstance(load_cands(fn), np.memmap)
+        assert isinstance(load_cands(fn), np.memmap)
+
+    def test_missing_stat(self, tmp_path):
+        fn = str(tmp_path / "x_all.cand")
+        write_all_cands(fn, make_cands(10))
+        load_cands(fn)
+        os.remove(fn + ".npy.stat")
+        assert not isinstance(load_cands(fn), np.memmap)
+        assert os.path.isfile(fn + ".npy.stat")
+
+    def test_float_ints_and_empty(self, tmp_path):
+        fn = str(tmp_path / "x.cand")
+        with open(fn, 'w') as f:
+            f.write("9.5 1.2e+04 12.0 3.0 7 56.2 4 11990 12010\n")
+        cands = load_cands(fn, CAND_NAMES, CAND_FORMATS, cache=False)
+        assert cands.size == 1 and cands['samp_idx'][0] == 12000 and cands['filter'][0] == 3
+        assert not os.path.exists(fn + ".npy")
+        open(fn, 'w').close()
+        assert load_cands(fn).size == 0
@@ -0,0 +1,72 @@
+import os
+import time
+import threading
+from cand_store import connect, cand_row, ingest, StoreWriter, frbcand_rows, plot_row, \
+    ingest_csv, query, repeaters
+
+HEADER = {'tsamp': 0.001, 'tstart': 59000.5, 'source_name': 'FRB121102', 'fch1': 1500.0,
+          'nchans': 64, 'foff': -1.0}
+
+
+class TestCandStore(object):
+    def test_stages_one_row(self, tmp_path):
+        os.chdir(str(tmp_path))
+        with open("FRBcand", 'w') as f:
+            f.write("12.5\t2.0\t2000\t557.123\t3\t1\n9.0\t5.0\t5000\t300.0\t1\t1\n")
+        with open("FRBcand_prob.txt", 'w') as f:
+            f.write("12.5\t2.0\t2000\t557.123\t3\t1\t0.97\n")
+        store = StoreWriter("cands.db")
+        store.put(frbcand_rows("FRBcand", "obs.fil", HEADER))
+        store.put(frbcand_rows("FRBcand_prob.txt", "obs.fil", HEADER))
+        csv_row = {'PNGFILE': 'A_0000_2.000sec_DM557.12.png', 'Category': 'A', 'Prob': 0.97,
+                   'T-test': '5.10', 'T-test_prob': '99.90', 'SNR': '12.5', 'WIDTH': '8.0',
+                   'DM': 557.12, 'SourceName': 'FRB121102', 'MJD': 59000.5}
+        store.put([plot_row("obs.fil", csv_row, 2.0)])
+        store.close()
+        assert store.nrows == 4
+        cands = query(connect("cands.db"))
+        assert len(cands) == 2
+        first = cands[0]
+        assert first['dm'] == 557.12 and first['samp_idx'] == 2000 and first['prob'] == 0.97
+        assert first['category'] == 'A' and first['png'] == 'A_0000_2.000sec_DM557.12.png'
+        assert abs(first['mjd'] - (59000.5 + 2.0/86400)) < 1e-9
+        assert first['source'] == 'FRB121102'
+
+    def test_queries(self, tmp_path):
+        conn = connect(str(tmp_path / "cands.db"))
+        rows = []
+        for iobs in range(200):
+            for icand in range(50):
+                dm = 557.0 + (icand % 3) if iobs % 20 == 0 and icand < 3 else 100.0 + icand*30
+                rows.append(cand_row("obs%03d.fil" % iobs, icand*1.5, dm, source="SRC%d" % (iobs % 2),
+                                     mjd=59000.0 + iobs, snr=8.0 + icand % 7))
+        ingest(conn, rows)
+        start = time.time()
+        near = query(conn, dm=557.0, dm_tol=5.0, mjd_lo=59100.0)
+        assert time.time() - start < 0.1
+        assert len(near) == 15 and all(c['mjd'] >= 59100.0 for c in near)
+        reps = repeaters(conn, dm_tol=2.0, min_bursts=2, snr_min=8.0, mjd_lo=59000.0)
+        rep = [r for r in reps if abs(r['dm'] - 558) < 3]
+        assert len(rep) == 1 and rep[0]['nobs'] == 10 and rep[0]['nbursts'] == 30
+        assert rep[0]['source'] == 'SRC0'
+
+    def test_writer_threads(self, tmp_path):
+        db = str(tmp_path / "cands.db")
+        store = StoreWriter(db, batch_size=7)
+        threads = [threading.Thread(target=lambda i=i: [store.put([cand_row("f%d.fil" % i, k, 100.0)])
+                                                         for k in range(100)]) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        store.close()
+        assert len(query(connect(db))) == 400
+
+    def test_ingest_csv(self, tmp_path):
+        conn = connect(str(tmp_path / "cands.db"))
+        example = os.path.join(os.path.dirname(__file__), "..", "example.csv")
+        n = ingest_csv(conn, example)
+        assert n > 0
+        cands = query(conn, dm=909.94, dm_tol=0.01)
+        # Plotted several times: the last category, the plots without one ignored
+        assert len(cands) == 1 and cands[0]['category'] == 'C' and cands[0]['time'] == 596.446
@@ -0,0 +1,95 @@
+import time
+import numpy as np
+from scipy.sparse.csgraph import connected_components
+from cand_io import CAND_NAMES, CAND_FORMATS, load_cands
+from heimdall_chunks import write_cands
+from coincidencer import parse_cand_name, groups, coincide, coincidencer
+
+
+def cands(rows):
+    out = np.zeros(len(rows), dtype={'names': CAND_NAMES, 'formats': CAND_FORMATS})
+    for i, (snr, samp, dm_trial, filt) in enumerate(rows):
+        out[i]['snr'] = snr
+        out[i]['samp_idx'] = out[i]['begin'] = out[i]['end'] = samp
+        out[i]['time'] = samp*0.001
+        out[i]['dm_trial'] = dm_trial
+        out[i]['dm'] = dm_trial*10.0
+        out[i]['filter'] = filt
+        out[i]['members'] = 5
+    return out
+
+
+def groups_brute(c, time_tol=0, dm_tol=3, filter_tol=2):
+    """Number of friends-of-friends groups, comparing all pairs"""
+    width = np.left_shift(1, np.maximum.outer(c['filter'], c['filter']).astype(int))
+    linked = (np.abs(np.subtract.outer(c['samp_idx'], c['samp_idx'])) <= width + time_tol) & \
+             (np.abs(np.subtract.outer(c['dm_trial'], c['dm_trial'])) <= dm_tol) & \
+             (np.abs(np.subtract.outer(c['filter'], c['filter'])) <= filter_tol)
+    return connected_components(linked, directed=False)[0]
+
+
+class TestCoincidencer(object):
+    def test_parse_name(self):
+        assert parse_cand_name("/a/2020-01-01-00:00:00_03.cand") == ("2020-01-01-00:00:00", 3)
+        assert parse_cand_name("x.cand") == ("x", 1)
+
+    def test_beams(self):
+        c = cands([(10, 1000, 50, 2), (14, 1002, 51, 3), (8, 5000, 50, 2), (9, 1001, 80, 2)])
+        out = coincide(c, np.array([1, 3, 1, 2]))
+        # Every candidate kept, with the beams of its group
+        assert out.size == 4
+        assert list(out['samp_idx']) == [1000, 1001, 1002, 5000]
+        assert list(out['snr']) == [10, 9, 14, 8]
+        assert list(out['beam']) == [1, 2, 3, 1]
+        assert list(out['beam_mask']) == [5, 2, 5, 1]
+        assert list(out['nbeams']) == [2, 1, 2, 1]
+        assert list(out['prim_beam']) == [3, 2, 3, 1]
+        assert list(out['max_snr']) == [14, 9, 14, 8]
+        assert list(out['members']) == [5, 5, 5, 5]
+
+    def test_widths(self):
+        # Both narrow pulses are inside the window of the wide one, but
+        # not next to each other: all three in one group
+        c = cands([(10, 0, 50, 4), (9, 1, 50, 2), (8, 15, 50, 2), (7, 40, 50, 2)])
+        ngroup, group = groups(c)
+        assert ngroup == groups_brute(c) == 2
+        assert group[0] == group[1] == group[2] != group[3]
+
+    def test_same_as_brute_force(self):
+        rng = np.random.RandomState(4)
+        c = cands([(rng.uniform(6, 20), rng.randint(0, 200000), rng.randint(0, 200), rng.randint(0, 6))
+                   for _ in range(1500)])
+        assert groups(c)[0] == groups_brute(c)
+        out = coincide(c, np.ones(c.size, dtype=int))
+        assert out.size == c.size
+        assert np.array_equal(np.sort(out['snr']), np.sort(c['snr']))
+        assert np.all(out['max_snr'] >= out['snr'])
+
+    def test_same_as_brute_force_widths(self):
+        # Dense wide pulses: friends far apart in the sorted rows
+        rng = np.random.RandomState(6)
+        c = cands([(rng.uniform(6, 20), rng.randint(0, 20000), rng.randint(0, 20), rng.randint(0, 10))
+                   for _ in range(1500)])
+        for tols in [(0, 3, 2), (5, 1, 0), (2, 0, 4)]:
+            assert groups(c, *tols)[0] == groups_brute(c, *tols)
+
+    def test_files(self, tmp_path):
+        write_cands(str(tmp_path / "2020-01-01-00:00:00_01.cand"), cands([(10, 1000, 50, 2)]))
+        write_cands(str(tmp_path / "2020-01-01-00:00:08_01.cand"), cands([(11, 1001, 50, 2), (9, 9000, 20, 1)]))
+        all_cand_file = coincidencer([str(p) for p in tmp_path.iterdir()])
+        assert all_cand_file == str(tmp_path / "2020-01-01-00:00:00_all.cand")
+        out = load_cands(all_cand_file, cache=False)
+        assert list(out['samp_idx']) == [1000, 1001, 9000]
+        assert list(out['max_snr']) == [11, 11, 9]
+
+    def test_speed(self):
+        rng = np.random.RandomState(5)
+        n = 300000
+        c = np.zeros(n, dtype={'names': CAND_NAMES, 'formats': CAND_FORMATS})
+        c['samp_idx'] = rng.randint(0, 10**8, n)
+        c['dm_trial'] = rng.randint(0, 1000, n)
+        c['filter'] = rng.randint(0, 12, n)
+        c['snr'] = rng.uniform(6, 20, n)
+        start = time.time()
+        coincide(c, rng.randint(1, 14, n))
+        assert time.time() - start < 10.0
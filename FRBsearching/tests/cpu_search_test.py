@@ -0,0 +1,76 @@
+import numpy as np
+from filterbank_mmap import FilterbankMmap, write_header
+from dedisperse import delay_table
+from cpu_search import cpu_search, dm_plan, boxcar_snr
+
+
+def make_pulse_fil(path, nsamp, nchan, tsamp, dm, t0, width=4, amp=3.0):
+    """8-bit noise with a dispersed pulse arriving at t0 (top of the band)"""
+    freqs = 1500.0 - np.arange(nchan)*1.0
+    rng = np.random.RandomState(1)
+    data = rng.normal(100, 10, size=(nsamp, nchan))
+    delays = delay_table(freqs, tsamp, [dm])[0]
+    for ichan in range(nchan):
+        s = int(round(t0/tsamp)) + delays[ichan]
+        data[s:s+width, ichan] += amp*10
+    with open(path, 'wb') as f:
+        write_header(f, {'source_name': 'FAKE', 'telescope_id': 9, 'machine_id': 20,
+                         'data_type': 1, 'fch1': 1500.0, 'foff': -1.0, 'nchans': nchan,
+                         'nbits': 8, 'tstart': 59000.5, 'tsamp': tsamp, 'nifs': 1})
+        np.clip(np.round(data), 0, 255).astype('uint8').tofile(f)
+
+
+class TestBoxcar(object):
+    def test_boxcar(self):
+        ts = np.zeros((1, 64), dtype='float32')
+        ts[0, 20:24] = 1.0
+        best, best_filter = boxcar_snr(ts, [1, 2, 4, 8], 40)
+        assert np.argmax(best[0]) == 20
+        assert best_filter[0, 20] == 2
+        assert np.isclose(best[0, 20], 2.0)
+
+
+class TestCpuSearch(object):
+    def test_dm_plan(self):
+        dms = dm_plan(0, 500, 1500.0 - np.arange(64)*1.0, 0.001)
+        assert dms[0] == 0 and dms[-1] >= 500
+        assert np.all(np.diff(dms) > 0)
+
+    def test_find_pulse(self, tmp_path):
+        fn = str(tmp_path / "pulse.fil")
+        make_pulse_fil(fn, 6000, 64, 0.001, 300.0, 2.5)
+        cand_file = str(tmp_path / "pulse_all.cand")
+        cands = cpu_search(fn, 100, 500, snr_cut=8.0, boxcar_max=16, nproc=2,
+                           chunk_nsamp=1500, ndm_per_task=8, cand_file=cand_file)
+        assert cands.size >= 1
+        best = cands[np.argmax(cands['snr'])]
+        assert abs(best['samp_idx'] - 2502) <= 4
+        assert abs(best['dm'] - 300.0) < 30
+        assert best['members'] > 1
+        assert len(open(cand_file).readline().split()) == 14
+
+    def test_negdm(self, tmp_path):
+        fn = str(tmp_path / "pulse.fil")
+        make_pulse_fil(fn, 6000, 64, 0.001, 300.0, 2.5)
+        # Channels in reverse order: a negative DM pulse
+        fil = FilterbankMmap(fn)
+        data = np.array(fil._data[:, ::-1])
+        neg = str(tmp_path / "negdm.fil")
+        with open(neg, 'wb') as f:
+            write_header(f, fil.header)
+            data.tofile(f)
+        flip_file = str(tmp_path / "negdm.txt")
+        cands = cpu_search(neg, 100, 500, snr_cut=8.0, boxcar_max=16, nproc=2, chunk_nsamp=1500,
+                           ndm_per_task=8, flips=['none', 'nT', 'nF', 'nTnF'], flip_file=flip_file)
+        assert set(cands['flip']) <= set(['none', 'nT', 'nF', 'nTnF'])
+        best = dict((flip, cands['snr'][cands['flip'] == flip].max() if np.any(cands['flip'] == flip) else 0)
+                    for flip in ['none', 'nT', 'nF', 'nTnF'])
+        assert best['nF'] > 20 and best['nT'] > 20
+        assert best['none'] < best['nF']/2 and best['nTnF'] < best['nF']/2
+        nf = cands[cands['flip'] == 'nF']
+        assert abs(nf['samp_idx'][np.argmax(nf['snr'])] - 2502) <= 4
+        # Reversed in time, the pulse is at the other end of the file
+        nt = cands[cands['flip'] == 'nT']
+        assert nt['samp_idx'][np.argmax(nt['snr'])] > 3000
+        line = open(flip_file).readline().split()
+        assert len(line) == 15 and line[-1] in ['none', 'nT', 'nF', 'nTnF']
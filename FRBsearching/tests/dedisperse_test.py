@@ -0,0 +1,66 @@
+import time
+import numpy as np
+from dedisperse import delay_table, dedisperse, dm_time
+
+FREQS = 1500.0 - np.arange(32)*4.0
+
+
+def rotated(block, delays, nout):
+    """Sum of the channels rotated by their delays (as Spectra.dedisperse)"""
+    return sum(np.roll(block[c], -delays[c])[:nout] for c in range(block.shape[0]))
+
+
+class TestDedisperse(object):
+    def test_naive(self):
+        block = np.random.normal(size=(16, 300)).astype('float32')
+        delays = delay_table(1500.0 - np.arange(16)*4.0, 0.001, [0, 50, 100])
+        out = dedisperse(block, delays, 100)
+        for idm in range(3):
+            ref = sum(block[c, delays[idm, c]:delays[idm, c]+100] for c in range(16))
+            assert np.allclose(out[idm], ref, atol=1e-4)
+
+    def test_dm_time(self):
+        # Slow periodic channels: a rotation off by a sample changes little
+        rng = np.random.RandomState(4)
+        phase = rng.uniform(0, 200, 32)
+        block = np.cos(2*np.pi*(np.arange(200)[np.newaxis, :] + phase[:, np.newaxis])/200).astype('float32')
+        before = block.copy()
+        # Offsets from the DM of the block, negative below it
+        ddms = np.arange(0, 60, 0.5) - 30.0
+        out = dm_time(block, FREQS, 0.001, ddms, 150)
+        assert out.shape == (ddms.size, 150)
+        assert np.array_equal(block, before)
+        assert np.allclose(out[ddms == 0][0], block.sum(axis=0)[:150], atol=1e-4)
+        delays = delay_table(FREQS, 0.001, ddms)
+        for idm in [0, 37, 119]:
+            assert np.allclose(out[idm], rotated(block, delays[idm], 150), atol=1.0)
+
+    def test_pulse(self):
+        # Pulses of 4 samples dispersed by DM +20 and -20 in a block
+        # dedispersed to DM 0: all the channels at the top of the band
+        delays = delay_table(FREQS, 0.0005, [20.0])[0]
+        ddms = np.linspace(-40, 40, 81)
+        for sign in [1, -1]:
+            block = np.zeros((32, 1000), dtype='float32')
+            for shift in range(4):
+                block[np.arange(32), 100 + sign*delays + shift] = 1.0
+            out = dm_time(block, FREQS, 0.0005, ddms)
+            idm = np.flatnonzero(ddms == sign*20.0)[0]
+            assert out[idm].max() == out.max() == 32
+            assert abs(np.argmax(out[idm]) - 100) <= 1
+            # Rotations: nothing is lost at any offset
+            assert np.allclose(out.sum(axis=1), 4*32)
+
+    def test_speed(self):
+        rng = np.random.RandomState(5)
+        block = rng.normal(size=(256, 4096)).astype('float32')
+        freqs = 1500.0 - np.arange(256)*1.0
+        ddms = np.linspace(-30, 30, 48)
+        start = time.time()
+        dm_time(block, freqs, 0.001, ddms)
+        fdmt_time = time.time() - start
+        delays = delay_table(freqs, 0.001, ddms)
+        start = time.time()
+        for idm in range(ddms.size):
+            rotated(block, delays[idm], 4096)
+        assert fdmt_time < time.time() - start
@@ -0,0 +1,76 @@
+import time
+import numpy as np
+from filterbank_mmap import FilterbankMmap, write_header
+from dedisperse import delay_table, dedisperse
+from fdmt import Fdmt, maxdt_of_dm
+
+NCHAN = 256
+TSAMP = 0.001
+FREQS = 1500.0 - np.arange(NCHAN)*1.0
+
+
+def pulse_block(delays, nsamp, t0, width=4):
+    """Pulse of width samples at t0 (top of the band) dispersed by delays"""
+    block = np.zeros((len(delays), nsamp), dtype='float32')
+    for ichan, delay in enumerate(delays):
+        block[ichan, t0+delay:t0+delay+width] = 1.0
+    return block
+
+
+class TestFdmt(object):
+    def test_brute_force(self):
+        fdmt = Fdmt(FREQS, maxdt_of_dm(FREQS, TSAMP, 300))
+        delays = delay_table(FREQS, TSAMP, fdmt.dms(TSAMP))
+        assert delays[-1].max() == fdmt.maxdt
+        block = np.random.RandomState(0).normal(size=(NCHAN, 2000)).astype('float32')
+        out = fdmt.transform(block)
+        ref = dedisperse(block, delays, 2000 - fdmt.maxdt)
+        assert out.shape == ref.shape
+        assert np.allclose(out[0], ref[0], atol=1e-3)
+        for idm in [20, 101, fdmt.maxdt]:
+            pulse = pulse_block(delays[idm], 1000, 300)
+            out = fdmt.transform(pulse)
+            ref = dedisperse(pulse, delays, 1000 - fdmt.maxdt)
+            # Every channel of the pulse is summed at its DM, within a sample of the brute force
+            assert out[idm].max() == ref[idm].max() == NCHAN
+            assert abs(np.argmax(out[idm]) - np.argmax(ref[idm])) <= 1
+            assert out.max() == NCHAN
+
+    def test_order_weights(self):
+        fdmt = Fdmt(FREQS, 60)
+        block = np.random.RandomState(1).normal(size=(NCHAN, 500)).astype('float32')
+        out = fdmt.transform(block)
+        # Channels from the bottom of the band
+        assert np.allclose(Fdmt(FREQS[::-1], 60).transform(block[::-1]), out, atol=1e-3)
+        weights = np.ones(NCHAN)
+        weights[10:20] = 0
+        zapped = block.copy()
+        zapped[10:20] = 0
+        assert np.allclose(fdmt.transform(block, weights=weights), fdmt.transform(zapped), atol=1e-3)
+        assert np.allclose(fdmt.transform(block, rows=[60, 0, 7]), out[[60, 0, 7]], atol=1e-3)
+
+    def test_chunks(self, tmp_path):
+        fdmt = Fdmt(FREQS, 60)
+        block = np.random.RandomState(2).randint(0, 255, size=(NCHAN, 3000)).astype('uint8')
+        out = fdmt.transform(block)
+        assert np.allclose(fdmt.transform(block, max_elems=fdmt.nrows*150), out, atol=1e-2)
+        fn = str(tmp_path / "x.fil")
+        with open(fn, 'wb') as f:
+            write_header(f, {'source_name': 'FAKE', 'telescope_id': 9, 'machine_id': 20,
+                             'data_type': 1, 'fch1': 1500.0, 'foff': -1.0, 'nchans': NCHAN,
+                             'nbits': 8, 'tstart': 59000.5, 'tsamp': TSAMP, 'nifs': 1})
+            block.T.tofile(f)
+        parts = list(fdmt.blocks(FilterbankMmap(fn), nout=1000))
+        assert [start for start, part in parts] == [0, 1000, 2000]
+        assert np.allclose(np.concatenate([part for start, part in parts], axis=1), out, atol=1e-2)
+
+    def test_speed(self):
+        fdmt = Fdmt(FREQS, maxdt_of_dm(FREQS, TSAMP, 300))
+        delays = delay_table(FREQS, TSAMP, fdmt.dms(TSAMP))
+        block = np.random.RandomState(3).normal(size=(NCHAN, 4096)).astype('float32')
+        start = time.time()
+        fdmt.transform(block)
+        fdmt_time = time.time() - start
+        start = time.time()
+        dedisperse(block, delays, 4096 - fdmt.maxdt)
+        assert fdmt_time < time.time() - start
@@ -0,0 +1,124 @@
+import numpy as np
+from filterbank_mmap import FilterbankMmap, read_header, write_header, unpack_bits, plan_blocks
+
+
+def make_fil(path, data, nbits, header=None):
+    """Write data given as (nsamp, nchan) to a filterbank file"""
+    hdr = {'source_name': 'FAKE', 'telescope_id': 9, 'machine_id': 20,
+           'data_type': 1, 'fch1': 1500.0, 'foff': -1.0, 'nchans': data.shape[1],
+           'nbits': nbits, 'tstart': 59000.5, 'tsamp': 0.001, 'nifs': 1}
+    if header:
+        hdr.update(header)
+    with open(path, 'wb') as f:
+        write_header(f, hdr)
+        data.tofile(f)
+    return hdr
+
+
+class TestFilterbankMmap(object):
+    def test_header_roundtrip(self, tmp_path):
+        fn = str(tmp_path / "hdr.fil")
+        hdr = make_fil(fn, np.zeros((10, 8), dtype='uint8'), 8)
+        header, size = read_header(fn)
+        for key in hdr:
+            assert header[key] == hdr[key]
+        f = FilterbankMmap(fn)
+        assert f.nspec == 10 and f.nchan == 8
+        assert np.allclose(f.freqs, 1500.0 - np.arange(8))
+
+    def test_8bit_view(self, tmp_path):
+        fn = str(tmp_path / "8bit.fil")
+        data = np.random.randint(0, 255, size=(100, 16)).astype('uint8')
+        make_fil(fn, data, 8)
+        f = FilterbankMmap(fn)
+        block = f.get_block(10, 20)
+        assert block.shape == (16, 20)
+        assert np.array_equal(block, data[10:30].T)
+        # A view of the mapped file, not a copy
+        assert np.shares_memory(block, f._data)
+
+    def test_32bit_end_of_file(self, tmp_path):
+        fn = str(tmp_path / "32bit.fil")
+        data = np.random.normal(size=(50, 4)).astype('float32')
+        make_fil(fn, data, 32)
+        f = FilterbankMmap(fn)
+        block = f.get_block(40, 20)
+        assert block.shape == (4, 10)
+        assert np.array_equal(block, data[40:].T)
+
+    def test_low_bits(self, tmp_path):
+        for nbits in [1, 2, 4]:
+            nchan = 16
+            vals = np.random.randint(0, 1 << nbits, size=(30, nchan)).astype('uint8')
+            # Pack with the first channel in the lowest bits
+            per_byte = 8 // nbits
+            packed = np.zeros((30, nchan // per_byte), dtype='uint8')
+            for ii in range(per_byte):
+                packed |= (vals[:, ii::per_byte] << (ii*nbits)).astype('uint8')
+            assert np.array_equal(unpack_bits(packed, nbits), vals)
+            fn = str(tmp_path / ("%dbit.fil" % nbits))
+            make_fil(fn, packed, nbits, {'nchans': nchan})
+            f = FilterbankMmap(fn)
+            assert f.nspec == 30
+            assert np.array_equal(f.get_block(5, 10), vals[5:15].T)
+
+    def test_loaded_block(self, tmp_path):
+        fn = str(tmp_path / "block.fil")
+        data = np.random.randint(0, 255, size=(100, 8)).astype('uint8')
+        make_fil(fn, data, 8)
+        f = FilterbankMmap(fn)
+        f.load_block(20, 50)
+        block = f.get_block(30, 10)
+        assert np.array_equal(block, data[30:40].T)
+        assert np.shares_memory(block, f._block)
+        # Outside of the loaded block: read from the mapped file
+        block = f.get_block(60, 20)
+        assert np.array_equal(block, data[60:80].T)
+        assert not np.shares_memory(block, f._block)
+
+    def test_flipped(self, tmp_path):
+        fn = str(tmp_path / "flip.fil")
+        data = np.random.randint(0, 255, size=(100, 16)).astype('uint8')
+        make_fil(fn, data, 8)
+        f = FilterbankMmap(fn)
+        expected = {'none': data, 'nT': data[::-1], 'nF': data[:, ::-1], 'nTnF': data[::-1, ::-1]}
+        for flip, ref in expected.items():
+            view = f.flipped(flip)
+            block = view.get_block(10, 20)
+            assert np.array_equal(block, ref[10:30].T)
+            assert np.shares_memory(block, f._data)
+            view.load_block(0, 50)
+            assert np.array_equal(view.get_block(5, 10), ref[5:15].T)
+            assert np.array_equal(FilterbankMmap(fn, flip).get_block(90, 20), ref[90:].T)
+        assert np.allclose(f.flipped('nF').freqs, f.freqs)
+
+        # Packed samples: the channels are flipped once unpacked
+        vals = np.random.randint(0, 4, size=(30, 16)).astype('uint8')
+        packed = np.zeros((30, 4), dtype='uint8')
+        for ii in range(4):
+            packed |= (vals[:, ii::4] << (ii*2)).astype('uint8')
+        fn = str(tmp_path / "flip2bit.fil")
+        make_fil(fn, packed, 2, {'nchans': 16})
+        view = FilterbankMmap(fn).flipped('nTnF')
+        assert np.array_equal(view.get_block(5, 10), vals[::-1, ::-1][5:15].T)
+        view.load_block(0, 30)
+        assert np.array_equal(view.get_block(5, 10), vals[::-1, ::-1][5:15].T)
+
+
+class TestPlanBlocks(object):
+    def test_merge(self):
+        windows = [(500, 100), (0, 100), (50, 100), (580, 10), (300, 10)]
+        blocks = plan_blocks(windows, 1000)
+        assert [(b[0], b[1]) for b in blocks] == [(0, 150), (300, 10), (500, 100)]
+        assert blocks[0][2] == [1, 2]
+        assert sorted(blocks[2][2]) == [0, 3]
+
+    def test_max_nspec(self):
+        windows = [(0, 100), (50, 100), (100, 100), (0, 500)]
+        blocks = plan_blocks(windows, 200)
+        for start, nspec, indices in blocks:
+            for ii in indices:
+                assert start <= windows[ii][0]
+                assert windows[ii][0] + windows[ii][1] <= start + nspec
+        assert sorted(sum([b[2] for b in blocks], [])) == [0, 1, 2, 3]
+        assert max(b[1] for b in blocks if len(b[2]) > 1) <= 200
@@ -0,0 +1,102 @@
+import time
+import numpy as np
+import io
+from frb_detector_bl import Classifier, TextOutput, ALL_CANDS_DTYPE, load_all_cands, classify
+from cpu_search import write_all_cands
+from multibeam import BeamLayout
+
+
+def rate_loop(classifier, cands, is_noise, epoch, min_time, max_time, event_time=8.0):
+    """Rate around one epoch, as the former per-candidate loop computed it"""
+    half_time = event_time / 2.0
+    new_time = 0
+    if (epoch - half_time) < min_time:
+        new_time += (epoch - min_time)
+    else:
+        new_time += half_time
+    if (epoch + half_time) > max_time:
+        new_time += (max_time - epoch)
+    else:
+        new_time += half_time
+    half_time = new_time / 2.0
+    is_not_adjacent = (is_noise == False) & classifier.is_not_adjacent(cands, epoch, half_time)
+    is_valid = (is_noise == False) & (is_not_adjacent == False)
+    return float(np.count_nonzero(is_valid)) / new_time
+
+
+class TestRfiStorm(object):
+    def test_same_as_loop(self):
+        rng = np.random.RandomState(3)
+        cands = np.zeros(3000, dtype={'names': ('time', 'members'), 'formats': ('f8', 'i4')})
+        # Background and a storm between 40 and 45 sec
+        cands['time'] = np.concatenate([rng.uniform(0, 100, 2000), rng.uniform(40, 45, 1000)])
+        cands['members'] = rng.randint(1, 10, cands.size)
+        classifier = Classifier(6)
+        is_noise = classifier.is_noise(cands)
+        min_time, max_time = classifier.min_time(cands), classifier.max_time(cands)
+        epochs = np.concatenate([cands['time'][:200], [min_time, max_time, 42.0]])
+        rates = classifier.cands_per_sec(np.sort(cands['time'][is_noise == False]), epochs,
+                                         min_time, max_time)
+        ref = [rate_loop(classifier, cands, is_noise, e, min_time, max_time) for e in epochs[:-3]]
+        assert np.allclose(rates[:-3], ref)
+        assert rates[-1] > 5*np.median(rates)
+
+    def test_speed(self):
+        times = np.sort(np.random.uniform(0, 3600, 2000000))
+        start = time.time()
+        rates = Classifier(6).cands_per_sec(times, times, times[0], times[-1])
+        assert rates.size == times.size
+        assert time.time() - start < 5.0
+
+
+class TestClassify(object):
+    def make_cands(self):
+        cands = np.zeros(6, dtype=ALL_CANDS_DTYPE)
+        cands['snr'] = [12, 5, 15, 11, 20, 13]
+        cands['time'] = [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+        cands['samp_idx'] = cands['time']*1000
+        cands['dm'] = [300, 300, 2, 300, 300, 300]
+        cands['filter'] = [2, 2, 2, 10, 2, 2]
+        cands['members'] = [5, 5, 5, 5, 1, 5]
+        cands['prim_beam'] = cands['beam'] = 1
+        return cands
+
+    def test_categories(self, tmp_path):
+        fn = str(tmp_path / "x_all.cand")
+        write_all_cands(fn, self.make_cands())
+        all_cands = load_all_cands([fn])
+        assert list(all_cands['prim_beam']) == [0]*6
+        categories, counts, rates = classify(all_cands, gdm=6, snr_cut=10, max_cands_per_sec=2)
+        assert list(categories['valid']['time']) == [1.0, 6.0]
+        assert counts == {'loaded': 6, 'hidden': 2, 'noise': 1, 'galactic': 1, 'valid': 2, 'rfi_storm': 0}
+        assert rates[1].size == 2
+        # A low enough rate cut flags them as an RFI storm
+        categories, counts, rates = classify(all_cands, gdm=6, snr_cut=10, max_cands_per_sec=0.1)
+        assert counts['valid'] == 0 and counts['rfi_storm'] == 2
+
+    def test_text(self):
+        categories, counts, rates = classify(self.make_cands(), gdm=6, max_cands_per_sec=None)
+        out = io.StringIO()
+        TextOutput().print_text(categories, out)
+        assert out.getvalue() == "12.0\t1.0\t1000\t300.0\t2\t2\n13.0\t6.0\t6000\t300.0\t2\t2\n"
+        out = io.StringIO()
+        TextOutput().print_summary(counts, rates, 2.0, out)
+        assert "2 as valid FRB candidates" in out.getvalue()
+
+    def test_layout(self):
+        cands = self.make_cands()
+        # Candidate at 6 sec seen in beams 1 and 3, not neighbours
+        cands['beam_mask'] = [1, 1, 1, 1, 1, 5]
+        layout = BeamLayout([(0, 0), (1, 0), (2, 0)], 1.1)
+        categories, counts, rates = classify(cands, gdm=6, max_cands_per_sec=None, layout=layout)
+        assert list(categories['valid']['time']) == [1.0]
+        assert counts['coinc'] == 1
+
+    def test_wide_layout(self):
+        cands = self.make_cands()
+        # Candidate at 6 sec seen in beams 15 and 31 of a line of 32 beams
+        cands['beam_mask'] = [1, 1, 1, 1, 1, (1 << 14) | (1 << 30)]
+        layout = BeamLayout([(ibeam, 0) for ibeam in range(32)], 1.1)
+        categories, counts, rates = classify(cands, gdm=6, max_cands_per_sec=None, layout=layout)
+        assert list(categories['valid']['time']) == [1.0]
+        assert counts['coinc'] == 1
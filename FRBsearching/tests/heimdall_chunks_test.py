@@ -0,0 +1,89 @@
+import os
+import sys
+import stat
+import numpy as np
+from filterbank_mmap import write_header
+from heimdall_chunks import heimdall_chunked, plan_chunks, read_cands
+
+# Stand-in for heimdall: reports every run of non-zero samples of the
+# first channel as a candidate (snr = length of the run) and logs its calls.
+FAKE_HEIMDALL = r'''#!%s
+import os, sys
+sys.path.insert(0, %r)
+import numpy as np
+from filterbank_mmap import FilterbankMmap
+args = sys.argv[1:]
+fil_file = args[args.index('-f') + 1]
+outdir = args[args.index('-output_dir') + 1]
+fil = FilterbankMmap(fil_file)
+with open(os.environ['FAKE_HEIMDALL_LOG'], 'a') as f:
+    f.write("%%d\n" %% fil.nspec)
+if os.path.exists(os.environ['FAKE_HEIMDALL_FAIL']) and fil.nspec < 1000:
+    sys.exit(1)
+ts = fil.get_block(0, fil.nspec)[0] > 0
+edges = np.diff(np.concatenate([[0], ts.astype(int), [0]]))
+starts = np.where(edges == 1)[0]
+stops = np.where(edges == -1)[0]
+with open(os.path.join(outdir, "2020-01-01-00:00:00_01.cand"), 'w') as f:
+    for b, e in zip(starts, stops):
+        filt = int(np.ceil(np.log2(e - b)))
+        f.write("%%d\t%%d\t%%f\t%%d\t10\t100.0\t5\t%%d\t%%d\n" %% (e - b, b, b*fil.tsamp, filt, b, e - 1))
+'''
+
+
+def make_setup(tmp_path, data):
+    fn = str(tmp_path / "obs.fil")
+    with open(fn, 'wb') as f:
+        write_header(f, {'source_name': 'FAKE', 'telescope_id': 9, 'machine_id': 20,
+                         'data_type': 1, 'fch1': 1500.0, 'foff': -1.0, 'nchans': data.shape[1],
+                         'nbits': 8, 'tstart': 59000.5, 'tsamp': 0.001, 'nifs': 1})
+        data.tofile(f)
+    heimdall = str(tmp_path / "heimdall")
+    srcdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(heimdall, 'w') as f:
+        f.write(FAKE_HEIMDALL % (sys.executable, srcdir))
+    os.chmod(heimdall, os.stat(heimdall).st_mode | stat.S_IEXEC)
+    os.environ['FAKE_HEIMDALL_LOG'] = str(tmp_path / "calls")
+    os.environ['FAKE_HEIMDALL_FAIL'] = str(tmp_path / "fail")
+    return fn, heimdall
+
+
+def ncalls(tmp_path):
+    return len(open(str(tmp_path / "calls")).read().split())
+
+
+class TestHeimdallChunks(object):
+    def test_plan(self):
+        chunks = plan_chunks(1050, 300, 40)
+        assert [c[2:] for c in chunks] == [(0, 300), (300, 600), (600, 900), (900, 1050)]
+        assert chunks[0][:2] == (0, 340)
+        assert chunks[-1][:2] == (900, 150)
+
+    def test_merge(self, tmp_path):
+        data = np.zeros((2500, 8), dtype='uint8')
+        pulses = {100: 1, 999: 1, 1500: 4, 1990: 20}
+        for samp, width in pulses.items():
+            data[samp:samp+width, 0] = 100
+        fn, heimdall = make_setup(tmp_path, data)
+        # 1 sec chunks, the 1990 pulse crosses the boundary at 2000
+        cand_file = heimdall_chunked(fn, "-dm 0 10", str(tmp_path), 10.0, 16, 1.0,
+                                     nworkers=2, heimdall=heimdall)
+        cands = read_cands(cand_file)
+        assert sorted(cands['samp_idx']) == sorted(pulses)
+        assert cands['snr'][cands['samp_idx'] == 1990][0] == 20
+        assert np.allclose(cands['time'], cands['samp_idx']*0.001)
+
+    def test_resume(self, tmp_path):
+        data = np.zeros((2500, 8), dtype='uint8')
+        data[2200, 0] = 100
+        fn, heimdall = make_setup(tmp_path, data)
+        # The last (short) chunk fails on every try
+        open(str(tmp_path / "fail"), 'w').close()
+        assert heimdall_chunked(fn, "", str(tmp_path), 10.0, 16, 1.0,
+                                heimdall=heimdall, ntries=2) is None
+        assert ncalls(tmp_path) == 2 + 2
+        os.remove(str(tmp_path / "fail"))
+        cand_file = heimdall_chunked(fn, "", str(tmp_path), 10.0, 16, 1.0, heimdall=heimdall)
+        # Only the failed chunk is searched again
+        assert ncalls(tmp_path) == 2 + 2 + 1
+        assert list(read_cands(cand_file)['samp_idx']) == [2200]
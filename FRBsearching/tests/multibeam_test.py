@@ -0,0 +1,79 @@
+import time
+import numpy as np
+from cand_io import CAND_NAMES, CAND_FORMATS
+import multibeam
+from multibeam import popcount, BeamLayout, coincide_beams, is_coinc_rfi, join
+
+
+def cands(rows):
+    out = np.zeros(len(rows), dtype={'names': CAND_NAMES, 'formats': CAND_FORMATS})
+    for i, (snr, samp, dm_trial, filt) in enumerate(rows):
+        out[i]['snr'] = snr
+        out[i]['samp_idx'] = out[i]['begin'] = out[i]['end'] = samp
+        out[i]['dm_trial'] = dm_trial
+        out[i]['filter'] = filt
+        out[i]['members'] = 5
+    return out
+
+
+class TestMultibeam(object):
+    def test_popcount(self):
+        masks = np.array([0, 1, 7, 1 << 40 | 5, (1 << 62) - 1])
+        assert list(popcount(masks)) == [0, 1, 3, 3, 62]
+
+    def test_layout(self, tmp_path):
+        # Beams 1 to 4 on a line, 1 apart
+        fn = str(tmp_path / "beams.txt")
+        with open(fn, 'w') as f:
+            f.write("1 0 0\n2 1 0\n3 2 0\n4 3 0\n")
+        layout = BeamLayout.from_file(fn, 1.1)
+        assert list(layout.neighbours) == [3, 7, 14, 12]
+        assert list(layout.is_connected([1, 3, 7, 15, 5, 9, 13])) == \
+            [True, True, True, True, False, False, False]
+        assert BeamLayout(nbeams=4).is_connected([9]).all()
+
+    def test_coincide(self):
+        beam1 = cands([(10, 1000, 50, 2), (8, 9000, 20, 1)])
+        beam2 = cands([(14, 1002, 51, 3)])
+        beam3 = cands([(9, 1001, 80, 2), (7, 8999, 21, 1)])
+        out = coincide_beams([beam1, beam2, beam3])
+        assert list(out['samp_idx']) == [1000, 1001, 1002, 8999, 9000]
+        assert list(out['beam']) == [1, 3, 2, 3, 1]
+        assert list(out['beam_mask']) == [3, 4, 3, 5, 5]
+        assert list(out['nbeams']) == [2, 1, 2, 2, 2]
+        assert list(out['prim_beam']) == [2, 3, 2, 1, 1]
+        assert list(out['max_snr']) == [14, 9, 14, 8, 8]
+        layout = BeamLayout([(0, 0), (1, 0), (2, 0)], 1.1)
+        assert list(is_coinc_rfi(out, layout, nbeams_cut=4)) == [False, False, False, True, True]
+
+    def test_join(self, monkeypatch):
+        rng = np.random.RandomState(4)
+        samp = np.sort(rng.randint(0, 20000, 3000))
+        idm = rng.randint(0, 50, 3000)
+        filt = rng.randint(0, 4, 3000)
+        filt[::500] = 11
+        near = (np.abs(samp[:, None] - samp[None, :]) <= (1 << np.maximum(filt[:, None], filt[None, :])) + 2) & \
+            (np.abs(idm[:, None] - idm[None, :]) <= 3)
+        monkeypatch.setattr(multibeam, 'MAX_PAIRS', 5000)
+        pairs = list(join(samp, idm, filt, time_tol=2))
+        assert len(pairs) > 1
+        i = np.concatenate([ii for ii, jj in pairs])
+        j = np.concatenate([jj for ii, jj in pairs])
+        assert np.all(np.diff(i) >= 0)
+        assert sorted(zip(i, j)) == sorted(zip(*np.nonzero(near)))
+
+    def test_speed(self):
+        rng = np.random.RandomState(6)
+        beams = []
+        for ibeam in range(32):
+            n = 30000
+            c = np.zeros(n, dtype={'names': CAND_NAMES, 'formats': CAND_FORMATS})
+            c['samp_idx'] = rng.randint(0, 10**8, n)
+            c['dm_trial'] = rng.randint(0, 1000, n)
+            c['filter'] = rng.randint(0, 12, n)
+            c['snr'] = rng.uniform(6, 20, n)
+            beams.append(c)
+        start = time.time()
+        out = coincide_beams(beams)
+        assert out.size == 32*30000 and out['nbeams'].min() >= 1
+        assert time.time() - start < 20.0
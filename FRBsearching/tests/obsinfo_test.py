@@ -0,0 +1,53 @@
+import os
+import numpy as np
+import obsinfo
+from filterbank_mmap import write_header
+from obsinfo import obs_info, base_name, dead_channels
+
+
+def make_fil(path, data, tstart=59000.123456789):
+    with open(path, 'wb') as f:
+        write_header(f, {'source_name': 'FRB 121102', 'telescope_id': 9, 'machine_id': 20,
+                         'data_type': 1, 'fch1': 1500.0, 'foff': -1.0, 'nchans': data.shape[1],
+                         'nbits': 8, 'tstart': tstart, 'tsamp': 0.001, 'nifs': 1})
+        data.tofile(f)
+
+
+class TestObsInfo(object):
+    def test_header(self, tmp_path):
+        fn = str(tmp_path / "obs.fil")
+        make_fil(fn, np.zeros((1000, 16), dtype='uint8'))
+        info = obs_info(fn)
+        assert info['nspec'] == 1000 and info['nchans'] == 16
+        assert np.isclose(info['tobs'], 1.0)
+        assert info['fh'] == 1500.0 and info['fl'] == 1485.0
+        assert base_name(info) == ('FRB_121102', '59000_1234', 'FRB_121102_59000_1234')
+        assert os.path.isfile(fn + ".obsinfo.json")
+
+    def test_stats_and_cache(self, tmp_path, monkeypatch):
+        fn = str(tmp_path / "obs.fil")
+        data = np.random.randint(1, 255, size=(3000, 16)).astype('uint8')
+        data[:, 3] = 0
+        make_fil(fn, data)
+        # Blocks of 1000 spectra, medians of every other spectrum
+        monkeypatch.setattr(obsinfo, 'STATS_BLOCK_BYTES', 1000*16*4)
+        monkeypatch.setattr(obsinfo, 'MEDIAN_SPECTRA', 500)
+        info = obs_info(fn, stats=True)
+        assert np.allclose(info['mean'], data.mean(axis=0))
+        assert np.allclose(info['std'], data.std(axis=0))
+        assert np.allclose(info['median'], np.median([np.median(data[i:i+1000:2], axis=0)
+                                                      for i in range(0, 3000, 1000)], axis=0))
+        assert info['zero_frac'][3] == 1.0
+        assert dead_channels(info) == [3]
+
+        # Second call: from the sidecar, without reading the data
+        calls = []
+        monkeypatch.setattr(obsinfo, 'scan_stats', lambda fil: calls.append(fil))
+        assert np.allclose(obs_info(fn, stats=True)['mean'], info['mean'])
+        assert not calls
+
+        # A changed file is scanned again
+        monkeypatch.undo()
+        make_fil(fn, data[:2000])
+        os.utime(fn, (0, 12345))
+        assert obs_info(fn, stats=True)['nspec'] == 2000
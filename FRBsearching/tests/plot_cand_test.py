@@ -0,0 +1,125 @@
+import os
+import sys
+import types
+import importlib
+import numpy as np
+import pandas as pd
+import pytest
+from filterbank_mmap import FilterbankMmap, write_header
+
+NCHAN = 32
+NSPEC = 20000
+TSAMP = 0.001
+
+
+def cutout_window(rawdatafile, start, duration, dm=None, nbins=None):
+    nbins = int(round(duration/rawdatafile.tsamp))
+    return int(round(start/rawdatafile.tsamp)), nbins, nbins
+
+
+def waterfall(rawdatafile, start, duration, dm=None, **kwargs):
+    """Window of the candidate, which must be inside the block of the task"""
+    if dm < 0:
+        raise ValueError("negative DM")
+    start_bin, nbinsextra, nbins = cutout_window(rawdatafile, start, duration, dm)
+    block_start = rawdatafile._block_start
+    assert block_start <= start_bin and start_bin + nbinsextra <= block_start + rawdatafile._block.shape[0]
+    data = rawdatafile.get_block(start_bin, nbinsextra)
+    return data, nbinsextra, nbins, start, rawdatafile.header['source_name']
+
+
+def plot_waterfall(data, start, source_name, duration, dm, ofile, **kwargs):
+    with open(ofile, 'w') as f:
+        f.write("%d spectra" % data.shape[1])
+    # One line per plot, from all the workers
+    with open("plots.log", 'a') as f:
+        f.write(ofile + "\n")
+    return ofile, 1.0, 0.5
+
+
+def cand_csv_row(rawdatafile, fn, ofile, ttest, ttestprob, snr, width, dm, prob):
+    return pd.DataFrame({'PNGFILE': [ofile], 'DM': [dm]})
+
+
+def append_csv(csv_file, df):
+    df.to_csv(csv_file, mode='a', header=False, index=False)
+
+
+@pytest.fixture
+def plot_cand(monkeypatch):
+    """PlotCand with the presto/psrchive based modules stubbed"""
+    wf = types.ModuleType('waterfaller_vg')
+    wf.FilterbankMmap = FilterbankMmap
+    for func in [cutout_window, waterfall, plot_waterfall, cand_csv_row, append_csv]:
+        setattr(wf, func.__name__, func)
+    sigpyproc = types.ModuleType('sigpyproc')
+    sigpyproc.readers = types.ModuleType('sigpyproc.readers')
+    sigpyproc.readers.FilReader = None
+    for name, module in [('waterfaller_vg', wf), ('psrchive', types.ModuleType('psrchive')),
+                         ('sigpyproc', sigpyproc), ('sigpyproc.readers', sigpyproc.readers),
+                         ('sigpyproc.Readers', sigpyproc.readers)]:
+        monkeypatch.setitem(sys.modules, name, module)
+    monkeypatch.delitem(sys.modules, 'PlotCand', raising=False)
+    yield importlib.import_module('PlotCand'), wf
+    sys.modules.pop('PlotCand', None)
+
+
+def make_fil8(path):
+    rng = np.random.RandomState(7)
+    with open(path, 'wb') as f:
+        write_header(f, {'source_name': 'FAKE', 'telescope_id': 9, 'machine_id': 20,
+                         'data_type': 1, 'fch1': 1500.0, 'foff': -1.0, 'nchans': NCHAN,
+                         'nbits': 8, 'tstart': 59000.5, 'tsamp': TSAMP, 'nifs': 1})
+        rng.randint(0, 255, size=(NSPEC, NCHAN)).astype('uint8').tofile(f)
+
+
+def make_cands(times, duration=0.2):
+    return [{'candname': '%04d_%.3fsec_DM100.00.png' % (ii, tt), 'time': tt, 'stime': tt,
+             'TotDisplay': duration, 'dm': 100.0, 'fbin': 8, 'downfact': 1, 'smooth_bins': 1,
+             'snr': '10.0', 'width': '1.0', 'prob': None} for ii, tt in enumerate(times)]
+
+
+class TestPlanCandBlocks(object):
+    def test_sub_windows(self, plot_cand, tmp_path):
+        PlotCand, wf = plot_cand
+        fn = str(tmp_path / "x.fil")
+        make_fil8(fn)
+        # One block of 6 overlapping windows, one window on its own
+        cands = make_cands([1.0, 1.05, 1.1, 1.15, 1.2, 1.25, 15.0])
+        plan = PlotCand.planCandBlocks(fn, cands, 3)
+        assert sorted(indx for start, nspec, indexed in plan for indx, cand in indexed) == list(range(7))
+        assert [(start, nspec) for start, nspec, indexed in plan] == [(1000, 300), (1150, 300), (15000, 200)]
+        # Every task reads the windows of its own candidates only
+        for start, nspec, indexed in plan:
+            for indx, cand in indexed:
+                assert start <= int(cand['stime']/TSAMP) and int(cand['stime']/TSAMP) + 200 <= start + nspec
+        plan = PlotCand.planCandBlocks(fn, cands, 1)
+        assert [(start, nspec) for start, nspec, indexed in plan] == [(1000, 450), (15000, 200)]
+
+
+class TestRenderCandidates(object):
+    def test_render(self, plot_cand, tmp_path, monkeypatch, capfd):
+        PlotCand, wf = plot_cand
+        monkeypatch.chdir(tmp_path)
+        fn = str(tmp_path / "x.fil")
+        make_fil8(fn)
+        cands = make_cands([1.0, 1.05, 1.1, 1.15, 1.2, 1.25, 15.0, 5.0])
+        # Failure of a worker on one candidate
+        cands[4]['dm'] = -1.0
+        nplot = PlotCand.render_candidates(fn, cands, csv_file="plots.csv", nproc=3)
+        assert nplot == 7
+        plotted = [c['candname'] for ii, c in enumerate(cands) if ii != 4]
+        # Every plot made once, by the worker holding its window
+        assert sorted(open("plots.log").read().split()) == sorted(plotted)
+        for name in plotted:
+            assert open(name).read() == "200 spectra"
+        assert not os.path.exists(cands[4]['candname'])
+        # CSV rows in candidate order
+        assert list(pd.read_csv("plots.csv", header=None)[0]) == plotted
+        out = capfd.readouterr().out
+        assert "ERROR plotting %s: negative DM" % cands[4]['candname'] in out
+        assert "1 of 8 candidates not plotted" in out
+
+    def test_no_cands(self, plot_cand):
+        PlotCand, wf = plot_cand
+        assert PlotCand.render_candidates("missing.fil", []) == 0
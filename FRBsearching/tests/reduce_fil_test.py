@@ -0,0 +1,121 @@
+import os
+import time
+import threading
+import pytest
+import numpy as np
+from filterbank_mmap import FilterbankMmap, write_header
+from reduce_fil import reduce_fil, start_reduce, OUT_MEAN, OUT_RMS
+
+
+def make_fil32(path, nsamp, nchan):
+    rng = np.random.RandomState(3)
+    means = np.linspace(1e4, 5e4, nchan)
+    rms = np.linspace(100, 900, nchan)
+    data = (rng.normal(size=(nsamp, nchan))*rms + means).astype('float32')
+    with open(path, 'wb') as f:
+        write_header(f, {'source_name': 'FAKE', 'telescope_id': 9, 'machine_id': 20,
+                         'data_type': 1, 'fch1': 1500.0, 'foff': -1.0, 'nchans': nchan,
+                         'nbits': 32, 'tstart': 59000.5, 'tsamp': 0.001, 'nifs': 1})
+        data.tofile(f)
+    return data
+
+
+class TestReduceFil(object):
+    def test_32_to_8bit_collapse(self, tmp_path):
+        fn = str(tmp_path / "in.fil")
+        data = make_fil32(fn, 5000, 16)
+        out = str(tmp_path / "out.fil")
+        assert reduce_fil(fn, out, fcollapse=2, qlen=2000, nthreads=3, chunk_nspec=700) == 5000
+        red = FilterbankMmap(out)
+        assert red.nbits == 8 and red.nchans == 8 and red.nspec == 5000
+        assert red.header['foff'] == -2.0 and red.header['fch1'] == 1499.5
+        block = red.get_block(0, 5000).astype(float)
+        assert np.all(np.abs(block.mean(axis=1) - OUT_MEAN) < 2)
+        assert np.all(np.abs(block.std(axis=1) - OUT_RMS) < 1)
+        summed = data.reshape(5000, 8, 2).sum(axis=2).T
+        for ichan in range(8):
+            assert np.corrcoef(summed[ichan], block[ichan])[0, 1] > 0.99
+
+    def test_fifo(self, tmp_path):
+        fn = str(tmp_path / "in.fil")
+        make_fil32(fn, 3000, 8)
+        out = str(tmp_path / "out.fil")
+        fifo = str(tmp_path / "pipe")
+        os.mkfifo(fifo)
+        received = []
+        reader = threading.Thread(target=lambda: received.append(open(fifo, 'rb').read()))
+        reader.start()
+        reduce_fil(fn, out, fifo=fifo, chunk_nspec=500)
+        reader.join()
+        assert received[0] == open(out, 'rb').read()
+
+    def test_fifo_reader_exits(self, tmp_path):
+        fn = str(tmp_path / "in.fil")
+        make_fil32(fn, 20000, 16)
+        full = str(tmp_path / "full.fil")
+        reduce_fil(fn, full, chunk_nspec=500)
+        out = str(tmp_path / "out.fil")
+        fifo = str(tmp_path / "pipe")
+        os.mkfifo(fifo)
+
+        def read_some():
+            with open(fifo, 'rb') as f:
+                f.read(1000)
+        reader = threading.Thread(target=read_some)
+        reader.start()
+        reducer = start_reduce(fn, out, fifo=fifo)
+        reader.join()
+        reducer.finish(timeout=10)
+        # More than a pipe buffer is left after the reader exits
+        assert reducer.error is None and reducer.nspec == 20000
+        assert open(out, 'rb').read() == open(full, 'rb').read()
+
+    def test_fifo_no_reader(self, tmp_path):
+        # The search exited before opening the pipe
+        fn = str(tmp_path / "in.fil")
+        make_fil32(fn, 20000, 16)
+        fifo = str(tmp_path / "pipe")
+        os.mkfifo(fifo)
+        out = str(tmp_path / "out.fil")
+        reducer = start_reduce(fn, out, fifo=fifo)
+        reducer.close_fifo()
+        reducer.finish(timeout=10)
+        assert reducer.error is None
+        full = str(tmp_path / "full.fil")
+        reduce_fil(fn, full)
+        assert open(out, 'rb').read() == open(full, 'rb').read()
+
+    def test_fifo_late_reader(self, tmp_path):
+        fn = str(tmp_path / "in.fil")
+        make_fil32(fn, 20000, 16)
+        fifo = str(tmp_path / "pipe")
+        os.mkfifo(fifo)
+        out = str(tmp_path / "out.fil")
+        reducer = start_reduce(fn, out, fifo=fifo)
+        # The file is written before anything reads the pipe
+        time.sleep(1.0)
+        assert os.path.getsize(out) > 20000*16 and reducer.feeder.pos == 0
+        with open(fifo, 'rb') as f:
+            received = f.read()
+        reducer.finish(timeout=10)
+        assert reducer.error is None and received == open(out, 'rb').read()
+
+    def test_fifo_stuck_reader(self, tmp_path):
+        fn = str(tmp_path / "in.fil")
+        make_fil32(fn, 20000, 16)
+        fifo = str(tmp_path / "pipe")
+        os.mkfifo(fifo)
+        reducer = start_reduce(fn, str(tmp_path / "out.fil"), fifo=fifo)
+        # Opened and never read
+        fd = os.open(fifo, os.O_RDONLY)
+        try:
+            with pytest.raises(RuntimeError):
+                reducer.finish(timeout=1, poll=0.1)
+            assert reducer.error is not None
+        finally:
+            os.close(fd)
+
+    def test_thread_error(self, tmp_path):
+        reducer = start_reduce(str(tmp_path / "missing.fil"), str(tmp_path / "out.fil"))
+        reducer.join()
+        assert reducer.error is not None
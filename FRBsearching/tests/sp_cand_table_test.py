@@ -0,0 +1,159 @@
+import os
+import sys
+import time
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'robert_sp'))
+from sp_cand_table import PULSE_NAMES, PULSE_FORMATS, CandTable, cands_from_file, find_duplicates, \
+    filter_plist, write_cands, read_singlepulse, friends_of_friends, group_stats, get_best_DM, \
+    beam_to_radec, beam_separations, get_pdist_stats
+
+SINGLEPULSE = """# DM      Sigma      Time (s)     Sample    Downfact
+   0.00    7.50      1.000100        10001       3
+ 100.00    9.00      1.000200        10002       3
+ 101.00   12.00      1.000300        10003       6
+ 100.50    6.00      5.000000        50000       1
+ 400.00    8.00      1.000400        10004       2
+"""
+
+
+def write_singlepulse(tmp_path):
+    fn = str(tmp_path / "All_cand.singlepulse")
+    with open(fn, 'w') as f:
+        f.write(SINGLEPULSE)
+    return fn
+
+
+class TestCandTable(object):
+    def test_read(self, tmp_path):
+        cands = cands_from_file(write_singlepulse(tmp_path), 2)
+        assert len(cands) == 5
+        assert list(cands['sample']) == [10001, 10002, 10003, 50000, 10004]
+        assert list(cands['beam']) == [2]*5
+        assert cands[2].dm == 101.0 and cands[2].dfact == 6
+        empty = str(tmp_path / "empty.singlepulse")
+        open(empty, 'w').close()
+        assert read_singlepulse(empty, 0).size == 0
+
+    def test_duplicates(self, tmp_path):
+        cands = find_duplicates(cands_from_file(write_singlepulse(tmp_path), 0), 0.1, 1000.0)
+        heads = cands[cands['nhits'] > 0]
+        # Brightest pulse of every (time, DM) bin first
+        assert list(heads['sigma']) == [12.0, 6.0]
+        assert list(heads['nhits']) == [4, 1]
+        assert sorted(heads[0].dupes_dms) == [0.0, 100.0, 101.0, 400.0]
+        assert list(heads['dupes_maxsnr']) == [12.0, 6.0]
+        assert list(heads['dupes_nbeams']) == [1, 1]
+        assert list(heads.dupes_any('dm', 0.0)) == [True, False]
+        assert [len(dd) for dd in heads.dupes('sigma')] == [4, 1]
+
+    def test_nbeams(self):
+        pulses = np.array([(100.0, 8.0, 1.0, 1000, 1, 1),
+                        (100.0, 9.0, 1.0, 1000, 1, 3),
+                        (101.0, 7.0, 1.0, 1000, 1, 3)],
+                       dtype={'names': PULSE_NAMES, 'formats': PULSE_FORMATS})
+        cands = find_duplicates(CandTable(pulses), 0.1, 1000.0)
+        assert cands[0].sigma == 9.0
+        assert cands[0].dupes_nbeams == 2
+        assert sorted(cands[0].dupes_beams) == [1, 3, 3]
+
+    def test_filter(self, tmp_path):
+        cands = find_duplicates(cands_from_file(write_singlepulse(tmp_path), 0), 0.1, 1000.0)
+        kept = filter_plist(cands, 0.1, hit_min=1, hit_max=3)
+        assert list(kept['sigma']) == [6.0]
+        # Subsets of rows are tables too
+        assert list(cands[[cands[0], cands[1]]]['sigma']) == list(cands['sigma'][:2])
+
+    def test_write(self, tmp_path):
+        cands = find_duplicates(cands_from_file(write_singlepulse(tmp_path), 0), 0.1, 1000.0)
+        fn = str(tmp_path / "cands.txt")
+        write_cands(fn, cands[cands['nhits'] > 0])
+        lines = open(fn).read().splitlines()
+        assert lines[0] == "#Time        Beam      DM        SNR       Nhits     "
+        assert lines[1] == "1.000       0         101.00    12.00     4         "
+        assert len(lines) == 3
+
+
+
+def brute_groups(tt, dm, dt, ddm):
+    """Friends of friends of all the pairs of pulses"""
+    ii, jj = np.nonzero((np.abs(tt[:, None] - tt[None, :]) <= dt) & (np.abs(dm[:, None] - dm[None, :]) <= ddm))
+    return connected_components(coo_matrix((np.ones(ii.size), (ii, jj)), shape=(tt.size, tt.size)))[1]
+
+
+def same_partition(aa, bb):
+    pairs = set(zip(aa, bb))
+    return len(pairs) == len(set(aa)) == len(set(bb))
+
+
+class TestFriendsOfFriends(object):
+    def test_brute_force(self):
+        rng = np.random.RandomState(5)
+        for ddm in [2.0, 10.0, np.inf]:
+            tt = rng.uniform(0, 20, 800)
+            dm = rng.uniform(0, 100, 800)
+            group = friends_of_friends(tt, dm, 0.05, ddm)
+            assert same_partition(group, brute_groups(tt, dm, 0.05, ddm))
+
+    def test_bin_edge(self):
+        # A sweep across the 1 sec bin edge is one group
+        tt = np.array([0.98, 0.99, 1.0, 1.01, 1.02, 3.0])
+        dm = np.array([100.0, 101.0, 102.0, 103.0, 104.0, 100.0])
+        group = friends_of_friends(tt, dm, 0.015, 1.5)
+        assert list(group) == [0, 0, 0, 0, 0, 1]
+        nhits, best_dm, max_snr = group_stats(np.array([5.0, 6, 9, 7, 6, 8]), dm, group)
+        assert list(nhits) == [5, 1]
+        assert list(best_dm) == [102.0, 100.0]
+        assert list(max_snr) == [9.0, 8.0]
+
+    def test_beams(self):
+        pulses = np.array([(100.0, 8.0, 1.0, 1000, 1, 1),
+                           (200.0, 9.0, 1.0, 1000, 1, 1),
+                           (100.0, 7.0, 1.0, 1000, 1, 2)],
+                          dtype={'names': PULSE_NAMES, 'formats': PULSE_FORMATS})
+        ppi = get_best_DM(CandTable(pulses), 0.1)
+        assert list(ppi['ndms']) == [2, 0, 1]
+        assert list(ppi['dm']) == [200.0, 100.0, 100.0]
+
+    def test_speed(self):
+        rng = np.random.RandomState(1)
+        tt = rng.uniform(0, 600, 200000)
+        dm = rng.uniform(0, 1000, 200000)
+        start = time.time()
+        group = friends_of_friends(tt, dm, 0.01, 5.0)
+        assert group.size == tt.size
+        assert time.time() - start < 10.0
+
+
+class TestPdistStats(object):
+    def test_pairs(self):
+        rng = np.random.RandomState(2)
+        coords = np.column_stack([rng.uniform(10, 10.2, 20), rng.uniform(40, 40.2, 20)])
+        pulses = np.zeros(300, dtype={'names': PULSE_NAMES, 'formats': PULSE_FORMATS})
+        pulses['time'] = rng.randint(0, 30, 300) + 0.5
+        pulses['sigma'] = rng.uniform(6, 20, 300)
+        pulses['beam'] = rng.randint(0, 20, 300)
+        table = get_pdist_stats(find_duplicates(CandTable(pulses), 0.1, 1000.0), coords)
+        sep = beam_separations(coords)
+        heads = table[table['nhits'] > 0]
+        for cand, mean, std in zip(heads, heads['dupes_dist_mean'], heads['dupes_dist_std']):
+            beams = cand.dupes_beams
+            ii, jj = np.triu_indices(len(beams), 1)
+            dd = sep[np.array(beams)[ii], np.array(beams)[jj]]
+            assert np.isclose(mean, np.mean(dd) if dd.size else 0.0)
+            assert np.isclose(std, np.std(dd) if dd.size else 0.0, atol=1e-6)
+        assert np.all(table['dupes_dist_mean'][table['nhits'] == 0] == 0)
+
+    def test_separation(self):
+        # 1 deg apart along the equator and along a meridian, 1 deg of RA at Dec 60
+        sep = beam_separations({1: (10.0, 0.0), 2: (11.0, 0.0), 3: (10.0, 1.0)})
+        assert np.allclose(sep[1:, 1:], [[0, 3600, 3600], [3600, 0, 5091.0], [3600, 5091.0, 0]], atol=0.1)
+        assert np.isclose(beam_separations([(0.0, 60.0), (1.0, 60.0)])[0, 1], 1800.0, rtol=1e-3)
+
+    def test_radec(self):
+        pulses = np.zeros(2, dtype={'names': PULSE_NAMES, 'formats': PULSE_FORMATS})
+        pulses['beam'] = [2, 1]
+        table = beam_to_radec(CandTable(pulses), {1: (10.0, 20.0), 2: (11.0, 21.0)})
+        assert list(table['ra']) == [11.0, 10.0]
+        assert list(table['dec']) == [21.0, 20.0]
@@ -0,0 +1,57 @@
+import os
+import csv
+from spandak_batch import expand_files, concurrency, batch
+
+# Stands for SP_search_BL.py: writes two candidates and a plot, fails on bad.fil
+FAKE_SPANDAK = '''
+import os, sys, json
+fil = sys.argv[sys.argv.index("--fil") + 1]
+outdir = sys.argv[sys.argv.index("--outdir") + 1]
+assert os.getcwd() == outdir
+if fil.endswith("bad.fil"):
+    sys.exit(3)
+obsdir = os.path.join(outdir, "src_59000_0000")
+os.mkdir(obsdir)
+with open(os.path.join(obsdir, "FRBcand"), "w") as f:
+    f.write("10 1.0 1000 500 4 0\\n12 2.0 2000 500 4 0\\n")
+open(os.path.join(obsdir, "cand.png"), "w").close()
+with open(os.path.join(obsdir, "timing.json"), "w") as f:
+    json.dump({"stages": [{"stage": "search", "wall": 2.0, "skipped": False},
+                          {"stage": "plot", "wall": 1.0, "skipped": False}]}, f)
+with open(os.path.join(outdir, "args"), "w") as f:
+    f.write(" ".join(sys.argv[1:]))
+'''
+
+
+class TestBatch(object):
+    def test_expand_files(self, tmp_path):
+        for name in ["a.fil", "b.fil", "c.fil"]:
+            open(str(tmp_path / name), 'w').close()
+        with open(str(tmp_path / "list.txt"), 'w') as f:
+            f.write("%s\n\n%s\n" % (tmp_path / "c.fil", tmp_path / "a.fil"))
+        files = expand_files([str(tmp_path / "*.fil"), "@" + str(tmp_path / "list.txt")])
+        assert [os.path.basename(f) for f in files] == ["a.fil", "b.fil", "c.fil"]
+
+    def test_concurrency(self):
+        assert concurrency(100, cpus=32, mem=64, job_cpus=4, job_mem=4) == 8
+        assert concurrency(100, cpus=32, mem=10, job_cpus=4, job_mem=4) == 2
+        assert concurrency(3, cpus=32, mem=64) == 3
+        assert concurrency(10, cpus=32, mem=64, max_jobs=2) == 2
+        assert concurrency(10, cpus=1, mem=1, job_cpus=4, job_mem=8) == 1
+
+    def test_batch(self, tmp_path):
+        fake = str(tmp_path / "fake_spandak.py")
+        with open(fake, 'w') as f:
+            f.write(FAKE_SPANDAK)
+        files = [str(tmp_path / name) for name in ["obs1.fil", "bad.fil", "obs2.fil"]]
+        outdir = str(tmp_path / "out")
+        rows = batch(files, outdir, ["--cpu", "--hidm", "2000"], cpus=4, mem=8, job_cpus=2,
+                     spandak=fake)
+        assert [r['file'] for r in rows] == files
+        assert [r['status'] for r in rows] == ["ok", "failed", "ok"]
+        assert rows[0]['candidates'] == 2 and rows[0]['plots'] == 1
+        assert rows[0]['slowest_stage'] == "search (2.0 sec)"
+        with open(os.path.join(outdir, "obs1", "args")) as f:
+            assert f.read().endswith("--cpu --hidm 2000 --cpu_workers 2")
+        with open(os.path.join(outdir, "batch_summary.csv")) as f:
+            assert [r['status'] for r in csv.DictReader(f)] == ["ok", "failed", "ok"]
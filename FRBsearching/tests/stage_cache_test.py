@@ -0,0 +1,75 @@
+import os
+from stage_cache import StageCache
+
+
+class Pipeline(object):
+    """Two stages: 'mask' writes a mask from the data, 'search' reads it"""
+    def __init__(self, tmp_path):
+        self.dir = str(tmp_path)
+        self.data = os.path.join(self.dir, "obs.fil")
+        self.mask = os.path.join(self.dir, "obs.mask")
+        self.cands = os.path.join(self.dir, "obs.cand")
+        with open(self.data, 'w') as f:
+            f.write("data")
+        self.calls = []
+
+    def make_mask(self, frac):
+        self.calls.append('mask')
+        with open(self.mask, 'w') as f:
+            f.write("mask %s" % frac)
+        return self.mask
+
+    def search(self, dmhi):
+        self.calls.append('search')
+        with open(self.cands, 'w') as f:
+            f.write("cands %s" % dmhi)
+        return dmhi
+
+    def run(self, frac=0.3, dmhi=1000):
+        cache = StageCache(os.path.join(self.dir, "manifest.json"))
+        mask = cache.run('mask', self.make_mask, (frac,), inputs=[self.data], params={'frac': frac},
+                         outputs=lambda m: [m])
+        cache.run('search', self.search, (dmhi,), inputs=[self.data, mask], params={'dmhi': dmhi},
+                  upstream=['mask'], outputs=[os.path.join(self.dir, "*.cand")])
+        return mask
+
+
+class TestStageCache(object):
+    def test_skip(self, tmp_path):
+        p = Pipeline(tmp_path)
+        p.run()
+        assert p.calls == ['mask', 'search']
+        assert p.run() == p.mask
+        assert p.calls == ['mask', 'search']
+
+    def test_param_change(self, tmp_path):
+        p = Pipeline(tmp_path)
+        p.run()
+        p.run(dmhi=2000)
+        assert p.calls == ['mask', 'search', 'search']
+        p.run(frac=0.5, dmhi=2000)
+        assert p.calls == ['mask', 'search', 'search', 'mask', 'search']
+
+    def test_changed_output(self, tmp_path):
+        p = Pipeline(tmp_path)
+        p.run()
+        with open(p.cands, 'a') as f:
+            f.write(" edited")
+        p.run()
+        assert p.calls == ['mask', 'search', 'search']
+        os.remove(p.mask)
+        p.run()
+        assert p.calls == ['mask', 'search', 'search', 'mask', 'search']
+
+    def test_result_copy(self, tmp_path):
+        manifest = str(tmp_path / "manifest.json")
+        cache = StageCache(manifest)
+        ranges = cache.run('rfifind', lambda: ['1 1'], params={'frac': 0.3})
+        ranges.append('5 5')
+        cached = cache.run('rfifind', lambda: ['2 2'], params={'frac': 0.3})
+        assert cached == ['1 1']
+        cached.append('5 5')
+        cache.record('search', cache.key('search', upstream=['rfifind']))
+        # Changing a result does not change the manifest, nor the later keys
+        assert StageCache(manifest).result('rfifind') == ['1 1']
+        assert StageCache(manifest).run('rfifind', lambda: ['2 2'], params={'frac': 0.3}) == ['1 1']
@@ -0,0 +1,50 @@
+import os
+import sys
+import json
+import subprocess
+import numpy as np
+from stage_cache import StageCache
+from stage_timer import StageTimer, load_reports, aggregate
+
+
+class TestStageTimer(object):
+    def test_stage(self, tmp_path):
+        timer = StageTimer("obs.fil")
+        with timer.stage('search'):
+            data = np.ones(10000000)
+            data.sum()
+            subprocess.check_call([sys.executable, "-c", "sum(range(3000000))"])
+        timer.count('search', 'candidates', 12)
+        timer.count('search', 'candidates', 3)
+        entry = timer.stages[0]
+        assert entry['stage'] == 'search' and entry['counts'] == {'candidates': 15}
+        assert entry['wall'] >= entry['cpu'] > 0
+        assert entry['cpu_children'] > 0
+        if entry['peak_rss'] is not None:
+            assert entry['peak_rss'] > data.nbytes
+
+        report = timer.write(str(tmp_path / "timing.json"), str(tmp_path / "runs.jsonl"))
+        with open(str(tmp_path / "timing.json")) as f:
+            assert json.load(f)['stages'][0]['counts'] == {'candidates': 15}
+        assert report['name'] == "obs.fil"
+
+    def test_cache_and_aggregate(self, tmp_path):
+        log = str(tmp_path / "runs.jsonl")
+        manifest = str(tmp_path / "manifest.json")
+        for run in range(2):
+            timer = StageTimer()
+            cache = StageCache(manifest, timer)
+            cache.run('rfifind', lambda: 1, params={'time': 2.0})
+            cache.run('search', lambda: 2, params={'run': run}, upstream=['rfifind'])
+            timer.count('search', 'candidates', 10)
+            timer.write(str(tmp_path / ("timing%d.json" % run)), log)
+        assert [s['skipped'] for s in timer.stages] == [True, False]
+
+        for reports in [load_reports([log]),
+                        load_reports([str(tmp_path / "timing0.json"), str(tmp_path / "timing1.json")])]:
+            assert len(reports) == 2
+            stages = aggregate(reports)
+            assert [s['stage'] for s in stages] == ['rfifind', 'search']
+            assert stages[0]['runs'] == 1 and stages[0]['skipped'] == 1
+            assert stages[1]['runs'] == 2 and stages[1]['counts'] == {'candidates': 20}
+        assert os.path.isfile(manifest)
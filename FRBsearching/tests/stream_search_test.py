@@ -0,0 +1,52 @@
+import os
+import time
+from multiprocessing import Process
+import numpy as np
+from filterbank_mmap import write_header
+from dedisperse import delay_table
+from stream_search import follow
+
+
+def writer(fn, nblocks, block_nsamp, nchan, tsamp, dm, pulse_samps, pause):
+    """Record a file block by block, like a recorder, with dispersed pulses"""
+    freqs = 1500.0 - np.arange(nchan)*1.0
+    rng = np.random.RandomState(2)
+    data = rng.normal(100, 10, size=(nblocks*block_nsamp, nchan))
+    delays = delay_table(freqs, tsamp, [dm])[0]
+    for samp in pulse_samps:
+        for ichan in range(nchan):
+            data[samp+delays[ichan]:samp+delays[ichan]+4, ichan] += 40
+    data = np.clip(np.round(data), 0, 255).astype('uint8')
+    with open(fn, 'wb') as f:
+        write_header(f, {'source_name': 'FAKE', 'telescope_id': 9, 'machine_id': 20,
+                         'data_type': 1, 'fch1': 1500.0, 'foff': -1.0, 'nchans': nchan,
+                         'nbits': 8, 'tstart': 59000.5, 'tsamp': tsamp, 'nifs': 1})
+        f.flush()
+        for iblock in range(nblocks):
+            data[iblock*block_nsamp:(iblock+1)*block_nsamp].tofile(f)
+            f.flush()
+            time.sleep(pause)
+
+
+class TestFollow(object):
+    def test_growing_file(self, tmp_path):
+        fn = str(tmp_path / "growing.fil")
+        # Pulses in the first and the last block, and one across two blocks
+        pulses = [300, 1998, 3600]
+        p = Process(target=writer, args=(fn, 8, 500, 32, 0.001, 200.0, pulses, 0.2))
+        p.start()
+        while not os.path.exists(fn) or os.path.getsize(fn) < 400:
+            time.sleep(0.01)
+        cwd = os.getcwd()
+        os.chdir(str(tmp_path))
+        try:
+            valid = follow(fn, 150, 250, block_time=0.5, snr_cut=8.0, boxcar_max=8,
+                           nproc=1, poll=0.05, idle_timeout=1.0, noplot=True)
+        finally:
+            os.chdir(cwd)
+            p.join()
+        found = np.sort(valid['samp_idx'])
+        assert len(found) == len(pulses)
+        assert np.all(np.abs(found - np.array(pulses) - 2) <= 4)
+        lines = open(str(tmp_path / "FRBcand")).read().split("\n")
+        assert len([l for l in lines if l]) == len(pulses)
@@ -0,0 +1,76 @@
+import numpy as np
+from filterbank_mmap import write_header
+from dedisperse import delay_table
+from cpu_search import ALL_CAND_NAMES, ALL_CAND_FORMATS
+from subBand import subband_edges, merge_subbands, subband_search
+
+
+def make_narrow_fil(path, nsamp, nchan, tsamp, dm, t0, chans, amp=6.0):
+    """8-bit noise with a dispersed pulse in the channels chans only"""
+    freqs = 1500.0 - np.arange(nchan)*1.0
+    rng = np.random.RandomState(2)
+    data = rng.normal(100, 10, size=(nsamp, nchan))
+    delays = delay_table(freqs, tsamp, [dm])[0]
+    for ichan in range(*chans):
+        s = int(round(t0/tsamp)) + delays[ichan]
+        data[s:s+4, ichan] += amp*10
+    with open(path, 'wb') as f:
+        write_header(f, {'source_name': 'FAKE', 'telescope_id': 9, 'machine_id': 20,
+                         'data_type': 1, 'fch1': 1500.0, 'foff': -1.0, 'nchans': nchan,
+                         'nbits': 8, 'tstart': 59000.5, 'tsamp': tsamp, 'nifs': 1})
+        np.clip(np.round(data), 0, 255).astype('uint8').tofile(f)
+
+
+def cands(rows):
+    out = np.zeros(len(rows), dtype={'names': ALL_CAND_NAMES, 'formats': ALL_CAND_FORMATS})
+    for i, row in enumerate(rows):
+        snr, samp, filt = row[:3]
+        out[i]['dm'] = row[3] if len(row) > 3 else 300.0
+        out[i]['snr'] = snr
+        out[i]['samp_idx'] = out[i]['begin'] = out[i]['end'] = samp
+        out[i]['filter'] = filt
+        out[i]['members'] = 2
+    return out
+
+
+class TestSubBand(object):
+    def test_edges(self):
+        assert subband_edges(10, 3) == [(0, 3), (3, 6), (6, 10)]
+
+    def test_merge(self):
+        merged = merge_subbands([cands([(8, 100, 2), (7, 500, 0)]), cands([(12, 102, 1)]),
+                                 cands([(9, 103, 0), (6, 900, 0)])],
+                                [(1400, 1500), (1300, 1400), (1200, 1300)], 0.001)
+        assert list(merged['samp_idx']) == [102, 500, 900]
+        first = merged[0]
+        assert first['snr'] == 12 and first['nbeams'] == 3 and first['beam_mask'] == 7
+        assert first['prim_beam'] == 2 and first['members'] == 6
+        assert first['flo'] == 1200 and first['fhi'] == 1500
+        assert (first['begin'], first['end']) == (100, 103)
+        assert merged[1]['beam_mask'] == 1 and merged[2]['beam_mask'] == 4
+
+    def test_merge_dm(self):
+        # A 4 sample boxcar sweeps 14.7 DM units across 1400-1500 MHz at 1 ms
+        bands = [(1400, 1500), (1300, 1400)]
+        merged = merge_subbands([cands([(8, 100, 2, 300.0)]), cands([(9, 101, 2, 310.0)])], bands, 0.001)
+        assert list(merged['beam_mask']) == [3]
+        merged = merge_subbands([cands([(8, 100, 2, 300.0)]), cands([(9, 101, 2, 340.0)])], bands, 0.001)
+        assert list(merged['beam_mask']) == [1, 2]
+        # RFI at DM 0 of a sub-band and a pulse in the other
+        merged = merge_subbands([cands([(8, 100, 5, 0.0)]), cands([(9, 104, 2, 300.0), (7, 102, 2, 5.0)])],
+                                bands, 0.001, sweep_tol=0.5)
+        assert sorted(merged['beam_mask']) == [2, 3]
+
+    def test_narrow_band_pulse(self, tmp_path):
+        fn = str(tmp_path / "narrow.fil")
+        # Pulse in the third quarter of the band
+        make_narrow_fil(fn, 6000, 64, 0.001, 300.0, 2.0, (32, 48))
+        subband_file = str(tmp_path / "narrow_subbands.txt")
+        found = subband_search(fn, 100, 500, 4, snr_cut=8.0, boxcar_max=16, nproc=2,
+                               chunk_nsamp=1500, ndm_per_task=8, subband_file=subband_file)
+        best = found[np.argmax(found['snr'])]
+        assert best['prim_beam'] == 3 and best['beam_mask'] & 4
+        assert abs(best['samp_idx'] - 2002) <= 4
+        assert abs(best['dm'] - 300.0) < 60
+        assert best['flo'] == 1452.5 and best['fhi'] == 1468.5
+        assert len(open(subband_file).readline().split()) == 16
@@ -2,6 +2,8 @@
 
 import sys
 import numpy as np
+from cand_io import load_cands
+from multibeam import popcount
 
 MAX_DM = 4000
 
@@ -34,10 +36,7 @@ class Classifier(object):
         return cand['filter'] >= self.filter_max
     
     def count_nbeams(self, mask):
-        n = 0
-        for i in range(self.nbeams):
-            n += (mask & (1<<i)) > 0
-        return n
+        return popcount(mask & ((1<<self.nbeams) - 1))
             
     def is_coinc_rfi(self, cand):
         nbeams = self.count_nbeams(cand['beam_mask'] & self.beam_mask)
@@ -379,16 +378,15 @@ if __name__ == "__main__":
     
     # Load candidates from all_candidates file
     all_cands = \
-        np.loadtxt(filename,
-                   dtype={'names': ('snr','samp_idx','time','filter',
-                                    'dm_trial','dm','members','begin','end',
-                                    'nbeams','beam_mask','prim_beam',
-                                    'max_snr','beam'),
-                          'formats': ('f4', 'i4', 'f4', 'i4',
-                                      'i4', 'f4', 'i4', 'i4', 'i4',
-                                      'i4', 'i4', 'i4',
-                                      'f4', 'i4')},
-                   skiprows=skip_rows)
+        load_cands(filename)[skip_rows:].astype(
+                   {'names': ('snr','samp_idx','time','filter',
+                              'dm_trial','dm','members','begin','end',
+                              'nbeams','beam_mask','prim_beam',
+                              'max_snr','beam'),
+                    'formats': ('f4', 'i4', 'f4', 'i4',
+                                'i4', 'f4', 'i4', 'i4', 'i4',
+                                'i4', 'i4', 'i4',
+                                'f4', 'i4')})
 
     # Adjust for 0-based indexing
     all_cands['prim_beam'] -= 1
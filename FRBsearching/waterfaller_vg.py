@@ -27,11 +27,14 @@ from presto import rfifind
 
 from presto import psrfits
 from presto import filterbank
+from filterbank_mmap import FilterbankMmap
+from dedisperse import dm_time
 #import spectra
 from scipy import stats
 import pandas as pd
 import os
 import re
+import fcntl
 
 SWEEP_STYLES = ['r-', 'b-', 'g-', 'm-', 'c-']
 
@@ -59,8 +62,19 @@ def get_mask(rfimask, startsamp, N):
         mask[blocknums==blocknum] = blockmask
     return mask.T
         
+_RFIMASKS = {}
+
+def load_rfimask(maskfn):
+    """Return the rfifind object for maskfn, reading the mask only once
+        per process. Long-lived plotting workers call this for every
+        candidate so the mask is not re-parsed each time.
+    """
+    if maskfn not in _RFIMASKS:
+        _RFIMASKS[maskfn] = rfifind.rfifind(maskfn)
+    return _RFIMASKS[maskfn]
+
 def maskfile(maskfn, data, start_bin, nbinsextra):
-    rfimask = rfifind.rfifind(maskfn) 
+    rfimask = load_rfimask(maskfn)
     mask = get_mask(rfimask, start_bin, nbinsextra)[::-1]
     masked_chans = mask.all(axis=1)
     # Mask data
@@ -81,6 +95,36 @@ def zap_channels(data, flag_chans):
     new_data = data.masked(mask,maskval=0)
     return new_data
 
+def cutout_window(rawdatafile, start, duration, dm=None, nbins=None):
+    """
+    Samples of the raw data read in by waterfall().
+    Inputs:
+       rawdatafile - a PsrfitsData/FilterbankFile instance.
+       start - start time of the data to be read in for waterfalling.
+       duration - duration of data to be waterfalled.
+       dm - DM to use when dedispersing data.
+       nbins - Number of time bins to plot.
+    Outputs:
+       start_bin - first sample to read.
+       nbinsextra - number of time bins to read, including the dispersion sweep.
+       nbins - number of bins in duration.
+    """
+    start_bin = np.round(start/rawdatafile.tsamp).astype('int')
+    dmfac = 4.15e3 * np.abs(1./rawdatafile.frequencies[0]**2 - 1./rawdatafile.frequencies[-1]**2)
+
+    if nbins is None:
+        nbins = np.round(duration/rawdatafile.tsamp).astype('int')
+
+    if dm:
+        nbinsextra = np.round((duration + dmfac * dm)/rawdatafile.tsamp).astype('int')
+    else:
+        nbinsextra = nbins    
+
+    # If at end of observation
+    if (start_bin + nbinsextra) > rawdatafile.nspec-1:
+        nbinsextra = rawdatafile.nspec-1-start_bin
+    return start_bin, nbinsextra, nbins
+
 def waterfall(rawdatafile, start, duration, dm=None, nbins=None, nsub=None,\
               subdm=None, zerodm=False, downsamp=1, scaleindep=False,\
               width_bins=1, mask=False, maskfn=None, csv_file=None, bandpass_corr=False, \
@@ -142,20 +186,7 @@ def waterfall(rawdatafile, start, duration, dm=None, nbins=None, nsub=None,\
     try: source_name=rawdatafile.header['source_name']
     except: source_name="Unknown"
 	
-    start_bin = np.round(start/rawdatafile.tsamp).astype('int')
-    dmfac = 4.15e3 * np.abs(1./rawdatafile.frequencies[0]**2 - 1./rawdatafile.frequencies[-1]**2)
-
-    if nbins is None:
-        nbins = np.round(duration/rawdatafile.tsamp).astype('int')
-
-    if dm:
-        nbinsextra = np.round((duration + dmfac * dm)/rawdatafile.tsamp).astype('int')
-    else:
-        nbinsextra = nbins    
-
-    # If at end of observation
-    if (start_bin + nbinsextra) > rawdatafile.nspec-1:
-        nbinsextra = rawdatafile.nspec-1-start_bin
+    start_bin, nbinsextra, nbins = cutout_window(rawdatafile, start, duration, dm, nbins)
 
     data = rawdatafile.get_spectra(start_bin, nbinsextra)
     # Masking
@@ -193,7 +224,7 @@ def waterfall(rawdatafile, start, duration, dm=None, nbins=None, nsub=None,\
 	
     # Bandpass correction
     if maskfn and bandpass_corr:
-        bandpass = rfifind.rfifind(maskfn).bandpass_avg[::-1]
+        bandpass = load_rfimask(maskfn).bandpass_avg[::-1]
         #bandpass[bandpass == 0] = np.min(bandpass[np.nonzero(bandpass)])
         masked_chans[bandpass == 0] = True
 
@@ -299,12 +330,20 @@ def waterfall(rawdatafile, start, duration, dm=None, nbins=None, nsub=None,\
 	     	
     return data, nbinsextra, nbins, start, source_name
 
+def dmvstm(data, dms, nbins):
+    """ DM-vs-time array of the first nbins of data (presto Spectra) for
+        the trial DMs dms: the rotations of Spectra.dedisperse(padval='rotate')
+        from data.dm to every DM, from one FDMT of the data.
+    """
+    # Masked channels left out of the sums
+    return dm_time(np.ma.filled(data.data, 0), data.freqs, data.dt, np.asarray(dms, dtype=float) - data.dm, nbins)
+
 def plot_waterfall(data, start, source_name, duration, dm,ofile,
                    integrate_ts=False, integrate_spec=False, show_cb=False, 
                    cmap_str="gist_yarg", sweep_dms=[], sweep_posns=[], 
                    ax_im=None, ax_ts=None, ax_spec=None, interactive=False, 
 		   downsamp=1,nsub=None,subdm=None,width=None, snr=None, csv_file=None,
-		   prob=None, min_value=None):
+		   prob=None, min_value=None, ndms=48):
     """ I want a docstring too!
     """
 
@@ -379,7 +418,6 @@ def plot_waterfall(data, start, source_name, duration, dm,ofile,
                 ax_spec.axhline(data.freqs[i],alpha=0.4,color='grey')
 
     # DM-vs-time plot	
-    dmvstm_array = []
     #Old way
     ''' 
     lodm = int(dm-(dm*0.15))
@@ -401,18 +439,10 @@ def plot_waterfall(data, start, source_name, duration, dm,ofile,
     else:
         hidm= dm+FWHM_DM
     print(FWHM_DM,dm,lodm,hidm)
-    dmstep = (hidm-lodm)/48.0
-    datacopy = copy.deepcopy(data)
+    dmstep = (hidm-lodm)/float(ndms)
     #print lodm,hidm
-    for ii in np.arange(lodm,hidm,dmstep):
-    #for ii in range(400,600,10):
-	#Without this, dispersion delay with smaller DM step does not produce delay close to bin width
-        data.dedisperse(0,padval='rotate')
-        data.dedisperse(ii,padval='rotate')		
-        Data = np.array(data.data[..., :nbinlim])			
-        Dedisp_ts = Data.sum(axis=0)
-        dmvstm_array.append(Dedisp_ts)
-    dmvstm_array=np.array(dmvstm_array)		
+    #All trial DMs at once from the rotations relative to the DM of the data (data is unchanged)
+    dmvstm_array = dmvstm(data, np.arange(lodm,hidm,dmstep), nbinlim)
     #print np.shape(dmvstm_array)
     #np.save('dmvstm_1step.npz',dmvstm_array)
     ax_dmvstm.set_xlabel("Time (sec) ")
@@ -431,7 +461,6 @@ def plot_waterfall(data, start, source_name, duration, dm,ofile,
     	
 
     #Plot Freq-vs-time 
-    data = copy.deepcopy(datacopy)
     #data.downsample(downsamp)
     data.dedisperse(dm,padval='rotate')	
     nbinlim = int(duration/data.dt)
@@ -636,7 +665,43 @@ def plot_waterfall(data, start, source_name, duration, dm,ofile,
    
     plt.savefig(ofile)
     #plt.show()
+    # Workers of the pooled renderer keep plotting in the same process
+    plt.close(fig)
     return ofile,ttest,ttestprob	
+
+def cand_csv_row(rawdatafile, fn, ofile, ttest, ttestprob, snr, width, dm, prob):
+    """Return the one row DataFrame which is logged in the --logs CSV file
+        for a plotted candidate.
+    """
+    ttestprob = "%.2f" % ((1-ttestprob)*100)
+    ttest = "%.2f" % (ttest)
+    sourcename=rawdatafile.header['source_name']
+    try: src_ra=rawdatafile.header['src_raj']
+    except: src_ra = '00'
+    try: src_dec=rawdatafile.header['src_dej']
+    except: src_dec="00"
+    tstart=rawdatafile.header['tstart']
+    fch1=rawdatafile.header['fch1']
+    nchans=rawdatafile.header['nchans']
+    bw=int(rawdatafile.header['nchans'])*rawdatafile.header['foff']
+    cat=ofile.split("_")[0]
+    if not prob: prob="*"
+    df = pd.DataFrame({'PNGFILE':[ofile],'Category':[cat],'Prob':[prob],'T-test':[ttest],'T-test_prob':[ttestprob],'SNR':[snr],'WIDTH':[width],'DM':[dm],'SourceName':[sourcename],'RA':[src_ra],'DEC':[src_dec],'MJD':[tstart],'Hfreq':[fch1],'NCHANS':[nchans],'BANDWIDTH':[bw],'filename':[fn]})
+
+    #Column order coming out irregular, so fixing it here
+    col=['PNGFILE','Category','Prob','T-test','T-test_prob','SNR','WIDTH','DM','SourceName','RA','DEC','MJD','Hfreq','NCHANS','BANDWIDTH','filename']
+    return df.reindex(columns=col)
+
+def append_csv(csv_file, df):
+    """Append rows to the CSV file, writing the header if it is a new file.
+    The file is locked while writing: waterfaller_vg.py processes run in
+    parallel append to the same file.
+    """
+    with open(csv_file,'a') as f:
+        fcntl.flock(f,fcntl.LOCK_EX)
+        f.seek(0,os.SEEK_END)
+        df.to_csv(f,header=(f.tell()==0),index=False)
+        f.flush()
    
 def main():
     fn = args[0]
@@ -644,7 +709,7 @@ def main():
     if fn.endswith(".fil"):
         # Filterbank file
         filetype = "filterbank"
-        rawdatafile = filterbank.FilterbankFile(fn)
+        rawdatafile = FilterbankMmap(fn)
     elif fn.endswith(".fits"):
         # PSRFITS file
         filetype = "psrfits"
@@ -673,39 +738,13 @@ def main():
                    cmap_str=options.cmap, sweep_dms=options.sweep_dms, \
                    sweep_posns=options.sweep_posns, downsamp=options.downsamp,\
 		   width=options.width,snr=options.snr,csv_file=options.csv_file,prob=options.prob,\
-		   interactive=options.inter_plt)	
+		   interactive=options.inter_plt,ndms=options.ndms)	
 
-    ttestprob = "%.2f" % ((1-ttestprob)*100)
-    ttest = "%.2f" % (ttest)
     # Update CSV file if file is provided	
     if csv_file:
-        sourcename=rawdatafile.header['source_name']
-        try: src_ra=rawdatafile.header['src_raj']
-        except: src_ra = '00'
-        try: src_dec=rawdatafile.header['src_dej']
-        except: src_dec="00"
-        tstart=rawdatafile.header['tstart']
-        fch1=rawdatafile.header['fch1']
-        nchans=rawdatafile.header['nchans']
-        bw=int(rawdatafile.header['nchans'])*rawdatafile.header['foff']
-        cat=ofile.split("_")[0]
-        snr=options.snr
-        width=options.width
-        dm=options.dm
-        if options.prob: prob=options.prob
-        else:	prob="*"	
-        df = pd.DataFrame({'PNGFILE':[ofile],'Category':[cat],'Prob':[prob],'T-test':[ttest],'T-test_prob':[ttestprob],'SNR':[snr],'WIDTH':[width],'DM':[dm],'SourceName':[sourcename],'RA':[src_ra],'DEC':[src_dec],'MJD':[tstart],'Hfreq':[fch1],'NCHANS':[nchans],'BANDWIDTH':[bw],'filename':[fn]})	
-
-	#Column order coming out irregular, so fixing it here
-        col=['PNGFILE','Category','Prob','T-test','T-test_prob','SNR','WIDTH','DM','SourceName','RA','DEC','MJD','Hfreq','NCHANS','BANDWIDTH','filename']
-        df = df.reindex(columns=col)
-
-        if os.path.exists(csv_file) is False: 	
-                with open(csv_file,'w') as f:
-                        df.to_csv(f,header=True,index=False)			
-        else:
-                with open(csv_file,'a') as f:
-                        df.to_csv(f,header=False,index=False)
+        df = cand_csv_row(rawdatafile, fn, ofile, ttest, ttestprob, options.snr, \
+                          options.width, options.dm, options.prob)
+        append_csv(csv_file, df)
 
 
 if __name__=='__main__':
@@ -810,6 +849,10 @@ if __name__=='__main__':
                                 "Range of channels is zapped if given range 'n:m'."\
                                 "Seperate multiple sets with commas e.g 2,5,7:9",
                         default=None)
+    parser.add_option('--ndms', dest='ndms', type='int',
+                        help="Number of trial DMs of the DM-vs-time plot. " \
+                                "(Default: 48)",
+                        default=48)
     parser.add_option('--ip', dest='inter_plt',
                         help="Interactive mode for plotting with interactive_plot.py",
                         default=False)
@@ -1,13 +1,14 @@
 #!/usr/bin/python
 
 import numpy as np
-import argparse, glob
-import subprocess
+import argparse, glob, os, sys
 from time import time
 from tqdm import tqdm
 
 # generate Spectra objects for FRB injection
 from waterfaller import filterbank, waterfall
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../FRBsearching'))
+from obsinfo import obs_info
 
 """
 Converts filterbank files to Spectra objects, which will then be used to
@@ -37,8 +38,7 @@ def fil2spec(fname, num_channels, num_time, spectra_array, total_samples, sample
     raw_filterbank_file = filterbank.FilterbankFile(fname)
 
     # grab total observation time to split up samples
-    t_obs = float(subprocess.check_output(['/usr/local/sigproc/bin/header',
-                                            fname, '-tobs']))
+    t_obs = obs_info(fname)['tobs']
 
     # generate samples_per_file random timesteps to sample from in filterbank file
     random_timesteps = np.random.choice(np.arange(int(t_obs)), size=samples_per_file)
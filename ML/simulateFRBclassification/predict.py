@@ -13,6 +13,8 @@ from keras.models import load_model, Model
 
 from training_utils import scale_data, compute_time_series
 import PlotCand_dom
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../FRBsearching'))
+from obsinfo import obs_info
 #from waterfaller import filterbank, waterfall
 
 """After taking in a directory of .fil files and a model,
@@ -25,17 +27,17 @@ os.environ['HDF5_USE_FILE_LOCKING'] = 'FALSE'
 
 def extract_candidates(fil_file, frb_cands, frbcand_path, NCHAN, NTIME, manualzap,save_png=False):
     # load filterbank file and candidate list
-    f = PlotCand_dom.FilReader(fil_file)
+    f = obs_info(fil_file)
 
     # other parameters
     noplot = 1
-    nchan = f.header.nchans
-    fch1 = f.header.fch1
-    foff = f.header.foff
+    nchan = f['nchans']
+    fch1 = f['fch1']
+    foff = f['foff']
     fl = fch1 + (foff*nchan)
     fh = fch1
-    tint = f.header.tsamp
-    Ttot = f.header.tobs
+    tint = f['tsamp']
+    Ttot = f['tobs']
     kill_time_range, kill_chans = [], []
     #if(f.header['source_anme']) 
     #	source_name = f.header['source_name']
@@ -120,6 +122,64 @@ def create_ensemble(model_names):
 
     return ensemble_model
 
+def load_models(model_names):
+    """Load a single model, or the ensemble of several models."""
+    if len(model_names) == 1:
+        return load_model(model_names[0], compile=True)
+    return create_ensemble(model_names)
+
+def predict_candidates(model, frb_cand_path, filterbank_candidate=None, NCHAN=64, NTIME=256,
+                       manualzap="None", skip_extract=False, keep_spectra=False,
+                       FRBcandprob=None, suppress_prob_save=False):
+    """Predict the FRB probability of every candidate of an FRBcand file
+    with a loaded model (see load_models), and save FRBcand_prob.txt.
+    Returns the paths of the spectra, the spectra and the predictions."""
+
+    frb_cand_info = np.loadtxt(frb_cand_path, dtype={'names': ('snr','time','samp_idx','dm','filter','prim_beam'),
+                                    'formats': ('f4', 'f4', 'i4','f4','i4','i4')})
+
+    if skip_extract is False:
+        print("Getting data about FRB candidates from " + frb_cand_path)
+        extract_candidates(filterbank_candidate, frb_cand_info, frb_cand_path, NCHAN, NTIME,manualzap)
+
+        time.sleep(10) # give some leeway for extraction in background to finish
+
+    print("Retrieving candidate spectra")
+    spectra_paths, candidate_spectra = get_pulses(os.path.dirname(frb_cand_path), NCHAN, keep_spectra=keep_spectra)
+
+    # retrieve freq-time data from each spectra
+    ftdata = np.array([spec.data for spec in candidate_spectra])
+
+    # compute time series for every spectrogram in ftdata
+    print('Getting time series for each sample...'),
+    time_series = compute_time_series(ftdata)
+    print('All time series computed!\n')
+
+    # scale each channel to zero median and each array to unit stddev
+    print("\nScaling arrays."),
+    scale_data(ftdata)
+    print("Done scaling!")
+
+    # add num_channel dimension to vectors for Keras
+    ftdata = ftdata[..., None]
+    time_series = time_series[..., None]
+
+    print(np.shape(time_series))
+    predictions = model.predict([ftdata, time_series],verbose=1)[:, 0]
+    print(predictions)
+
+    # save probabilities to disk along with candidate data
+    if not suppress_prob_save:
+        if not FRBcandprob:
+            FRBcand_prob_path = os.path.dirname(frb_cand_path) + '/FRBcand_prob.txt'
+        else:
+            FRBcand_prob_path = FRBcandprob + '/FRBcand_prob.txt'
+
+        print("Saving probabilities to {0}".format(FRBcand_prob_path))
+        save_prob_to_disk(frb_cand_info, predictions, FRBcand_prob_path)
+
+    return spectra_paths, candidate_spectra, predictions
+
 if __name__ == "__main__":
     """
     Parameters
@@ -189,54 +249,11 @@ if __name__ == "__main__":
     print(manualzap)
     model_names = args.model_names # either single model or list of models to ensemble predict
 
-    frb_cand_info = np.loadtxt(frb_cand_path, dtype={'names': ('snr','time','samp_idx','dm','filter','prim_beam'),
-                                    'formats': ('f4', 'f4', 'i4','f4','i4','i4')})
-
-    if args.skip_extract is False:
-        print("Getting data about FRB candidates from " + frb_cand_path)
-        extract_candidates(filterbank_candidate, frb_cand_info, frb_cand_path, NCHAN, NTIME,manualzap)
-
-        time.sleep(10) # give some leeway for extraction in background to finish
-
-    print("Retrieving candidate spectra")
-    spectra_paths, candidate_spectra = get_pulses(os.path.dirname(frb_cand_path), NCHAN, keep_spectra=args.keep_spectra)
-
-    # retrieve freq-time data from each spectra
-    ftdata = np.array([spec.data for spec in candidate_spectra])
-
-    # compute time series for every spectrogram in ftdata
-    print('Getting time series for each sample...'),
-    time_series = compute_time_series(ftdata)
-    print('All time series computed!\n')
-
-    # scale each channel to zero median and each array to unit stddev
-    print("\nScaling arrays."),
-    scale_data(ftdata)
-    print("Done scaling!")
-
-    # add num_channel dimension to vectors for Keras
-    ftdata = ftdata[..., None]
-    time_series = time_series[..., None]
-
     # load model(s) and predict
-    if len(model_names) == 1:
-        model = load_model(model_names[0], compile=True)
-    else:
-        model = create_ensemble(model_names)
-
-    print(np.shape(time_series))
-    predictions = model.predict([ftdata, time_series],verbose=1)[:, 0]
-    print(predictions)
-
-    # save probabilities to disk along with candidate data
-    if not args.suppress_prob_save:
-        if not args.FRBcandprob:
-            FRBcand_prob_path = os.path.dirname(frb_cand_path) + '/FRBcand_prob.txt'
-        else:
-            FRBcand_prob_path = args.FRBcandprob + '/FRBcand_prob.txt'
-
-        print("Saving probabilities to {0}".format(FRBcand_prob_path))
-        save_prob_to_disk(frb_cand_info, predictions, FRBcand_prob_path)
+    model = load_models(model_names)
+    spectra_paths, candidate_spectra, predictions = predict_candidates(
+        model, frb_cand_path, filterbank_candidate, NCHAN, NTIME, manualzap,
+        args.skip_extract, args.keep_spectra, args.FRBcandprob, args.suppress_prob_save)
 
     # threshold predictions to choose FRB/RFI
     voted_FRB_probs = predictions > args.thresh